@@ -9,7 +9,8 @@ cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir))
 sys.path.append(head)
 from src.utils.debug import t_print
-from src.data_loader.utils import reduce_data, new_indices, pad_raw_data, all_horizons, separating_and_resampling
+from src.data_loader.utils import reduce_data, new_indices, pad_raw_data, all_horizons, separating_and_resampling, \
+    horizon_groups, kernel_geometry
 
 
 class DataGenerator:
@@ -22,7 +23,9 @@ class DataGenerator:
                  to_save=False,
                  debug=False,
                  fixed_idx_per_class=False,
-                 features=None):
+                 features=None,
+                 precompute_geometry=False,
+                 horizon_batches=False):
         t_print("DataGenerator -- init")
         cwd = os.path.dirname(os.path.abspath(__file__))
         self.head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir))
@@ -40,6 +43,18 @@ class DataGenerator:
 
         # data = [Y, T, ind_K_D, ind_T, len_T, X, len_X, labels, static, classes, ids, ind_Y]
         # data = [0, 1,       2,     3,     4, 5,     6,      7,      8,       9,  10,    11]
+        if precompute_geometry:
+            # gathered & time ordered observations, to be used with MultiKernelMGPLayer(pre_gathered=True)
+            self.train_data = kernel_geometry(self.train_data)
+            self.val_data = kernel_geometry(self.val_data)
+            self.test_data = kernel_geometry(self.test_data)
+        self.val_horizons = None
+        self.test_horizons = None
+        if horizon_batches:
+            # truncated copies of each stay, to evaluate all horizons with one GP factorisation per stay
+            # (next_batch_dev_horizons, next_batch_test_horizons)
+            self.val_horizons = horizon_groups(self.val_data)
+            self.test_horizons = horizon_groups(self.test_data)
         if debug == False:
             # remove IDs & debugging cat
             self.train_data = self.train_data[:-2]
@@ -156,6 +171,27 @@ class DataGenerator:
         data = [self.test_data[i][batch * batch_size: (batch + 1) * batch_size] for i in range(len(self.test_data))]
         yield self.extract_data(data)
 
+    def next_batch_dev_horizons(self, batch_size, batch):
+        yield self.extract_horizons(self.val_data, self.val_horizons, batch_size, batch)
+
+    def next_batch_test_horizons(self, batch_size, batch):
+        yield self.extract_horizons(self.test_data, self.test_horizons, batch_size, batch)
+
+    def extract_horizons(self, data, horizons, batch_size, batch):
+        """
+        full stays together with the size of each of their truncated copies, see MultiKernelMGPLayer.call_horizons
+        labels and classes are given for every copy: patient x horizon x MC sample, rows_h < 0 flags dropped copies
+        """
+        rows, num_obs_h, num_grid_h, rows_h = [h[batch * batch_size: (batch + 1) * batch_size] for h in horizons]
+        output = list(self.extract_data([data[i][rows] for i in range(len(data))]))
+        n_horizons = num_obs_h.shape[1]
+        # labels & classes for every copy
+        output[8] = tf.convert_to_tensor(np.repeat(data[7][rows], n_horizons * self.no_mc_samples), dtype=tf.int32)
+        output[9] = np.repeat(np.tile(np.arange(n_horizons), len(rows)), self.no_mc_samples)
+        return output + [tf.convert_to_tensor(num_obs_h, dtype=tf.int32),
+                         tf.convert_to_tensor(num_grid_h, dtype=tf.int32),
+                         np.repeat(rows_h.reshape(-1), self.no_mc_samples)]
+
     def extract_data(self, data):
         # data = [Y, T, ind_K_D, ind_T, num_distinct_Y, X, num_distinct_X, labels, static, classes]
         # data = [0, 1,       2,     3,              4, 5,              6,      7,      8,       9]
@@ -54,6 +54,30 @@ def new_indices(data):
     return [np.asarray(data[i])[idx] for i in range(len(data))]
 
 
+def kernel_geometry(data):
+    """
+    precomputes the parameter free part of the GP inputs once, instead of at every step in the GP layer:
+    observations are gathered with ind_T (times and values follow ind_K_D) and put in time order,
+    which also makes every truncated stay of all_horizons a prefix of its full stay
+    stored compactly: float32 values and times, int8 feature indices, ind_T becomes the identity
+    :param data: [Y, T, ind_K_D, ind_T, len_T, X, len_X, labels, static, classes, ids, ind_Y]
+    :return: data in the same format, to be used with MultiKernelMGPLayer(pre_gathered=True)
+    """
+    Y, T, ind_K_D, ind_T, len_T = [np.asarray(data[i]) for i in range(5)]
+    ind_T = ind_T.astype(np.int64)
+    mask = np.arange(T.shape[1])[np.newaxis, :] < np.asarray(len_T)[:, np.newaxis]
+    # times in the feature order of ind_K_D, then sorted by time (padding last)
+    T_feat = np.take_along_axis(T, ind_T, axis=1)
+    order = np.argsort(np.where(mask, T_feat, np.inf), axis=1, kind='stable')
+    perm = np.take_along_axis(ind_T, order, axis=1)
+    data[0] = np.where(mask, np.take_along_axis(Y, perm, axis=1), 0).astype(np.float32)
+    data[1] = np.where(mask, np.take_along_axis(T, perm, axis=1), 0).astype(np.float32)
+    data[2] = np.where(mask, np.take_along_axis(ind_K_D, order, axis=1), 0).astype(np.int8)
+    data[3] = np.broadcast_to(np.arange(T.shape[1], dtype=np.int16), T.shape)
+    data[5] = np.asarray(data[5]).astype(np.float32)
+    return data
+
+
 def pad_raw_data(data):
     # data = [Y, T, ind_Y, len_T, X, len_X, labels, ids, static]
     # data = [0, 1,     2,     3, 4,     5,      6,   7,      8]
@@ -152,6 +176,32 @@ def all_horizons(data):
     return data
 
 
+def horizon_groups(data, n_horizons=7):
+    """
+    groups the truncated copies of each stay created by all_horizons
+    the copy at horizon h keeps the first num_obs_h[h] observations (in time) of the stay at horizon 0
+    :param data: [Y, T, ind_K_D, ind_T, len_T, X, len_X, labels, static, classes, ids, ind_Y]
+    :return: rows: index of the horizon 0 copy of each stay
+             num_obs_h, num_grid_h: number of observations and grid times of each copy (0 if dropped)
+             rows_h: index of each copy (-1 if dropped)
+    """
+    classes = np.asarray(data[9])
+    ids = np.asarray(data[10])
+    rows = np.where(classes == 0)[0]
+    row_of_id = {ids[row]: k for k, row in enumerate(rows)}
+    num_obs_h = np.zeros((len(rows), n_horizons), dtype=np.int32)
+    num_grid_h = np.zeros((len(rows), n_horizons), dtype=np.int32)
+    rows_h = - np.ones((len(rows), n_horizons), dtype=np.int32)
+    for i in range(len(ids)):
+        k = row_of_id.get(ids[i])
+        if k is None:
+            continue
+        num_obs_h[k, classes[i]] = data[4][i]
+        num_grid_h[k, classes[i]] = data[6][i]
+        rows_h[k, classes[i]] = i
+    return rows, num_obs_h, num_grid_h, rows_h
+
+
 def separating_and_resampling(data):
     """
     resamples case patients (or controls) to have a balanced dataset
@@ -2,7 +2,10 @@ import numpy as np
 import tensorflow as tf
 
 def GP_loss(model, inputs, labels, weighted_loss=None):
-    out = model(inputs)
+    return logits_loss(model(inputs), labels, weighted_loss)
+
+
+def logits_loss(out, labels, weighted_loss=None):
     temp_labels = tf.reshape(labels, (-1, 1))
     y_star = tf.concat([temp_labels, tf.ones_like(temp_labels) - temp_labels], axis=1, name="y_star")
     if weighted_loss is not None:
@@ -23,6 +23,7 @@ def main(
         features,
         late_patients_only,
         horizon0,
+        pre_gathered,
         # model
         model_choice,
         # MGP
@@ -53,6 +54,7 @@ def main(
         "features": features,
         "late_patients_only": late_patients_only,
         "horizon0": horizon0,
+        "pre_gathered": pre_gathered,
         # model
        "model_choice": model_choice,
         # MGP
@@ -86,7 +88,8 @@ def main(
                          to_save=True,
                          debug=True,
                          fixed_idx_per_class=False,
-                         features=features)
+                         features=features,
+                         precompute_geometry=pre_gathered)
 
     t_print("main - generate model and optimiser")
     optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
@@ -103,7 +106,8 @@ def main(
                      num_layers=num_layers,
                      kernel_size=kernel_size,
                      stride=stride,
-                     sigmoid_beta=sigmoid_beta)
+                     sigmoid_beta=sigmoid_beta,
+                     pre_gathered=pre_gathered)
 
     # Initialise trainer
     trainer = Trainer(model=model,
@@ -139,6 +143,8 @@ if __name__=="__main__":
     features = None
     late_patients_only = False
     horizon0 = False
+    # observations gathered & time ordered once by the data loader instead of at every step
+    pre_gathered = False
 
     # model
     model_choice = 'Att'  # ['Att', 'Moor']
@@ -179,6 +185,7 @@ if __name__=="__main__":
         features,
         late_patients_only,
         horizon0,
+        pre_gathered,
         # model
         model_choice,
         # MGP
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import contextlib
 import os
 import sys
 import tensorflow as tf
@@ -9,7 +10,11 @@ import numpy as np
 cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
 sys.path.append(head)
-from src.models.GP_utils import kroneker_matrix, OU_kernel, K_vitals_initialiser, K_labs_initialiser
+from src.models.GP_utils import abs_distance, OU_kernel, OU_sqrt, OU_matmul, OU_grid_matmul, multi_kernel_covariance, \
+    safe_cholesky, standard_normal, cholesky_failed, cholesky_grad, K_vitals_initialiser, K_labs_initialiser, \
+    K_vitals_log_diag_initialiser, K_labs_log_diag_initialiser
+from src.models.GP_solvers import batch_cg, lanczos_sample
+from src.models.GP_state_space import kalman_smoother_draws
 from src.utils.debug import t_print
 
 
@@ -26,11 +31,25 @@ class MultiKernelMGPLayer(tf.keras.layers.Layer):
                  method_name='chol',
                  add_diag=0.001,
                  save_path=head,
-                 moor_data=False):
+                 moor_data=False,
+                 n_buckets=4,
+                 cg_max_iter=100,
+                 cg_tol=1e-4,
+                 cg_matrix_free=False,
+                 n_lanczos=20,
+                 pre_gathered=False,
+                 max_chol_tries=4,
+                 static_shapes=False,
+                 feature_groups=None,
+                 K_D_rank=None,
+                 noise='mc',
+                 noise_seed=0,
+                 lean_gradient=False,
+                 gp_dtype='float32'):
 
         super(MultiKernelMGPLayer, self).__init__()
-        if method_name not in ['chol', 'cg']:
-            raise NameError("method_name not in ['chol', 'cg']")
+        if method_name not in ['chol', 'cg', 'kalman', 'pathwise', 'grid']:
+            raise NameError("method_name not in ['chol', 'cg', 'kalman', 'pathwise', 'grid']")
         # t_print("Welcome to MyMGPLayer")
         # number of Monte Carlo samples
         self.time_window = time_window
@@ -42,15 +61,39 @@ class MultiKernelMGPLayer(tf.keras.layers.Layer):
 
         # covariance of medical features
         # enforcing positive definitiveness by using its cholesky decomposition
-        self.K_D_half_v_prior = self.add_weight(name="GP_features_kernel",
-                                                  shape=[n_features, n_features],
-                                                  initializer=K_vitals_initialiser,
+        # K_D_rank: K_D = W W^T + diag instead, with W = n_features x K_D_rank (a few latent physiological factors)
+        self.K_D_rank = K_D_rank
+        if K_D_rank is None:
+            self.K_D_half_v_prior = self.add_weight(name="GP_features_kernel",
+                                                      shape=[n_features, n_features],
+                                                      initializer=K_vitals_initialiser,
+                                                      trainable=True
+                                                      )
+
+            self.K_D_half_l_prior = self.add_weight(name="GP_features_kernel",
+                                                      shape=[n_features, n_features],
+                                                      initializer=K_labs_initialiser,
+                                                      trainable=True
+                                                      )
+        else:
+            self.K_D_half_v_prior = self.add_weight(name="GP_features_kernel",
+                                                      shape=[n_features, K_D_rank],
+                                                      initializer=tf.initializers.truncated_normal(stddev=0.1),
+                                                      trainable=True
+                                                      )
+            self.K_D_log_diag_v = self.add_weight(name="GP_features_log_diag",
+                                                  shape=[n_features],
+                                                  initializer=K_vitals_log_diag_initialiser,
                                                   trainable=True
                                                   )
-
-        self.K_D_half_l_prior = self.add_weight(name="GP_features_kernel",
-                                                  shape=[n_features, n_features],
-                                                  initializer=K_labs_initialiser,
+            self.K_D_half_l_prior = self.add_weight(name="GP_features_kernel",
+                                                      shape=[n_features, K_D_rank],
+                                                      initializer=tf.initializers.truncated_normal(stddev=0.1),
+                                                      trainable=True
+                                                      )
+            self.K_D_log_diag_l = self.add_weight(name="GP_features_log_diag",
+                                                  shape=[n_features],
+                                                  initializer=K_labs_log_diag_initialiser,
                                                   trainable=True
                                                   )
 
@@ -78,19 +121,99 @@ class MultiKernelMGPLayer(tf.keras.layers.Layer):
                                               )
 
         # matrix decomposition method
+        # 'chol': dense cholesky of the prior and posterior covariances
+        # 'cg': conjugate gradients for the prior solves and Lanczos for the posterior square root
+        # 'kalman': Kalman filter / simulation smoother on the state space form of the OU kernels,
+        #           linear in the number of time points (no need to truncate long stays with reduce_data)
+        # 'pathwise': cholesky of Sigma_prior only, posterior draws with Matheron's rule (no posterior cholesky)
+        # 'grid': observation times on the hourly grid, Matheron's rule with Toeplitz x Kronecker prior matvecs (FFT)
+        #         and CG, near linear in the length of the stay (buckets off the grid use 'chol')
         self.method_name = method_name
+        self.cg_max_iter = cg_max_iter
+        self.cg_tol = cg_tol
+        # 'cg' prior matvecs with prior_matmul (OU scans) instead of the dense Sigma_prior: O(n_obs n_feat) memory
+        # per column instead of O(n_obs^2) per patient, for stays whose Sigma_prior does not fit in memory
+        # (slower than the dense matvec at the usual stay lengths)
+        self.cg_matrix_free = cg_matrix_free
+        self.n_lanczos = n_lanczos
+        # 'chol' draws with a hand written gradient keeping only the cholesky factors (see lean_posterior_draws),
+        # opt-in: less memory on the tape, the autodiff gradient otherwise
+        self.lean_gradient = lean_gradient
+        # precision of the covariance assembly, factorisations and solves ('chol', 'cg', 'pathwise' and the moments),
+        # 'float64' makes the jitter retries of try_cholesky rare, the draws are returned in float32
+        self.gp_dtype = tf.as_dtype(gp_dtype)
         self.add_diag = add_diag
         self.lost_to_OOM = []
         self.moor_data = moor_data
+        # number of length buckets the batch is split into (one batched factorisation per bucket)
+        self.n_buckets = n_buckets
+        # inputs from DataGenerator(precompute_geometry=True): Y and T already gathered with ind_T
+        self.pre_gathered = pre_gathered
+        # cholesky with escalating jitter (see try_cholesky), the retries of the last call are kept in chol_telemetry
+        # max_chol_tries: retries after the first factorisation, the last one with a diagonal dominance jitter
+        self.max_chol_tries = max_chol_tries
+        # static_shapes: the cholesky retries factorise the whole batch again, the grid draws always compute their
+        # cholesky fallback (no dynamic shapes, for XLA)
+        self.static_shapes = static_shapes
+        self.chol_telemetry = []
+        self.current_patients = None
+
+        # noise of the MC draws: 'mc', 'antithetic', 'sobol' or 'crn' (see GP_utils.standard_normal)
+        # with 'crn' every call uses the same draws (seeded with noise_seed and the rank of the draw within the call)
+        if noise not in ['mc', 'antithetic', 'sobol', 'crn']:
+            raise NameError("noise not in ['mc', 'antithetic', 'sobol', 'crn']")
+        self.noise = noise
+        self.noise_seed = noise_seed
+        self.noise_calls = 0
+
+        # cross-feature covariance structure
+        # None: dense K_D_v, K_D_l coupling all features
+        # 'vitals_labs': vitals and labs independent (the split of K_vitals_initialiser / K_labs_initialiser)
+        # 'independent': every feature on its own
+        # or a list of lists of feature indices
+        # with groups the posterior factorises into one (smaller) solve per group
+        self.n_features_total = n_features
+        if feature_groups == 'vitals_labs':
+            feature_groups = [list(range(7)), list(range(7, n_features))]
+        elif feature_groups == 'independent':
+            feature_groups = [[f] for f in range(n_features)]
+        self.feature_groups = feature_groups
+        if feature_groups is not None:
+            group_of = np.zeros(n_features, dtype=int)
+            for g, group in enumerate(feature_groups):
+                group_of[group] = g
+            self.group_mask = tf.constant(group_of[:, np.newaxis] == group_of[np.newaxis, :], tf.float32)
+            # concatenated group outputs -> original feature order
+            self.group_inverse = tf.constant(np.argsort(np.concatenate(feature_groups)), tf.int32)
 
     def variable_update(self):
-        # K_D from K_D_half_prior
-        # keep lower triangular part
-        self.K_D_v_half = tf.linalg.band_part(self.K_D_half_v_prior, -1, 0)
-        self.K_D_l_half = tf.linalg.band_part(self.K_D_half_l_prior, -1, 0)
-        # multiply
-        self.K_D_v = tf.matmul(self.K_D_v_half, tf.transpose(self.K_D_v_half))
-        self.K_D_l = tf.matmul(self.K_D_l_half, tf.transpose(self.K_D_l_half))
+        if self.K_D_rank is None:
+            # K_D from K_D_half_prior
+            # keep lower triangular part
+            self.K_D_v_half = tf.linalg.band_part(self.K_D_half_v_prior, -1, 0)
+            self.K_D_l_half = tf.linalg.band_part(self.K_D_half_l_prior, -1, 0)
+            if self.feature_groups is not None:
+                # no coupling across groups: K_D = K_D_half K_D_half^T is then block diagonal
+                self.K_D_v_half = self.K_D_v_half * self.group_mask
+                self.K_D_l_half = self.K_D_l_half * self.group_mask
+            # multiply
+            self.K_D_v = tf.matmul(self.K_D_v_half, tf.transpose(self.K_D_v_half))
+            self.K_D_l = tf.matmul(self.K_D_l_half, tf.transpose(self.K_D_l_half))
+            self.K_D_factors = None
+        else:
+            # K_D = W W^T + diag, products with K_D go through W (see K_D_matmul)
+            self.K_D_factors = [(self.K_D_half_v_prior, tf.exp(self.K_D_log_diag_v)),
+                                (self.K_D_half_l_prior, tf.exp(self.K_D_log_diag_l))]
+            K_Ds = []
+            for W, diag in self.K_D_factors:
+                WWT = tf.matmul(W, W, transpose_b=True)
+                if self.feature_groups is not None:
+                    WWT = WWT * self.group_mask
+                K_Ds.append(WWT + tf.linalg.diag(diag))
+            self.K_D_v, self.K_D_l = K_Ds
+            # square factors for the state space and pathwise draws (n_feat^3, negligible next to the solves)
+            self.K_D_v_half = tf.linalg.cholesky(self.K_D_v)
+            self.K_D_l_half = tf.linalg.cholesky(self.K_D_l)
 
         # D from log_noises
         noises = tf.exp(self.log_noises)
@@ -100,67 +223,314 @@ class MultiKernelMGPLayer(tf.keras.layers.Layer):
         self.length_v = tf.exp(self.log_length_v)
         self.length_l = tf.exp(self.log_length_l)
 
-    def __call__(self, inputs):
+        # additive components of the prior covariance, sum_c K_D_c x_kroneker OU(length_c)
+        self.K_Ds = [self.K_D_v, self.K_D_l]
+        self.lengths = [self.length_v, self.length_l]
+
+    def __call__(self, inputs, moments=False):
+        # moments: no draws, returns the posterior mean and marginal variances (batch x grid_max x n_feat each)
         # first calculate data indep. (but differentiable) matrices
         # this needs to happen within 'call' to be taped in the GradientTape (TF eager exec)
         self.variable_update()
 
         if len(inputs[0].shape) == 1:
+            # single patient: add the batch dimension
             for k in range(len(inputs)):
-                inputs[k] = tf.reshape(inputs[k], (-1, 1))
+                inputs[k] = tf.reshape(inputs[k], (1, -1))
         # Y, T, ind_features, num_distinct_Y, X, num_distinct_X,
-        Y, T, ind_K_D, ind_T, num_obs, X, num_tcn_grid_times = inputs
+        inputs = list(inputs)
+        inputs[4] = tf.reshape(inputs[4], [-1])
+        inputs[6] = tf.reshape(inputs[6], [-1])
+        grid_max = self.time_window
+        # moments: mean and variance take the place of the MC samples
+        n_out = 2 if moments else self.n_mc_samples
+
+        self.chol_telemetry = []
+        self.noise_calls = 0
+        if self.feature_groups is None:
+            Z = self.draw_buckets(inputs, n_out, moments)
+        else:
+            # block diagonal K_D: independent posteriors, one per feature group
+            Z_groups = []
+            for group in self.feature_groups:
+                group_inputs, _ = self.group_inputs(inputs, group)
+                with self.group_parameters(group):
+                    Z_groups.append(self.draw_buckets(group_inputs, n_out, moments))
+            Z = tf.gather(tf.concat(Z_groups, -1), self.group_inverse, axis=-1)
+
+        if moments:
+            return Z[:, 0], Z[:, 1]
+        # Z = [patient_1 sample_1, ..., patient_1 sample_n, patient_2 sample_1, ...] x grid_max x n_feat
+        return tf.reshape(Z, (-1, grid_max, self.n_features))
 
+    def posterior(self, inputs):
+        """
+        posterior mean and covariance of the last grid_max grid times of each patient, no MC draws
+        (used to cache the posteriors once the GP is trained, see GP_cache.PosteriorCache)
+        the output is right aligned like the draws of __call__: short stays get a zero mean and covariance
+        :return: mean = batch x grid_max x n_feat,
+                 covariance = batch x grid_max * n_feat x grid_max * n_feat (time major, same order as the mean)
+        """
+        self.variable_update()
+        Y, T, ind_K_D, ind_T, num_obs, X, X_len = inputs
+        batch = tf.shape(T)[0]
+        self.chol_telemetry = []
+        self.noise_calls = 0
+        self.current_patients = tf.range(batch)
+        # all feature groups at once, K_D is block diagonal already
+        Xi, X_len = self.restrict_grid(X, tf.reshape(X_len, [-1]))
+        with self.gp_precision():
+            Mu, Sigma = self.draw_GP(Y, T, ind_K_D, ind_T, Xi, tf.reshape(num_obs, [-1]), X_len, moments='full')
+
+        # position of (time, feature) of the output in the feature major grid of draw_GP
+        X_max = tf.shape(Xi)[1]
+        positions = tf.expand_dims(X_len - self.time_window, -1) + tf.range(self.time_window)
+        valid = tf.repeat(tf.cast(positions >= 0, tf.float32), self.n_features, axis=1)
+        idx = tf.reshape(tf.expand_dims(tf.maximum(positions, 0), -1) + X_max * tf.range(self.n_features), (batch, -1))
+        Mu = tf.gather(Mu[..., 0], idx, batch_dims=1) * valid
+        Sigma = tf.gather(tf.gather(Sigma, idx, axis=1, batch_dims=1), idx, axis=2, batch_dims=1)
+        Sigma = Sigma * tf.expand_dims(valid, -1) * tf.expand_dims(valid, -2)
+        return tf.reshape(Mu, (batch, self.time_window, self.n_features)), Sigma
+
+    def draw_buckets(self, inputs, n_out, moments=False):
+        # draws (or moments) for the whole batch, one batched factorisation per length bucket
+        # returns batch x n_out x grid_max x n_feat, in the original patient order
+        Y, T, ind_K_D, ind_T, num_obs, X, num_tcn_grid_times = inputs
         grid_max = self.time_window
-        Z = tf.zeros((0, grid_max, self.n_features))
         batch_size = tf.shape(T)[0]
 
-        # while loop is parallelisable
-        def cond(i, Z):
-            return i < batch_size
-
-        def body(i, Z):
-            Yi = tf.reshape(tf.slice(Y, [i, 0], [1, num_obs[i]]), [-1])
-            Ti = tf.reshape(tf.slice(T, [i, 0], [1, num_obs[i]]), [-1])
-            ind_K_Di = tf.reshape(tf.slice(ind_K_D, [i, 0], [1, num_obs[i]]), [-1])
-            ind_Ti = tf.reshape(tf.slice(ind_T, [i, 0], [1, num_obs[i]]), [-1])
-            Xi = tf.reshape(tf.slice(X, [i, 0], [1, num_tcn_grid_times[i]]), [-1])
-            X_len = num_tcn_grid_times[i]
+        Z_buckets = []
+        Z_idx = []
+        for idx in self.make_buckets(num_obs):
+            Yb, Tb, ind_K_Db, ind_Tb, num_obs_b, Xb, X_len_b = self.bucket_inputs(inputs, num_obs, num_tcn_grid_times,
+                                                                                   idx)
+            self.current_patients = idx
             try:
-                GP_draws_i = self.draw_GP(Yi=Yi,
-                                          Ti=Ti,
-                                          ind_K_Di=ind_K_Di,
-                                          ind_Ti=ind_Ti,
-                                          Xi=Xi,
-                                          X_len=X_len,
-                                          i=i)
-                padding = grid_max - X_len
-                if padding > 0:
-                    # aligning data to the right
-                    padded_GP_draws_i = tf.concat([tf.zeros((self.n_mc_samples, padding, self.n_features)), GP_draws_i],
-                                                  1)
-                elif padding < 0:
-                    padded_GP_draws_i = tf.slice(GP_draws_i,
-                                                 [0, GP_draws_i.shape[1] - grid_max, 0],
-                                                 [self.n_mc_samples, grid_max, self.n_features])
-                else:
-                    padded_GP_draws_i = GP_draws_i
-                Z = tf.concat([Z, padded_GP_draws_i], 0)
-                # t_print("Z: {}".format(Z.shape))
-            except Exception as e:
-                print(e)
-                self.lost_to_OOM.append([Yi, Ti, ind_K_Di, ind_Ti, Xi, X_len, self.length, self.K_D, self.D])
-                Z = tf.concat([Z, tf.zeros((self.n_mc_samples, grid_max, self.n_features))], 0)
-            return i + 1, Z
-
-        i = tf.constant(0)
-        (i, Z) = tf.while_loop(cond,
-                               body,
-                               loop_vars=[i, Z],
-                               shape_invariants=[i.get_shape(),
-                                                 tf.TensorShape([None, None, None])])
-
-        return Z
+                # the posterior is only needed on the grid times the TCN consumes
+                Xb, X_len_b = self.restrict_grid(Xb, X_len_b)
+                with self.gp_precision():
+                    GP_draws_b = self.draw_GP(Yi=Yb,
+                                              Ti=Tb,
+                                              ind_K_Di=ind_K_Db,
+                                              ind_Ti=ind_Tb,
+                                              Xi=Xb,
+                                              num_obs=num_obs_b,
+                                              X_len=X_len_b,
+                                              moments=moments)
+                Z_buckets.append(self.align_right(GP_draws_b, X_len_b))
+            except tf.errors.ResourceExhaustedError as e:
+                # the whole bucket gets zero draws, any other error is raised
+                t_print("MultiKernelMGPLayer -- out of memory, zero draws for a bucket of {} patients: {}".format(
+                    int(tf.shape(idx)[0]), e.message))
+                self.lost_to_OOM.append([Yb, Tb, ind_K_Db, ind_Tb, Xb, X_len_b,
+                                         self.length_v, self.length_l, self.K_D_v, self.K_D_l, self.D])
+                Z_buckets.append(tf.zeros((tf.shape(idx)[0], n_out, grid_max, self.n_features)))
+            Z_idx.append(idx)
+
+        # write all buckets back in the original patient order
+        return tf.scatter_nd(tf.expand_dims(tf.concat(Z_idx, 0), -1),
+                             tf.concat(Z_buckets, 0),
+                             tf.stack([batch_size, n_out, grid_max, self.n_features]))
+
+    def call_horizons(self, inputs, num_obs_h, num_grid_h):
+        """
+        draws for all prediction horizons of each stay with a single factorisation per stay
+        the stay truncated at a later horizon keeps its first observations in time, hence its Sigma_prior is a leading
+        block of the full Sigma_prior in time order, and its cholesky the leading block of the full cholesky
+        :param inputs: full stays (horizon 0), same format as __call__
+        :param num_obs_h: batch x n_horizons, number of observations of each truncated stay (0 if dropped)
+        :param num_grid_h: batch x n_horizons, number of grid times of each truncated stay
+        :return: [patient_1 horizon_1 sample_1, ..., patient_1 horizon_1 sample_n, patient_1 horizon_2 ...]
+                 x grid_max x n_feat
+        """
+        self.variable_update()
+        Y, T, ind_K_D, ind_T, num_obs, X, num_tcn_grid_times = inputs
+        num_obs = tf.reshape(num_obs, [-1])
+        num_tcn_grid_times = tf.reshape(num_tcn_grid_times, [-1])
+        grid_max = self.time_window
+
+        # observations in time order
+        obs_mask = tf.sequence_mask(num_obs, tf.shape(ind_K_D)[1], dtype=tf.float32)
+        Ti_big = T if self.pre_gathered else tf.gather(T, ind_T, batch_dims=1)
+        time_order = tf.argsort(tf.where(obs_mask > 0, Ti_big, np.inf * tf.ones_like(Ti_big)), stable=True)
+        ind_K_D = tf.gather(ind_K_D, time_order, batch_dims=1)
+        if self.pre_gathered:
+            T = tf.gather(T, time_order, batch_dims=1)
+            Y = tf.gather(Y, time_order, batch_dims=1)
+        else:
+            ind_T = tf.gather(ind_T, time_order, batch_dims=1)
+            if self.moor_data:
+                Y = tf.gather(Y, time_order, batch_dims=1)
+        inputs = [Y, T, ind_K_D, ind_T, num_obs, X, num_tcn_grid_times]
+
+        self.chol_telemetry = []
+        self.noise_calls = 0
+        if self.feature_groups is None:
+            Z = self.draw_buckets_horizons(inputs, num_obs_h, num_grid_h)
+        else:
+            Z_groups = []
+            for group in self.feature_groups:
+                group_inputs, mask_g = self.group_inputs(inputs, group)
+                # the observations of a group stay in time order: truncated stays are still prefixes
+                count_g = tf.pad(tf.cumsum(tf.cast(mask_g, tf.int32), axis=1), [[0, 0], [1, 0]])
+                num_obs_h_g = tf.gather(count_g, num_obs_h, batch_dims=1)
+                with self.group_parameters(group):
+                    Z_groups.append(self.draw_buckets_horizons(group_inputs, num_obs_h_g, num_grid_h))
+            Z = tf.gather(tf.concat(Z_groups, -1), self.group_inverse, axis=-1)
+        return tf.reshape(Z, (-1, grid_max, self.n_features))
+
+    def draw_buckets_horizons(self, inputs, num_obs_h, num_grid_h):
+        # inputs in time order, returns batch x n_horizons x n_mc_samples x grid_max x n_feat
+        Y, T, ind_K_D, ind_T, num_obs, X, num_tcn_grid_times = inputs
+        grid_max = self.time_window
+        batch_size = tf.shape(T)[0]
+        n_horizons = tf.shape(num_obs_h)[1]
+
+        Z_buckets = []
+        Z_idx = []
+        for idx in self.make_buckets(num_obs):
+            Yb, Tb, ind_K_Db, ind_Tb, num_obs_b, Xb, X_len_b = self.bucket_inputs(inputs, num_obs, num_tcn_grid_times,
+                                                                                   idx)
+            self.current_patients = idx
+            num_obs_hb = tf.gather(num_obs_h, idx)
+            num_grid_hb = tf.gather(num_grid_h, idx)
+            with self.gp_precision():
+                L = None
+                if self.method_name in ['chol', 'pathwise']:
+                    # one factorisation of the full stay
+                    obs_mask_b = tf.sequence_mask(num_obs_b, tf.shape(Tb)[1], dtype=self.D.dtype)
+                    Ti_big = tf.cast(Tb if self.pre_gathered else tf.gather(Tb, ind_Tb, batch_dims=1), self.D.dtype)
+                    Sigma_prior, _ = self.prior_covariance(Ti_big, ind_K_Db, obs_mask_b)
+                    L, num_tries = self.try_cholesky(Sigma_prior)
+                GP_draws_b = []
+                for horizon in range(num_obs_h.shape[1]):
+                    L_h = None
+                    if L is not None:
+                        # cholesky of the truncated stay (padded with an identity block)
+                        mask_h = tf.sequence_mask(num_obs_hb[:, horizon], tf.shape(Tb)[1], dtype=L.dtype)
+                        L_h = L * tf.expand_dims(mask_h, -1) * tf.expand_dims(mask_h, -2) + tf.linalg.diag(1 - mask_h)
+                    Xh, X_len_h = self.restrict_grid(Xb, num_grid_hb[:, horizon])
+                    GP_draws_h = self.draw_GP(Yi=Yb,
+                                              Ti=Tb,
+                                              ind_K_Di=ind_K_Db,
+                                              ind_Ti=ind_Tb,
+                                              Xi=Xh,
+                                              num_obs=num_obs_hb[:, horizon],
+                                              X_len=X_len_h,
+                                              L=L_h)
+                    GP_draws_b.append(self.align_right(GP_draws_h, X_len_h))
+            Z_buckets.append(tf.stack(GP_draws_b, 1))
+            Z_idx.append(idx)
+
+        return tf.scatter_nd(tf.expand_dims(tf.concat(Z_idx, 0), -1),
+                             tf.concat(Z_buckets, 0),
+                             tf.stack([batch_size, n_horizons, self.n_mc_samples, grid_max, self.n_features]))
+
+    def group_inputs(self, inputs, group):
+        # observations of the features of group, moved to the front (their order is kept),
+        # feature indices relative to the group
+        Y, T, ind_K_D, ind_T, num_obs, X, num_tcn_grid_times = inputs
+        group = tf.constant(group, tf.int32)
+        in_group = tf.scatter_nd(tf.expand_dims(group, -1), tf.ones_like(group), [self.n_features_total])
+        local_index = tf.scatter_nd(tf.expand_dims(group, -1), tf.range(tf.shape(group)[0]),
+                                    [self.n_features_total])
+        obs_mask = tf.sequence_mask(num_obs, tf.shape(ind_K_D)[1])
+        mask_g = tf.logical_and(obs_mask, tf.gather(in_group, ind_K_D) > 0)
+        order = tf.argsort(1 - tf.cast(mask_g, tf.int32), stable=True)
+        ind_K_D = tf.gather(local_index, tf.gather(ind_K_D, order, batch_dims=1))
+        if not self.pre_gathered:
+            # times and values in the order of ind_K_D (ind_T becomes the identity), so that the buckets
+            # can be cut to the number of observations of the group
+            T = tf.gather(T, ind_T, batch_dims=1)
+            if not self.moor_data:
+                Y = tf.gather(Y, ind_T, batch_dims=1)
+            ind_T = tf.broadcast_to(tf.range(tf.shape(ind_T)[1]), tf.shape(ind_T))
+        T = tf.gather(T, order, batch_dims=1)
+        Y = tf.gather(Y, order, batch_dims=1)
+        num_obs = tf.reduce_sum(tf.cast(mask_g, tf.int32), 1)
+        return [Y, T, ind_K_D, ind_T, num_obs, X, num_tcn_grid_times], mask_g
+
+    @contextlib.contextmanager
+    def group_parameters(self, group):
+        # the parameters of the layer restricted to the features of group (K_D is block diagonal)
+        saved = [self.n_features, self.K_D_v_half, self.K_D_l_half, self.K_D_v, self.K_D_l, self.D]
+        saved_factors = self.K_D_factors
+        self.n_features = len(group)
+        self.K_D_v_half, self.K_D_l_half, self.K_D_v, self.K_D_l, self.D = \
+            [tf.gather(tf.gather(M, group), group, axis=1) for M in saved[1:]]
+        self.K_Ds = [self.K_D_v, self.K_D_l]
+        if saved_factors is not None:
+            self.K_D_factors = [(tf.gather(W, group), tf.gather(diag, group)) for W, diag in saved_factors]
+        try:
+            yield
+        finally:
+            self.n_features, self.K_D_v_half, self.K_D_l_half, self.K_D_v, self.K_D_l, self.D = saved
+            self.K_Ds = [self.K_D_v, self.K_D_l]
+            self.K_D_factors = saved_factors
+
+    @contextlib.contextmanager
+    def gp_precision(self):
+        # the parameters of the layer in gp_dtype (state space and grid backends stay in float32)
+        if self.gp_dtype == tf.float32 or self.method_name in ['kalman', 'grid']:
+            yield
+            return
+        saved = [self.K_D_v_half, self.K_D_l_half, self.K_D_v, self.K_D_l, self.D, self.length_v, self.length_l]
+        saved_factors = self.K_D_factors
+        self.K_D_v_half, self.K_D_l_half, self.K_D_v, self.K_D_l, self.D, self.length_v, self.length_l = \
+            [tf.cast(M, self.gp_dtype) for M in saved]
+        self.K_Ds = [self.K_D_v, self.K_D_l]
+        self.lengths = [self.length_v, self.length_l]
+        if saved_factors is not None:
+            self.K_D_factors = [(tf.cast(W, self.gp_dtype), tf.cast(diag, self.gp_dtype)) for W, diag in saved_factors]
+        try:
+            yield
+        finally:
+            self.K_D_v_half, self.K_D_l_half, self.K_D_v, self.K_D_l, self.D, self.length_v, self.length_l = saved
+            self.K_Ds = [self.K_D_v, self.K_D_l]
+            self.lengths = [self.length_v, self.length_l]
+            self.K_D_factors = saved_factors
+
+    def make_buckets(self, num_obs):
+        # patients are sorted by number of observations and cut into buckets of similar length
+        # each bucket is padded to its own longest patient and solved with a single batched cholesky
+        batch_size = tf.shape(num_obs)[0]
+        order = tf.argsort(num_obs, stable=True)
+        return [order[(bucket * batch_size) // self.n_buckets: ((bucket + 1) * batch_size) // self.n_buckets]
+                for bucket in range(self.n_buckets)]
+
+    def bucket_inputs(self, inputs, num_obs, num_tcn_grid_times, idx):
+        Y, T, ind_K_D, ind_T, _, X, _ = inputs
+        num_obs_b = tf.gather(num_obs, idx)
+        X_len_b = tf.gather(num_tcn_grid_times, idx)
+        # at least one column, so that empty buckets keep well defined shapes
+        n_max = tf.reduce_max(tf.concat([[1], num_obs_b], 0))
+        X_max = tf.reduce_max(tf.concat([[1], X_len_b], 0))
+        return [tf.gather(Y, idx)[:, :n_max],
+                tf.gather(T, idx)[:, :n_max],
+                tf.gather(ind_K_D, idx)[:, :n_max],
+                tf.gather(ind_T, idx)[:, :n_max],
+                num_obs_b,
+                tf.gather(X, idx)[:, :X_max],
+                X_len_b]
+
+    def restrict_grid(self, Xi, X_len):
+        # last grid_max grid times of each patient (all observations are still used for conditioning),
+        # shrinks the posterior over long stays from X_len x n_feat to grid_max x n_feat
+        # Xi = batch x X, X_len = batch -> batch x min(X, grid_max), batch
+        X_len_tw = tf.minimum(X_len, self.time_window)
+        width = tf.minimum(tf.shape(Xi)[1], self.time_window)
+        positions = tf.expand_dims(X_len - X_len_tw, -1) + tf.range(width)
+        positions = tf.minimum(positions, tf.shape(Xi)[1] - 1)
+        grid_mask = tf.sequence_mask(X_len_tw, width, dtype=Xi.dtype)
+        return tf.gather(Xi, positions, batch_dims=1) * grid_mask, X_len_tw
+
+    def align_right(self, GP_draws, X_len):
+        # GP_draws = batch x n_mc_samples x X x n_feat
+        # keep the last grid_max grid times of each patient, short stays are left padded with zeros
+        positions = tf.expand_dims(X_len - self.time_window, -1) + tf.range(self.time_window)
+        valid = tf.cast(positions >= 0, tf.float32)
+        aligned = tf.gather(GP_draws, tf.maximum(positions, 0), axis=2, batch_dims=1)
+        return aligned * tf.reshape(valid, (-1, 1, self.time_window, 1))
 
     def draw_GP(self,
                 Yi,
@@ -168,87 +538,496 @@ class MultiKernelMGPLayer(tf.keras.layers.Layer):
                 ind_K_Di,
                 ind_Ti,
                 Xi,
+                num_obs,
                 X_len,
-                i
+                L=None,
+                moments=False,
+                method_name=None
                 ):
+        # all inputs are padded to the longest patient of the bucket: Yi, Ti, ind_K_Di, ind_Ti = batch x n_obs
+        # Xi = batch x X, num_obs = X_len = batch
+        # padded entries get an identity block, decoupled from the true data points
+        # L: cholesky of Sigma_prior if already known ('chol' and 'pathwise')
+        # method_name: overrides self.method_name (the 'chol' fallback of 'grid')
+        # moments: posterior mean and marginal variances instead of draws (batch x 2 x X x n_feat)
+        #          'full': posterior mean and covariance over the grid (batch x [x_i] * n_feat x 1 and squared)
+        batch = tf.shape(Ti)[0]
+        # in the precision of the parameters (see gp_precision)
+        Yi, Ti, Xi = [tf.cast(M, self.D.dtype) for M in [Yi, Ti, Xi]]
+        obs_mask = tf.sequence_mask(num_obs, tf.shape(Ti)[1], dtype=Ti.dtype)
 
-        # step I: calculate Sigma = K_D_v x_kroneker K_Ti_v + K_D_l x_kroneker K_Ti_l + D x_kroneker I
-        Ti_big = tf.gather(Ti, ind_Ti)
+        if self.pre_gathered:
+            # times and values already in the order of ind_K_Di (DataGenerator(precompute_geometry=True))
+            Ti_big = Ti
+            Yi_reordered = Yi
+        else:
+            Ti_big = tf.gather(Ti, ind_Ti, batch_dims=1)
+            if self.moor_data:
+                Yi_reordered = Yi
+            else:
+                Yi_reordered = tf.gather(Yi, ind_Ti, batch_dims=1)
+        Yi_reordered = Yi_reordered * obs_mask
 
-        K_Ti_v_big = OU_kernel(length=self.length_v, x1=Ti_big, x2=Ti_big)
-        K_Ti_l_big = OU_kernel(length=self.length_l, x1=Ti_big, x2=Ti_big)
+        method_name = method_name or self.method_name
+        if method_name == 'kalman' and not moments:
+            # linear in the number of time points, no covariance matrix over observations is built
+            grid_mask = tf.sequence_mask(X_len, tf.shape(Xi)[1], dtype=tf.float32)
+            return self.kalman_posterior_draws(Yi_reordered, Ti_big, ind_K_Di, obs_mask, Xi, grid_mask)
 
-        # calculate the kroneker product only for values that are actually present
-        K_D_v_big = kroneker_matrix(self.K_D_v, ind_K_Di)
-        K_D_l_big = kroneker_matrix(self.K_D_l, ind_K_Di)
+        if method_name == 'grid' and not moments:
+            grid_mask = tf.sequence_mask(X_len, tf.shape(Xi)[1], dtype=tf.float32)
+            # the tensors of a branch of tf.cond stay in it (graph mode): the telemetry of the cholesky retries of
+            # the fallback is returned by the cond, the grid branch returns the same structure without retries
+            # both branches are traced in graph mode: they start from the same noise_calls ('crn' seeds)
+            n_telemetry = len(self.chol_telemetry)
+            fallback_telemetry = []
+            noise_calls = self.noise_calls
 
-        K_D__K_Ti = tf.multiply(K_D_v_big, K_Ti_v_big) + tf.multiply(K_D_l_big, K_Ti_l_big)
+            def chol_draws():
+                self.noise_calls = noise_calls
+                draws = self.draw_GP(Yi, Ti, ind_K_Di, ind_Ti, Xi, num_obs, X_len, L=L, method_name='chol')
+                fallback_telemetry.extend(self.chol_telemetry[n_telemetry:])
+                del self.chol_telemetry[n_telemetry:]
+                return draws, [t[1:] for t in fallback_telemetry]
 
-        D_big = kroneker_matrix(self.D, ind_K_Di)
-        D__I = tf.linalg.diag(tf.linalg.diag_part(D_big))
+            def grid_draws():
+                self.noise_calls = noise_calls
+                draws = self.grid_posterior_draws(Yi_reordered, Ti_big, ind_K_Di, obs_mask, Xi, grid_mask)
+                return tf.cast(draws, tf.float32), [(tf.ones([batch], tf.int32), tf.zeros([batch], t[2].dtype))
+                                                    for t in fallback_telemetry]
 
-        Sigma_prior = K_D__K_Ti + D__I + self.add_diag * tf.eye(tf.cast(D__I.shape[0], tf.int32))
+            off_grid = tf.logical_not(self.on_grid(Ti_big, obs_mask, Xi, grid_mask))
+            if self.static_shapes:
+                # XLA does not compile the gradient of this tf.cond (FakeParam): both draws are computed
+                fallback, grid = chol_draws(), grid_draws()
+                draws, telemetry = tf.nest.map_structure(lambda a, b: tf.where(off_grid, a, b), fallback, grid)
+            else:
+                # (the fallback is traced first, true_fn)
+                draws, telemetry = tf.cond(off_grid, chol_draws, grid_draws)
+            self.chol_telemetry.extend([(t[0],) + tuple(x) for t, x in zip(fallback_telemetry, telemetry)])
+            return draws
+
+        # step I: calculate Sigma = K_D_v x_kroneker K_Ti_v + K_D_l x_kroneker K_Ti_l + D x_kroneker I
+        if L is None and (method_name != 'cg' or moments or not self.cg_matrix_free):
+            Sigma_prior, D_big = self.prior_covariance(Ti_big, ind_K_Di, obs_mask)
+        else:
+            # matrix free 'cg' draws only apply Sigma_prior through prior_matmul
+            Sigma_prior, D_big = None, tf.gather(tf.linalg.diag_part(self.D), ind_K_Di)
 
         # step II: calculate Sigma for new datapoints
-        ind_K_D_l = tf.concat([tf.tile([i], [X_len]) for i in range(self.n_features)], 0)
-        K_D_v_big = kroneker_matrix(self.K_D_v, ind_K_D_l)
-        K_D_l_big = kroneker_matrix(self.K_D_l, ind_K_D_l)
-        ind_K_Xi = tf.tile(tf.range(X_len), [self.n_features])
-        Xi_big = tf.gather(Xi, ind_K_Xi)
-        K_Xi_v_big = OU_kernel(self.length_v, Xi_big, Xi_big)
-        K_Xi_l_big = OU_kernel(self.length_l, Xi_big, Xi_big)
-        K_D__K_Xi = tf.multiply(K_D_v_big, K_Xi_v_big) + tf.multiply(K_D_l_big, K_Xi_l_big)
+        X_max = tf.shape(Xi)[1]
+        grid_mask = tf.sequence_mask(X_len, X_max, dtype=Ti.dtype)
+        ind_K_D_l = tf.repeat(tf.range(self.n_features), X_max)
+        ind_K_Xi = tf.tile(tf.range(X_max), [self.n_features])
+        grid_mask_big = tf.gather(grid_mask, ind_K_Xi, axis=1)
+        Xi_big = tf.gather(Xi, ind_K_Xi, axis=1)
 
         # K_D__K_XT
-        K_D_v_big = kroneker_matrix(self.K_D_v, ind_K_Di, ind_K_D_l)
-        K_D_l_big = kroneker_matrix(self.K_D_l, ind_K_Di, ind_K_D_l)
-        K_XT_v_big = OU_kernel(self.length_v, Xi_big, Ti_big)
-        K_XT_l_big = OU_kernel(self.length_l, Xi_big, Ti_big)
-        K_D__K_XT = tf.multiply(K_D_v_big, K_XT_v_big) + tf.multiply(K_D_l_big, K_XT_l_big)
+        K_D__K_XT = multi_kernel_covariance(self.K_Ds, self.lengths, Xi_big, ind_K_D_l, Ti_big, ind_K_Di,
+                                            mask1=grid_mask_big, mask2=obs_mask)
         # t_print("K_D__K_XT {}".format(K_D__K_XT.shape))
 
-        # K_D_K_TX
-        K_D__K_TX = tf.transpose(K_D__K_XT)
+        Yi_reordered = tf.expand_dims(Yi_reordered, -1)
 
-        # step III: inverse Sigma_prior
-        L, num_tries = self.try_cholesky(Sigma_prior)
-        if self.moor_data:
-            Mu = tf.matmul(K_D__K_XT, tf.linalg.cholesky_solve(L, tf.reshape(Yi, [-1, 1])))
+        # step III: inverse Sigma_prior and draw from the posterior
+        if moments == 'full':
+            Mu, Sigma = self.posterior_covariance(Sigma_prior, K_D__K_XT, Yi_reordered, Xi_big, grid_mask_big, L=L)
+            return tf.cast(Mu, tf.float32), tf.cast(Sigma, tf.float32)
+        elif moments:
+            # dense moments for every method_name, the grid is at most grid_max long
+            draws = self.posterior_moments(Sigma_prior, K_D__K_XT, Yi_reordered, grid_mask_big, L=L)
+            draws = tf.transpose(tf.reshape(draws, (batch, self.n_features, X_max, 2)), perm=[0, 3, 2, 1])
+            return tf.cast(draws, tf.float32)
+        elif method_name == 'pathwise':
+            draws = self.pathwise_posterior_draws(Sigma_prior, K_D__K_XT, Yi_reordered, Ti_big, ind_K_Di, D_big,
+                                                  obs_mask, Xi, grid_mask, L=L)
         else:
-            Yi_reordered = tf.gather(Yi, ind_Ti)
-            Mu = tf.matmul(K_D__K_XT, tf.linalg.cholesky_solve(L, tf.reshape(Yi_reordered, [-1, 1])))
+            epsilon = self.standard_normal((batch, X_max * self.n_features, self.n_mc_samples))
+            if method_name == 'chol':
+                draws = self.chol_posterior_draws(Sigma_prior, K_D__K_XT, Yi_reordered, Xi_big, grid_mask_big,
+                                                  epsilon, L=L)
+            else:
+                draws = self.cg_posterior_draws(Sigma_prior, Ti_big, ind_K_Di, D_big, obs_mask, K_D__K_XT,
+                                                Yi_reordered, Xi, grid_mask, epsilon)
+
+        # draws = batch x [x_i] * n_feat x n_mc_samples
+        shaped_draws = tf.transpose(tf.reshape(draws, (batch, self.n_features, X_max, self.n_mc_samples)),
+                                    perm=[0, 3, 2, 1])
+        # shaped_draws = batch x n_mc_samples x X x n_feat
+        return tf.cast(shaped_draws, tf.float32)
+
+    def prior_covariance(self, Ti_big, ind_K_Di, obs_mask):
+        # Sigma_prior = K_D_v x_kroneker K_Ti_v + K_D_l x_kroneker K_Ti_l + D x_kroneker I
+        # calculate the kroneker product only for values that are actually present
+        D_big = tf.gather(tf.linalg.diag_part(self.D), ind_K_Di)
+        Sigma_prior = multi_kernel_covariance(self.K_Ds, self.lengths, Ti_big, ind_K_Di, mask1=obs_mask,
+                                              diag=D_big + self.add_diag)
+        return Sigma_prior, D_big
+
+    def chol_posterior_draws(self, Sigma_prior, K_D__K_XT, Yi, Xi_big, grid_mask, epsilon, L=None):
+        # dense posterior: Sigma = K_D__K_Xi - K_D__K_XT Sigma_prior^-1 K_D__K_TX, drawn from via its cholesky
+        ind_K_D_l = tf.repeat(tf.range(self.n_features), tf.shape(Xi_big)[1] // self.n_features)
+        K_D__K_Xi = multi_kernel_covariance(self.K_Ds, self.lengths, Xi_big, ind_K_D_l, mask1=grid_mask)
+
+        # K_D_K_TX
+        K_D__K_TX = tf.transpose(K_D__K_XT, perm=[0, 2, 1])
+
+        if L is None:
+            L, num_tries = self.try_cholesky(Sigma_prior)
+        if self.lean_gradient:
+            return self.lean_posterior_draws(L, K_D__K_XT, K_D__K_Xi, Yi, epsilon)
+        Mu = tf.matmul(K_D__K_XT, tf.linalg.cholesky_solve(L, Yi))
         Sigma = K_D__K_Xi - tf.matmul(K_D__K_XT, tf.linalg.cholesky_solve(L, K_D__K_TX)) \
-                + self.add_diag * tf.eye(tf.cast(tf.shape(K_D__K_Xi)[0], tf.int32))
-        epsilon = tf.random.normal((tf.shape(Xi)[0] * self.n_features, self.n_mc_samples))
+                + self.add_diag * tf.eye(tf.shape(K_D__K_Xi)[-1], dtype=K_D__K_Xi.dtype)
         chol_Sigma, num_tries = self.try_cholesky(Sigma)
-        draws = tf.matmul(chol_Sigma, epsilon) + Mu
+        return tf.matmul(chol_Sigma, epsilon) + Mu
+
+    def lean_posterior_draws(self, L, K_D__K_XT, K_D__K_Xi, Yi, epsilon):
+        # same draws as chol_posterior_draws, with a hand written gradient:
+        # the tape only keeps both cholesky factors, alpha = Sigma_prior^-1 Yi and the inputs,
+        # Sigma_prior^-1 K_D__K_TX is solved again in the backward pass instead of being stored
+        # (the forward runs on detached inputs, so none of its intermediates are recorded)
+        # with S = K_D__K_Xi - K_D__K_XT Sigma_prior^-1 K_D__K_TX, B = Sigma_prior^-1 K_D__K_TX:
+        #   dS = cholesky_grad(chol_S, d_draws epsilon^T), d_Mu = sum_s d_draws
+        #   dK_D__K_Xi = dS, dK_D__K_XT = d_Mu alpha^T - 2 dS B^T
+        #   dSigma_prior = B dS B^T - B d_Mu alpha^T (implicit differentiation of the solves), dL = 2 sym(dSigma_prior) L
+        @tf.custom_gradient
+        def posterior_draws(L, K_D__K_XT, K_D__K_Xi):
+            L, K_D__K_XT, K_D__K_Xi = [tf.stop_gradient(t) for t in [L, K_D__K_XT, K_D__K_Xi]]
+            alpha = tf.linalg.cholesky_solve(L, Yi)
+            A = tf.linalg.triangular_solve(L, tf.transpose(K_D__K_XT, perm=[0, 2, 1]))
+            Sigma = K_D__K_Xi - tf.matmul(A, A, transpose_a=True) \
+                    + self.add_diag * tf.eye(tf.shape(K_D__K_Xi)[-1], dtype=K_D__K_Xi.dtype)
+            chol_Sigma, num_tries = self.try_cholesky(Sigma)
+            draws = tf.matmul(chol_Sigma, epsilon) + tf.matmul(K_D__K_XT, alpha)
+
+            def grad(d_draws):
+                dS = cholesky_grad(chol_Sigma, tf.linalg.band_part(tf.matmul(d_draws, epsilon, transpose_b=True),
+                                                                   -1, 0))
+                d_Mu = tf.reduce_sum(d_draws, -1, keepdims=True)
+                B = tf.linalg.cholesky_solve(L, tf.transpose(K_D__K_XT, perm=[0, 2, 1]))
+                dK_D__K_XT = tf.matmul(d_Mu, alpha, transpose_b=True) - 2 * tf.matmul(dS, B, transpose_b=True)
+                dSigma_prior = tf.matmul(tf.matmul(B, dS), B, transpose_b=True) \
+                               - tf.matmul(tf.matmul(B, d_Mu), alpha, transpose_b=True)
+                dL = tf.matmul(dSigma_prior + tf.linalg.adjoint(dSigma_prior), L)
+                return tf.linalg.band_part(dL, -1, 0), dK_D__K_XT, dS
+
+            return draws, grad
+
+        return posterior_draws(L, K_D__K_XT, K_D__K_Xi)
+
+    def posterior_covariance(self, Sigma_prior, K_D__K_XT, Yi, Xi_big, grid_mask, L=None):
+        # Mu = K_D__K_XT Sigma_prior^-1 Yi, Sigma = K_D__K_Xi - K_D__K_XT Sigma_prior^-1 K_D__K_TX
+        ind_K_D_l = tf.repeat(tf.range(self.n_features), tf.shape(Xi_big)[1] // self.n_features)
+        K_D__K_Xi = multi_kernel_covariance(self.K_Ds, self.lengths, Xi_big, ind_K_D_l, mask1=grid_mask)
+        if L is None:
+            L, num_tries = self.try_cholesky(Sigma_prior)
+        Mu = tf.matmul(K_D__K_XT, tf.linalg.cholesky_solve(L, Yi))
+        A = tf.linalg.triangular_solve(L, tf.transpose(K_D__K_XT, perm=[0, 2, 1]))
+        return Mu, K_D__K_Xi - tf.matmul(A, A, transpose_a=True)
+
+    def posterior_moments(self, Sigma_prior, K_D__K_XT, Yi, grid_mask, L=None):
+        # Mu = K_D__K_XT Sigma_prior^-1 Yi, var = diag(K_D__K_Xi) - diag(K_D__K_XT Sigma_prior^-1 K_D__K_TX)
+        # returns batch x [x_i] * n_feat x 2 (mean, variance)
+        if L is None:
+            L, num_tries = self.try_cholesky(Sigma_prior)
+        Mu = tf.matmul(K_D__K_XT, tf.linalg.cholesky_solve(L, Yi))
+        A = tf.linalg.triangular_solve(L, tf.transpose(K_D__K_XT, perm=[0, 2, 1]))
+        ind_K_D_l = tf.repeat(tf.range(self.n_features), tf.shape(grid_mask)[1] // self.n_features)
+        prior_var = tf.gather(tf.add_n([tf.linalg.diag_part(K_D) for K_D in self.K_Ds]), ind_K_D_l)
+        var = (prior_var - tf.reduce_sum(tf.square(A), -2)) * grid_mask
+        return tf.concat([Mu, tf.expand_dims(tf.nn.relu(var), -1)], -1)
+
+    def prior_matmul(self, Ti_big, ind_K_Di, D_big, obs_mask, V):
+        # Sigma_prior V without forming Sigma_prior (same masking as prior_covariance), V = batch x n_obs x k
+        # for every component the observations are spread over their feature (batch x n_obs x n_feat x k), summed over
+        # time with the OU kernel (OU_matmul, in time order) and mixed with K_D_c: O(n_obs n_feat k) memory
+        mask = tf.expand_dims(obs_mask, -1)
+        last = tf.reduce_max(tf.where(obs_mask > 0, Ti_big, -np.inf * tf.ones_like(Ti_big)), 1, keepdims=True)
+        last = tf.where(tf.math.is_finite(last), last, tf.zeros_like(last))
+        # the padding (zero values) is moved after the last valid time
+        order = tf.argsort(tf.where(obs_mask > 0, Ti_big, last * tf.ones_like(Ti_big)), stable=True)
+        inverse = tf.argsort(order)
+        W = tf.expand_dims(tf.one_hot(ind_K_Di, self.n_features, dtype=V.dtype), -1) * tf.expand_dims(V * mask, -2)
+        times = tf.gather(tf.where(obs_mask > 0, Ti_big, last * tf.ones_like(Ti_big)), order, batch_dims=1)
+        W = tf.gather(W, order, batch_dims=1)
+        KV = 0
+        for c, length in enumerate(self.lengths):
+            U = tf.gather(OU_matmul(length, times, W), inverse, batch_dims=1)
+            U = tf.transpose(self.K_D_matmul(c, tf.transpose(U, perm=[0, 2, 1, 3])), perm=[0, 2, 1, 3])
+            KV += tf.gather(U, ind_K_Di, axis=2, batch_dims=2)
+        return (KV + tf.expand_dims(D_big + self.add_diag, -1) * V) * mask + V * (1 - mask)
+
+    def cg_posterior_draws(self, Sigma_prior, Ti_big, ind_K_Di, D_big, obs_mask, K_D__K_XT, Yi, Xi, grid_mask,
+                           epsilon):
+        # matrix free posterior: Sigma_prior is only used through matvecs (dense, or prior_matmul if Sigma_prior is
+        # None) and solved with preconditioned CG, the posterior covariance is never formed, its square root is
+        # applied with Lanczos
+        batch = tf.shape(Xi)[0]
+        X_max = tf.shape(Xi)[1]
+        distance = abs_distance(Xi, Xi)
+        K_Xis = [OU_kernel(length, distance=distance) for length in self.lengths]
+        grid_mask = tf.reshape(grid_mask, (batch, 1, X_max, 1))
+
+        def prior_matvec(V):
+            # (K_D x_kroneker K_X) vec(V) = vec(K_D V K_X^T), V = batch x n_feat x X x k
+            V = tf.reshape(V, (batch, self.n_features, X_max, -1))
+            masked_V = V * grid_mask
+            KV = tf.add_n([self.K_D_matmul(c, tf.einsum('bxy,bgyk->bgxk', K_Xi, masked_V))
+                           for c, K_Xi in enumerate(K_Xis)])
+            KV = KV * grid_mask + V * (1 - grid_mask)
+            return tf.reshape(KV, (batch, self.n_features * X_max, -1))
+
+        if Sigma_prior is None:
+            def Sigma_matmul(V):
+                return self.prior_matmul(Ti_big, ind_K_Di, D_big, obs_mask, V)
+        else:
+            def Sigma_matmul(V):
+                return tf.matmul(Sigma_prior, V)
+
+        prior_var = tf.gather(tf.add_n([tf.linalg.diag_part(K_D) for K_D in self.K_Ds]), ind_K_Di)
+        diag_prior = tf.expand_dims((prior_var + D_big + self.add_diag) * obs_mask + 1 - obs_mask, -1)
+
+        def solve_prior(R):
+            return batch_cg(Sigma_matmul,
+                            R,
+                            precond=lambda V: V / diag_prior,
+                            max_iter=self.cg_max_iter,
+                            tol=self.cg_tol)
+
+        def posterior_matvec(V):
+            return prior_matvec(V) - tf.matmul(K_D__K_XT, solve_prior(tf.matmul(K_D__K_XT, V, transpose_a=True))) \
+                   + self.add_diag * V
+
+        Mu = tf.matmul(K_D__K_XT, solve_prior(Yi))
+        return lanczos_sample(posterior_matvec, epsilon, n_iter=self.n_lanczos) + Mu
+
+    def K_D_matmul(self, c, V):
+        # K_D_c V along the feature axis of V = batch x n_feat x ...
+        # with K_D = W W^T + diag: W (W^T V) + diag V, n_feat x rank instead of n_feat^2 per column
+        if self.K_D_factors is None:
+            return tf.einsum('fg,bg...->bf...', self.K_Ds[c], V)
+        W, diag = self.K_D_factors[c]
+        return tf.einsum('fr,br...->bf...', W, tf.einsum('gr,bg...->br...', W, V)) \
+               + tf.reshape(diag, [1, -1] + [1] * (len(V.shape) - 2)) * V
 
-        # draws = [x_i] * n_feat, n_mc_samples
-        shaped_draws = tf.transpose(tf.reshape(draws, (self.n_features, X_len, self.n_mc_samples)), perm=[2, 1, 0])
-        # shaped_draws = n_mc_samples, X, n_feat
-        return shaped_draws
+    def pathwise_posterior_draws(self, Sigma_prior, K_D__K_XT, Yi, Ti_big, ind_K_Di, D_big, obs_mask, Xi, grid_mask,
+                                 L=None):
+        # Matheron's rule: f_X + K_D__K_XT Sigma_prior^-1 (Y - f_T - noise), with (f_X, f_T) a joint prior draw
+        # the prior draw only needs the feature factors K_D_half and the closed form OU factors over time,
+        # so the posterior covariance over the grid is never built nor factorised
+        batch = tf.shape(Xi)[0]
+        X_max = tf.shape(Xi)[1]
+        # joint prior draw over grid times followed by observation times
+        times = tf.concat([Xi, Ti_big], 1)
+        mask = tf.concat([grid_mask, obs_mask], 1)
+        f = 0
+        for K_D_half, length in [(self.K_D_v_half, self.length_v), (self.K_D_l_half, self.length_l)]:
+            epsilon = self.standard_normal((batch, tf.shape(times)[1], self.n_features, self.n_mc_samples))
+            # (K_D_half x_kroneker K_T_half) epsilon
+            f += tf.einsum('df,bufs->buds', K_D_half,
+                           tf.einsum('buv,bvfs->bufs', OU_sqrt(length, times, mask), epsilon))
+        # f = batch x time x n_feat x n_mc_samples
+        f_X = tf.reshape(tf.transpose(f[:, :X_max], perm=[0, 2, 1, 3]), (batch, self.n_features * X_max, -1))
+        f_T = tf.gather(f[:, X_max:], ind_K_Di, axis=2, batch_dims=2)
+        noise = self.standard_normal(tf.shape(f_T)) * tf.expand_dims(tf.sqrt(D_big + self.add_diag), -1)
+
+        if L is None:
+            L, num_tries = self.try_cholesky(Sigma_prior)
+        residuals = (Yi - f_T - noise) * tf.expand_dims(obs_mask, -1)
+        return f_X + tf.matmul(K_D__K_XT, tf.linalg.cholesky_solve(L, residuals))
+
+    def on_grid(self, Ti_big, obs_mask, Xi, grid_mask, tol=1e-3):
+        # True if all observation and grid times of the batch are whole hours
+        return tf.logical_and(tf.reduce_all(tf.abs(Ti_big - tf.round(Ti_big)) * obs_mask < tol),
+                              tf.reduce_all(tf.abs(Xi - tf.round(Xi)) * grid_mask < tol))
+
+    def grid_posterior_draws(self, Yi, Ti_big, ind_K_Di, obs_mask, Xi, grid_mask):
+        # structured backend for times on the hourly grid: the latent values live on the cells (feature, hour) of a
+        # grid covering the observations and Xi, whose prior covariance sum_c K_D_c x_kroneker K_X_c has Toeplitz
+        # K_X_c (see OU_grid_matmul), the observations pick (and average) cells of this grid
+        # Matheron's rule: f + K M (M K M + N)^-1 (Y - f - noise), M the observed cells, solved with CG,
+        # every iteration costs O(n_feat n_hours log n_hours + n_feat^2 n_hours)
+        batch = tf.shape(Ti_big)[0]
+        n_cells = batch * self.n_features
+        # origin and length of the grid of each patient, the batch is padded to the longest one
+        inf = np.inf * tf.ones_like(Ti_big)
+        t_min = tf.minimum(tf.reduce_min(tf.where(obs_mask > 0, Ti_big, inf), 1),
+                           tf.reduce_min(tf.where(grid_mask > 0, Xi, np.inf * tf.ones_like(Xi)), 1))
+        t_max = tf.maximum(tf.reduce_max(tf.where(obs_mask > 0, Ti_big, -inf), 1),
+                           tf.reduce_max(tf.where(grid_mask > 0, Xi, -np.inf * tf.ones_like(Xi)), 1))
+        origin = tf.where(tf.math.is_finite(t_min), tf.round(t_min), tf.zeros_like(t_min))
+        t_max = tf.where(tf.math.is_finite(t_max), tf.round(t_max), origin)
+        G = tf.cast(tf.reduce_max(t_max - origin), tf.int32) + 1
+
+        # observations averaged per cell, cells = batch x n_feat x G
+        hour = tf.cast(tf.round(Ti_big - tf.expand_dims(origin, -1)), tf.int32)
+        cell = (tf.expand_dims(tf.range(batch), -1) * self.n_features + ind_K_Di) * G + hour
+        cell = tf.where(obs_mask > 0, cell, n_cells * G * tf.ones_like(cell))
+        counts = tf.reshape(tf.math.unsorted_segment_sum(obs_mask, cell, n_cells * G + 1)[:-1],
+                            (batch, self.n_features, G))
+        Y_cells = tf.math.divide_no_nan(tf.reshape(tf.math.unsorted_segment_sum(Yi, cell, n_cells * G + 1)[:-1],
+                                                   (batch, self.n_features, G)), counts)
+        observed = tf.cast(counts > 0, tf.float32)
+        noise = tf.reshape(tf.linalg.diag_part(self.D) + self.add_diag, (1, -1, 1))
+        # noise of the cell averages, unobserved (and padded) cells are decoupled with an identity block
+        noise = tf.math.divide_no_nan(noise, counts) * observed + (1 - observed)
+        prior_var = tf.reshape(tf.add_n([tf.linalg.diag_part(K_D) for K_D in self.K_Ds]), (1, -1, 1))
+
+        def prior_matvec(V):
+            # V = batch x n_feat x G x k
+            V = tf.transpose(V, perm=[0, 1, 3, 2])
+            KV = tf.add_n([self.K_D_matmul(c, OU_grid_matmul(length, V)) for c, length in enumerate(self.lengths)])
+            return tf.transpose(KV, perm=[0, 1, 3, 2])
+
+        def system_matvec(V):
+            V = tf.reshape(V, (batch, self.n_features, G, -1))
+            AV = prior_matvec(V * tf.expand_dims(observed, -1)) * tf.expand_dims(observed, -1) \
+                 + V * tf.expand_dims(noise, -1)
+            return tf.reshape(AV, (batch, self.n_features * G, -1))
+
+        diag_system = tf.reshape(prior_var * observed + noise, (batch, self.n_features * G, 1))
+
+        # joint prior draw over the grid cells
+        f = 0
+        for K_D_half, length in [(self.K_D_v_half, self.length_v), (self.K_D_l_half, self.length_l)]:
+            # MC samples on the last axis of the noise (see standard_normal), the grid on the last axis of the FFT
+            epsilon = tf.transpose(self.standard_normal((batch, self.n_features, G, self.n_mc_samples)),
+                                   perm=[0, 1, 3, 2])
+            f += tf.einsum('df,bfsg->bdsg', K_D_half, OU_grid_matmul(length, epsilon, sqrt=True))
+        # f = batch x n_feat x G x n_mc_samples
+        f = tf.transpose(f, perm=[0, 1, 3, 2])
+        epsilon = self.standard_normal((batch, self.n_features, G, self.n_mc_samples))
+        residuals = (tf.expand_dims(Y_cells, -1) - f - epsilon * tf.expand_dims(tf.sqrt(noise), -1)) \
+                    * tf.expand_dims(observed, -1)
+        alpha = batch_cg(system_matvec,
+                         tf.reshape(residuals, (batch, self.n_features * G, self.n_mc_samples)),
+                         precond=lambda R: R / diag_system,
+                         max_iter=self.cg_max_iter,
+                         tol=self.cg_tol)
+        alpha = tf.reshape(alpha, (batch, self.n_features, G, self.n_mc_samples)) * tf.expand_dims(observed, -1)
+        draws = f + prior_matvec(alpha)
+
+        # read out at the grid times
+        positions = tf.clip_by_value(tf.cast(tf.round(Xi - tf.expand_dims(origin, -1)), tf.int32), 0, G - 1)
+        draws = tf.gather(draws, positions, axis=2, batch_dims=1) * tf.reshape(grid_mask, (batch, 1, -1, 1))
+        # shaped_draws = batch x n_mc_samples x X x n_feat
+        return tf.transpose(draws, perm=[0, 3, 2, 1])
+
+    def kalman_posterior_draws(self, Yi, Ti_big, ind_K_Di, obs_mask, Xi, grid_mask):
+        # state space backend: observations and grid times are merged into one sequence of events sorted by time,
+        # the smoothed draws of the state are read out at the grid times
+        batch = tf.shape(Xi)[0]
+        n_obs = tf.shape(Ti_big)[1]
+        X_max = tf.shape(Xi)[1]
+        times = tf.concat([Ti_big, Xi], 1)
+        valid = tf.concat([obs_mask, grid_mask], 1)
+        is_obs = tf.concat([obs_mask, tf.zeros_like(grid_mask)], 1)
+        ind_obs = tf.concat([ind_K_Di, tf.zeros((batch, X_max), dtype=tf.int32)], 1)
+        Y = tf.concat([Yi, tf.zeros_like(Xi)], 1)
+
+        # padding events go last, at the last valid time, and never update the state
+        order = tf.argsort(tf.where(valid > 0, times, np.inf * tf.ones_like(times)), stable=True)
+        times, valid, is_obs, ind_obs, Y = [tf.gather(v, order, batch_dims=1) for v in [times, valid, is_obs, ind_obs, Y]]
+        last_time = tf.reduce_max(tf.where(valid > 0, times, -np.inf * tf.ones_like(times)), 1, keepdims=True)
+        last_time = tf.where(tf.math.is_finite(last_time), last_time, tf.zeros_like(last_time))
+        times = tf.where(valid > 0, times, last_time * tf.ones_like(times))
+        dt_zero = tf.concat([tf.zeros((batch, 1), dtype=tf.bool), tf.equal(times[:, 1:], times[:, :-1])], 1)
+        noise = tf.gather(tf.linalg.diag_part(self.D), ind_obs) + self.add_diag
+
+        H = tf.concat([self.K_D_v_half, self.K_D_l_half], 1)
+        draws = kalman_smoother_draws(H=H,
+                                      lengths=[self.length_v, self.length_l],
+                                      times=times,
+                                      dt_zero=dt_zero,
+                                      is_obs=is_obs,
+                                      ind_obs=ind_obs,
+                                      Y=Y,
+                                      noise=noise,
+                                      n_mc_samples=self.n_mc_samples,
+                                      random_normal=self.standard_normal)
+        # position of every grid time in the sorted sequence of events
+        grid_events = tf.gather(tf.argsort(order), n_obs + tf.range(X_max), axis=1)
+        draws = tf.gather(draws, grid_events, batch_dims=1)
+        # shaped_draws = batch x n_mc_samples x X x n_feat
+        return tf.einsum('dk,bxks->bsxd', H, draws)
+
+    def standard_normal(self, shape):
+        # noise of the MC draws, MC samples on the last axis
+        self.noise_calls += 1
+        return tf.cast(standard_normal(shape, self.noise, seed=[self.noise_seed, self.noise_calls]), self.D.dtype)
 
     def try_cholesky(self, Sigma):
-        try_no = 0
-        try:
-            try_no += 1
-            chol_sigma = tf.linalg.cholesky(Sigma)
-        except:
-            t_print("Chol ill defined. New diag {}".format(self.add_diag * 11))
-            Sigma = Sigma + self.add_diag * 10 * tf.eye(tf.cast(tf.shape(Sigma)[0], tf.int32))
-            try:
-                try_no += 1
-                chol_sigma = tf.linalg.cholesky(Sigma)
-            except:
-                t_print("Chol ill defined. New diag {}".format(self.add_diag * 111))
-                Sigma = Sigma + self.add_diag * 10 * tf.eye(tf.cast(tf.shape(Sigma)[0], tf.int32))
-                try:
-                    try_no += 1
-                    chol_sigma = tf.linalg.cholesky(Sigma)
-                except:
-                    t_print("Chol ill defined. New diag {}".format(self.add_diag * 1111))
-                    Sigma = Sigma + self.add_diag * 10 * tf.eye(tf.cast(tf.shape(Sigma)[0], tf.int32))
-                    try_no += 1
-                    chol_sigma = tf.linalg.cholesky(Sigma)
-
-        return chol_sigma, try_no
+        # exception free (hence tf.function / XLA friendly) cholesky of a batch of matrices
+        # a failed factorisation shows up as NaN or a non positive diagonal in the factor,
+        # only the failed matrices are factorised again: up to max_chol_tries retries after the first factorisation
+        # (max_chol_tries + 1 factorisations, num_tries counts them), retry k < max_chol_tries factorises
+        # Sigma + add_diag 10^k I (the jitter does not accumulate over the retries)
+        # the last retry uses a jitter making the matrix strictly diagonally dominant (PD):
+        # one ill-conditioned patient cannot stall the whole batch
+        # (the original schedule was 3 retries adding 10 add_diag I each time, and a raised exception after them)
+        # the jitter is a constant: the gradient is the one of the final factor (never the one of a failed factor)
+        batch = tf.shape(Sigma)[0]
+        I = tf.eye(tf.shape(Sigma)[-1], dtype=Sigma.dtype)
+        # jitter guaranteeing diagonal dominance: min_i (Sigma_ii - sum_j!=i |Sigma_ij|) >= add_diag * 10^max_tries
+        diag = tf.linalg.diag_part(tf.stop_gradient(Sigma))
+        off_diag = tf.reduce_sum(tf.abs(tf.stop_gradient(Sigma)), -1) - tf.abs(diag)
+        gershgorin = tf.nn.relu(tf.reduce_max(off_diag - diag, -1)) + self.add_diag * 10 ** self.max_chol_tries
+
+        @tf.custom_gradient
+        def cholesky(Sigma):
+            # detached: the failed tries are not recorded on the tape
+            Sigma = tf.stop_gradient(Sigma)
+            chol_sigma = safe_cholesky(Sigma)
+            num_tries = tf.ones([batch], tf.int32)
+            jitter = tf.zeros([batch], Sigma.dtype)
+            for try_no in range(1, self.max_chol_tries + 1):
+                if try_no < self.max_chol_tries:
+                    new_jitter = self.add_diag * 10 ** try_no * tf.ones([batch], Sigma.dtype)
+                else:
+                    new_jitter = gershgorin
+
+                def refactor(chol_sigma=chol_sigma, num_tries=num_tries, jitter=jitter, new_jitter=new_jitter):
+                    failed = cholesky_failed(chol_sigma)
+                    if self.static_shapes:
+                        # whole batch again, failed matrices only are replaced
+                        failed_jitter = tf.where(failed, new_jitter, jitter)
+                        new_chol = safe_cholesky(Sigma + tf.reshape(failed_jitter, (-1, 1, 1)) * I)
+                        return (tf.where(tf.reshape(failed, (-1, 1, 1)), new_chol, chol_sigma),
+                                num_tries + tf.cast(failed, tf.int32),
+                                failed_jitter)
+                    failed = tf.where(failed)
+                    failed_jitter = tf.gather_nd(new_jitter, failed)
+                    Sigma_failed = tf.gather_nd(Sigma, failed) + tf.reshape(failed_jitter, (-1, 1, 1)) * I
+                    return (tf.tensor_scatter_nd_update(chol_sigma, failed, safe_cholesky(Sigma_failed)),
+                            tf.tensor_scatter_nd_add(num_tries, failed, tf.ones_like(failed[:, 0], tf.int32)),
+                            tf.tensor_scatter_nd_update(jitter, failed, failed_jitter))
+
+                chol_sigma, num_tries, jitter = tf.cond(tf.reduce_any(cholesky_failed(chol_sigma)),
+                                                        refactor,
+                                                        lambda: (chol_sigma, num_tries, jitter))
+            self.chol_telemetry.append((self.current_patients, num_tries, jitter))
+
+            def grad(d_chol_sigma):
+                return cholesky_grad(chol_sigma, d_chol_sigma)
+
+            return chol_sigma, grad
+
+        chol_sigma = cholesky(Sigma)
+        return chol_sigma, self.chol_telemetry[-1][1]
+
+    def chol_metrics(self):
+        # telemetry of the cholesky retries of the last call, per patient (max over the factorisations of a patient)
+        # tries > max_chol_tries: the diagonal dominance fallback was needed
+        if len(self.chol_telemetry) == 0:
+            return {}
+        patients = tf.concat([t[0] for t in self.chol_telemetry], 0)
+        n_patients = tf.reduce_max(patients) + 1
+        tries = tf.math.unsorted_segment_max(tf.concat([t[1] for t in self.chol_telemetry], 0), patients, n_patients)
+        jitter = tf.math.unsorted_segment_max(tf.concat([t[2] for t in self.chol_telemetry], 0), patients, n_patients)
+        return {"chol_tries": tries,
+                "chol_jitter": jitter,
+                "chol_retries": tf.reduce_sum(tf.maximum(tries - 1, 0)),
+                "chol_patients_retried": tf.reduce_sum(tf.cast(tries > 1, tf.int32)),
+                "chol_patients_failed": tf.reduce_sum(tf.cast(tries > self.max_chol_tries, tf.int32)),
+                "chol_max_jitter": tf.reduce_max(jitter)}
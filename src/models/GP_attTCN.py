@@ -7,10 +7,11 @@ cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
 sys.path.append(head)
 from src.models.GP import MultiKernelMGPLayer
+from src.models.GP_sparse import SparseMultiKernelMGPLayer
 from src.models.attTCN import AttTCN
 
 
-class GPattTCN:
+class GPattTCN(tf.keras.Model):
     def __init__(self,
                  time_window,
                  n_mc_samples,
@@ -32,22 +33,50 @@ class GPattTCN:
                  kernel_size=2,
                  stride=1,
                  sigmoid_beta=False,
-                 moor_data=False
+                 moor_data=False,
+                 K_D_rank=None,
+                 noise='mc',
+                 gp_dtype='float32',
+                 tcn_dtype=None,
+                 static_pathway=True,
+                 pre_gathered=False,
+                 feature_groups=None,
+                 n_inducing=10,
+                 static_shapes=False
                  ):
+        # precision policy: gp_dtype for the GP covariances and factorisations (e.g. 'float64'),
+        # tcn_dtype keras dtype policy of the attTCN (e.g. 'mixed_bfloat16')
+        # static_pathway: the static features enter the attTCN once per patient (see call_attTCN)
+        # pre_gathered: inputs from DataGenerator(precompute_geometry=True)
+        # feature_groups: block diagonal K_D of the GP, e.g. 'vitals_labs' (see MultiKernelMGPLayer)
+        # method_name 'fitc': inducing point GP (SparseMultiKernelMGPLayer) with n_inducing points per feature
+        # static_shapes: GP without dynamic shapes, for Trainer(jit_compile=True)
+        super(GPattTCN, self).__init__()
         # a few variables to be used later
         self.tw = time_window
         self.s_feat = n_stat_features
         self.samp = n_mc_samples
+        self.static_pathway = static_pathway
 
         # the model
-        self.GP = MultiKernelMGPLayer(time_window=time_window,
-                                      n_mc_samples=n_mc_samples,
-                                      n_features=n_features,
-                                      log_noise_mean=log_noise_mean,
-                                      log_noise_std=log_noise_std,
-                                      method_name=method_name,
-                                      add_diag=add_diag,
-                                      save_path=save_path)
+        GP_layer, GP_kwargs = MultiKernelMGPLayer, {}
+        if method_name == 'fitc':
+            GP_layer, GP_kwargs = SparseMultiKernelMGPLayer, {'n_inducing': n_inducing}
+        self.GP = GP_layer(time_window=time_window,
+                           n_mc_samples=n_mc_samples,
+                           n_features=n_features,
+                           log_noise_mean=log_noise_mean,
+                           log_noise_std=log_noise_std,
+                           method_name=method_name,
+                           add_diag=add_diag,
+                           save_path=save_path,
+                           K_D_rank=K_D_rank,
+                           noise=noise,
+                           gp_dtype=gp_dtype,
+                           pre_gathered=pre_gathered,
+                           feature_groups=feature_groups,
+                           static_shapes=static_shapes,
+                           **GP_kwargs)
 
         self.attTCN = AttTCN(time_window,
                              n_features + n_stat_features,
@@ -56,36 +85,118 @@ class GPattTCN:
                              L2reg,
                              kernel_size=kernel_size,
                              stride=stride,
-                             sigmoid_beta=sigmoid_beta
+                             sigmoid_beta=sigmoid_beta,
+                             dtype=tcn_dtype
                              )
 
-        self.trainable_variables = self.GP.trainable_variables + \
-                                   self.attTCN.trainable_variables
-        self.n_GP_var = len(self.GP.trainable_variables)
+        # frozen GP: draws from a PosteriorCache, inputs = [ids, horizons, static] (see freeze_GP)
+        self.cache = None
 
-    def __call__(self, inputs):
-        self.GP_out = self.GP(inputs[:-1])
-        stat_matching_shape = \
-            tf.concat([  # step III: concatenate all patients i
-                # step II: tile patient info for each MC sample
-                tf.tile(
+    def call(self, inputs):
+        if self.cache is not None:
+            self.GP_out = self.cache.sample(inputs[0], inputs[1], self.samp)
+        else:
+            self.GP_out = self.GP(inputs[:-1])
+        return self.call_attTCN(self.GP_out, inputs[-1])
 
-                    # step I: for pat i, repeat feat data for each time step
-                    tf.concat([tf.reshape(inputs[-1][i], [1, 1, self.s_feat]) for _ in range(self.tw)], axis=1)
-                    , [self.samp, 1, 1])
-                for i in range(inputs[-1].shape[0])], axis=0)
+    def call_attTCN(self, GP_out, static):
+        """
+        attTCN on the GP draws and the static features of the patients
+        :param GP_out: patient * MC sample x time x n_feat
+        :param static: patient x n_stat
+        static_pathway: the static features are not repeated for every MC sample and time step, their contribution
+        to the TCNs is computed once per patient (AttTCN static), otherwise they are broadcast and concatenated
+        to GP_out
+        """
+        if self.static_pathway:
+            return self.attTCN(GP_out, static=static)
+        stat = tf.repeat(static, tf.shape(GP_out)[0] // tf.shape(static)[0], axis=0)
+        stat_matching_shape = tf.broadcast_to(tf.expand_dims(stat, 1), [tf.shape(GP_out)[0], self.tw, self.s_feat])
+        return self.attTCN(tf.concat([GP_out, stat_matching_shape], -1))
 
-        self.TCN_input = tf.concat([self.GP_out, stat_matching_shape], -1)
+    def call_horizons(self, inputs, num_obs_h, num_grid_h):
+        # all prediction horizons of each stay, one GP factorisation per stay (see MultiKernelMGPLayer.call_horizons)
+        # output = patient x horizon x MC sample
+        self.GP_out = self.GP.call_horizons(inputs[:-1], num_obs_h, num_grid_h)
+        return self.call_attTCN(self.GP_out, tf.repeat(inputs[-1], num_obs_h.shape[1], axis=0))
 
-        return self.attTCN(self.TCN_input)
+    def predict_moments(self, inputs, n_samples=0, var_threshold=None):
+        """
+        deterministic inference: the TCN runs once per patient on the posterior mean of the GP (no MC replication)
+        patients whose average marginal posterior variance exceeds var_threshold are scored again with n_samples
+        GP draws, and get the average of the MC logits
+        :return: logits = patient x 2, average marginal posterior variance over the hours of the stay = patient
+        """
+        GP_mean, GP_var = self.GP(inputs[:-1], moments=True)
+        logits = self.call_attTCN(GP_mean, inputs[-1])
+        # average over the grid hours of the stay only (the last time_window hours, short stays are left padded)
+        n_hours = tf.cast(tf.minimum(tf.reshape(inputs[6], [-1]), self.tw), GP_var.dtype)
+        uncertainty = tf.reduce_sum(GP_var, axis=[1, 2]) / (n_hours * tf.cast(tf.shape(GP_var)[-1], GP_var.dtype))
+
+        if n_samples > 0 and var_threshold is not None:
+            uncertain = tf.where(uncertainty > var_threshold)[:, 0]
+            if tf.size(uncertain) > 0:
+                n_mc_samples = self.GP.n_mc_samples
+                self.GP.n_mc_samples = n_samples
+                try:
+                    GP_out = self.GP([tf.gather(x, uncertain) for x in inputs[:-1]])
+                finally:
+                    self.GP.n_mc_samples = n_mc_samples
+                MC_logits = self.call_attTCN(GP_out, tf.gather(inputs[-1], uncertain))
+                MC_logits = tf.reduce_mean(tf.reshape(MC_logits, (-1, n_samples, MC_logits.shape[-1])), 1)
+                logits = tf.tensor_scatter_nd_update(logits, tf.expand_dims(uncertain, -1), MC_logits)
+
+        return logits, uncertainty
+
+    def predict_adaptive(self, inputs, chunk_size=4, max_samples=20, tol=0.02, threshold=0.5, z=3.):
+        """
+        inference with a per patient number of MC samples: GP draws are added chunk_size at a time, and a patient
+        stops once the standard error of its running estimate of P(sepsis) is below tol, or once the estimate is
+        more than z standard errors away from the alert threshold (clearly low / high risk)
+        :return: P(sepsis) = patient, number of MC samples used = patient
+        """
+        batch = inputs[-1].shape[0]
+        p_sum = np.zeros(batch)
+        p_sq_sum = np.zeros(batch)
+        n_samples = np.zeros(batch, dtype=int)
+        active = np.arange(batch)
+        n_mc_samples, noise_seed = self.GP.n_mc_samples, self.GP.noise_seed
+        self.GP.n_mc_samples = chunk_size
+        try:
+            while len(active) > 0:
+                # new common random numbers for every chunk (noise='crn')
+                self.GP.noise_seed = noise_seed + int(n_samples.max())
+                GP_out = self.GP([tf.gather(x, active) for x in inputs[:-1]])
+                logits = self.call_attTCN(GP_out, tf.gather(inputs[-1], active))
+                # P(sepsis) is the first column (y_star = [labels, 1 - labels], see GP_loss)
+                p = tf.nn.softmax(logits)[:, 0].numpy().reshape(len(active), chunk_size)
+
+                p_sum[active] += p.sum(1)
+                p_sq_sum[active] += np.square(p).sum(1)
+                n_samples[active] += chunk_size
+                mean = p_sum[active] / n_samples[active]
+                std_err = np.sqrt(np.maximum(p_sq_sum[active] / n_samples[active] - np.square(mean), 0)
+                                  / n_samples[active])
+                done = (std_err < tol) | (np.abs(mean - threshold) > z * std_err) \
+                       | (n_samples[active] + chunk_size > max_samples)
+                active = active[~done]
+        finally:
+            self.GP.n_mc_samples, self.GP.noise_seed = n_mc_samples, noise_seed
+        return p_sum / n_samples, n_samples
+
+    def freeze_GP(self, cache):
+        """
+        second training stage: the GP is no longer trained, its posteriors are read from cache (PosteriorCache)
+        only the attTCN is trained, the model is then called with inputs = [ids, horizons, static]
+        """
+        self.cache = cache
+        self.GP.trainable = False
 
     def get_weights(self):
-        self.trainable_variables = self.GP.trainable_variables + \
-                                   self.attTCN.trainable_variables
-        return self.trainable_variables
+        # GP then attTCN, also once the GP is frozen (keras lists non trainable weights last)
+        return self.GP.get_weights() + self.attTCN.get_weights()
 
     def set_weights(self, weights):
-        if not isinstance(weights[0], np.ndarray):
-            weights = [weights[i].numpy() for i in range(len(weights))]
-        self.GP.set_weights(weights[:self.n_GP_var])
-        self.attTCN.set_weights(weights[self.n_GP_var:])
+        n_GP_var = len(self.GP.weights)
+        self.GP.set_weights(weights[:n_GP_var])
+        self.attTCN.set_weights(weights[n_GP_var:])
@@ -1,7 +1,6 @@
 import os
 import sys
 import tensorflow as tf
-import numpy as np
 # appending head path
 cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
@@ -32,7 +31,12 @@ class GPattTCN_alpha(GPattTCN):
                  kernel_size=2,
                  stride=1,
                  sigmoid_beta=False,
-                 moor_data=False
+                 moor_data=False,
+                 K_D_rank=None,
+                 noise='mc',
+                 gp_dtype='float32',
+                 tcn_dtype=None,
+                 static_pathway=True
                  ):
         super().__init__(time_window,
                          n_mc_samples,
@@ -54,7 +58,12 @@ class GPattTCN_alpha(GPattTCN):
                          kernel_size,
                          stride,
                          sigmoid_beta,
-                         moor_data)
+                         moor_data,
+                         K_D_rank,
+                         noise,
+                         gp_dtype,
+                         tcn_dtype,
+                         static_pathway)
         self.attTCN = AttTCN_alpha(time_window,
                              n_features + n_stat_features,
                              num_layers,
@@ -62,11 +71,9 @@ class GPattTCN_alpha(GPattTCN):
                              L2reg,
                              kernel_size=kernel_size,
                              stride=stride,
+                             dtype=tcn_dtype
                              )
 
-        self.trainable_variables = self.GP.trainable_variables + \
-                                   self.attTCN.trainable_variables
-
 
 class GPattTCN_beta(GPattTCN):
     def __init__(self,
@@ -90,7 +97,12 @@ class GPattTCN_beta(GPattTCN):
                  kernel_size=2,
                  stride=1,
                  sigmoid_beta=False,
-                 moor_data=False
+                 moor_data=False,
+                 K_D_rank=None,
+                 noise='mc',
+                 gp_dtype='float32',
+                 tcn_dtype=None,
+                 static_pathway=True
                  ):
         super().__init__(time_window,
                          n_mc_samples,
@@ -112,7 +124,12 @@ class GPattTCN_beta(GPattTCN):
                          kernel_size,
                          stride,
                          sigmoid_beta,
-                         moor_data)
+                         moor_data,
+                         K_D_rank,
+                         noise,
+                         gp_dtype,
+                         tcn_dtype,
+                         static_pathway)
         self.attTCN = AttTCN_beta(time_window,
                              n_features + n_stat_features,
                              num_layers,
@@ -120,8 +137,6 @@ class GPattTCN_beta(GPattTCN):
                              L2reg,
                              kernel_size=kernel_size,
                              stride=stride,
-                             sigmoid_beta=sigmoid_beta
+                             sigmoid_beta=sigmoid_beta,
+                             dtype=tcn_dtype
                              )
-
-        self.trainable_variables = self.GP.trainable_variables + \
-                                   self.attTCN.trainable_variables
\ No newline at end of file
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
+sys.path.append(head)
+from src.models.GP_utils import standard_normal
+from src.utils.debug import t_print
+
+
+class PosteriorCache:
+    """
+    on disk cache of the GP posteriors of a trained (frozen) MultiKernelMGPLayer, keyed by (icustay id, horizon)
+    for each row: posterior mean (grid_max x n_feat) and covariance ~ F F^T + diag, with F the rank leading
+    eigenvectors of the posterior covariance (scaled) and diag the remaining marginal variances (exact marginals)
+    stored as float16 .npy files, memory mapped when loaded: the TCN is trained on draws from the cache
+    without running the GP again
+    noise, noise_seed: noise of the draws, as in MultiKernelMGPLayer (see GP_utils.standard_normal)
+    """
+    def __init__(self, path, noise='mc', noise_seed=0):
+        if noise not in ['mc', 'antithetic', 'sobol', 'crn']:
+            raise NameError("noise not in ['mc', 'antithetic', 'sobol', 'crn']")
+        self.path = path
+        self.noise = noise
+        self.noise_seed = noise_seed
+        self.mean = None
+        self.factor = None
+        self.diag = None
+        self.index = {}
+
+    def build(self, GP, datasets, batch_size=64, rank=32):
+        """
+        :param GP: trained MultiKernelMGPLayer
+        :param datasets: list of data = [Y, T, ind_K_D, ind_T, len_T, X, len_X, labels, static, classes, ids, ...]
+                         (DataGenerator(debug=True) train_data, val_data, test_data)
+        :param rank: rank of the covariance factor (None: full)
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        n_rows = sum([len(data[4]) for data in datasets])
+        n_out = GP.time_window * GP.n_features
+        rank = n_out if rank is None else min(rank, n_out)
+        mean = np.lib.format.open_memmap(os.path.join(self.path, 'mean.npy'), mode='w+', dtype=np.float16,
+                                         shape=(n_rows, GP.time_window, GP.n_features))
+        factor = np.lib.format.open_memmap(os.path.join(self.path, 'factor.npy'), mode='w+', dtype=np.float16,
+                                           shape=(n_rows, n_out, rank))
+        diag = np.lib.format.open_memmap(os.path.join(self.path, 'diag.npy'), mode='w+', dtype=np.float16,
+                                         shape=(n_rows, n_out))
+        keys = np.zeros((n_rows, 2), dtype=np.int64)
+        dtypes = [tf.float32, tf.float32, tf.int32, tf.int32, tf.int32, tf.float32, tf.int32]
+
+        row = 0
+        for data in datasets:
+            t_print("PosteriorCache -- {} rows".format(len(data[4])))
+            for start in range(0, len(data[4]), batch_size):
+                inputs = [tf.convert_to_tensor(np.asarray(data[i][start: start + batch_size]), dtype=dtype)
+                          for i, dtype in enumerate(dtypes)]
+                Mu, Sigma = GP.posterior(inputs)
+                # eigenvalues in increasing order
+                eigval, eigvec = tf.linalg.eigh(Sigma)
+                F = eigvec[..., -rank:] * tf.expand_dims(tf.sqrt(tf.nn.relu(eigval[..., -rank:])), -2)
+                residual = tf.nn.relu(tf.linalg.diag_part(Sigma) - tf.reduce_sum(tf.square(F), -1))
+                end = row + Mu.shape[0]
+                mean[row: end] = Mu.numpy()
+                factor[row: end] = F.numpy()
+                diag[row: end] = residual.numpy()
+                keys[row: end, 0] = np.asarray(data[10][start: start + batch_size])
+                keys[row: end, 1] = np.asarray(data[9][start: start + batch_size])
+                row = end
+        for array in [mean, factor, diag]:
+            array.flush()
+        np.save(os.path.join(self.path, 'keys.npy'), keys)
+        return self.load()
+
+    def load(self):
+        self.mean = np.load(os.path.join(self.path, 'mean.npy'), mmap_mode='r')
+        self.factor = np.load(os.path.join(self.path, 'factor.npy'), mmap_mode='r')
+        self.diag = np.load(os.path.join(self.path, 'diag.npy'), mmap_mode='r')
+        keys = np.load(os.path.join(self.path, 'keys.npy'))
+        self.index = {(key[0], key[1]): row for row, key in enumerate(keys)}
+        return self
+
+    def rows(self, ids, horizons):
+        return np.asarray([self.index[(int(i), int(h))] for i, h in zip(ids, horizons)])
+
+    def sample(self, ids, horizons, n_mc_samples):
+        """
+        :param ids, horizons: icustay id and horizon of each patient of the batch
+        :return: draws in the format of MultiKernelMGPLayer.__call__, patient * MC sample x grid_max x n_feat
+        """
+        # sorted reads from the memory maps
+        rows = self.rows(ids, horizons)
+        order = np.argsort(rows)
+        inverse = np.argsort(order)
+        mean, factor, diag = [tf.gather(tf.convert_to_tensor(array[rows[order]], dtype=tf.float32), inverse)
+                              for array in [self.mean, self.factor, self.diag]]
+        batch, grid_max, n_feat = mean.shape
+        epsilon = standard_normal((batch, factor.shape[-1], n_mc_samples), self.noise, seed=[self.noise_seed, 1])
+        epsilon_diag = standard_normal((batch, factor.shape[1], n_mc_samples), self.noise, seed=[self.noise_seed, 2])
+        draws = tf.matmul(factor, epsilon) + tf.expand_dims(tf.sqrt(diag), -1) * epsilon_diag
+        draws = tf.reshape(tf.transpose(draws, perm=[0, 2, 1]), (batch, n_mc_samples, grid_max, n_feat))
+        return tf.reshape(draws + tf.expand_dims(mean, 1), (-1, grid_max, n_feat))
@@ -1,7 +1,6 @@
 import os
 import sys
 import tensorflow as tf
-import numpy as np
 # appending head path
 cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
@@ -10,7 +9,7 @@ from src.models.GP import MultiKernelMGPLayer
 from src.models.attTCN import AttTCN
 
 
-class GPLogReg:
+class GPLogReg(tf.keras.Model):
     def __init__(self,
                  time_window,
                  n_mc_samples,
@@ -23,6 +22,7 @@ class GPLogReg:
                  L2reg=None,
                  save_path=head,
                  ):
+        super(GPLogReg, self).__init__()
         # a few variables to be used later
         self.tw = time_window
         self.non_s_feat = n_features
@@ -45,28 +45,13 @@ class GPLogReg:
                                    kernel_regularizer=tf.keras.regularizers.L2(L2reg[0]),
                                    bias_regularizer=tf.keras.regularizers.L2(L2reg[0]),)])
 
-        self.trainable_variables = self.GP.trainable_variables + \
-                                   self.LogReg.trainable_variables
-        self.n_GP_var = len(self.GP.trainable_variables)
-
-    def __call__(self, inputs):
+    def call(self, inputs):
         self.GP_out = self.GP(inputs[:-1])
         # GP out: batch x MC samples x tw x features
         self.GP_out = tf.reshape(self.GP_out, (-1, self.samp, self.tw * self.non_s_feat))
         stat_input = tf.expand_dims(inputs[-1], axis=1)
-        stat_input = tf.broadcast_to(stat_input, [stat_input.shape[0], self.samp, stat_input.shape[-1]])
+        stat_input = tf.broadcast_to(stat_input, [tf.shape(stat_input)[0], self.samp, self.s_feat])
         self.LR_input = tf.concat([self.GP_out, stat_input], axis=-1)
         self.LR_input = tf.reshape(self.LR_input, (-1, self.tw * self.non_s_feat + self.s_feat))
 
         return self.LogReg(self.LR_input)
-
-    def get_weights(self):
-        self.trainable_variables = self.GP.trainable_variables + \
-                                   self.LogReg.trainable_variables
-        return self.trainable_variables
-
-    def set_weights(self, weights):
-        if not isinstance(weights[0], np.ndarray):
-            weights = [weights[i].numpy() for i in range(len(weights))]
-        self.GP.set_weights(weights[:self.n_GP_var])
-        self.LogReg.set_weights(weights[self.n_GP_var:])
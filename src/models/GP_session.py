@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+from scipy.linalg import cholesky, solve_triangular
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
+sys.path.append(head)
+from src.models.GP_utils import multi_kernel_covariance
+
+
+def chol_update(L, X):
+    # cholesky of L L^T + X X^T from L (rank-k update, k rank-1 updates), O(k n^2)
+    L = L.copy()
+    X = X.copy()
+    n = L.shape[0]
+    for j in range(X.shape[1]):
+        x = X[:, j]
+        for k in range(n):
+            r = np.hypot(L[k, k], x[k])
+            c = r / L[k, k]
+            s = x[k] / L[k, k]
+            L[k, k] = r
+            L[k + 1:, k] = (L[k + 1:, k] + s * x[k + 1:]) / c
+            x[k + 1:] = c * x[k + 1:] - s * L[k + 1:, k]
+    return L
+
+
+class GPSession:
+    """
+    stateful posterior of a single patient for live scoring
+    keeps the cholesky factor of Sigma_prior over the observations received so far (in order of arrival):
+    appending k observations extends it with a block update, O(k n^2) instead of O(n^3),
+    a sliding window of max_obs observations drops the oldest ones, which is a rank-k update of the remaining factor
+    the GP parameters are frozen at the creation of the session
+    """
+    def __init__(self, gp, max_obs=None):
+        if gp.method_name not in ['chol', 'pathwise']:
+            raise NameError("GPSession needs method_name in ['chol', 'pathwise']")
+        self.gp = gp
+        self.gp.variable_update()
+        self.max_obs = max_obs
+        self.Y = np.zeros(0)
+        self.T = np.zeros(0)
+        self.ind_K_D = np.zeros(0, dtype=int)
+        self.L = np.zeros((0, 0))
+
+    def covariance(self, T1, ind1, T2=None, ind2=None):
+        # prior covariance between observations (with the noise on the diagonal if square)
+        if T2 is None:
+            D = np.diag(self.gp.D.numpy())[ind1] + self.gp.add_diag
+            K = multi_kernel_covariance(self.gp.K_Ds, self.gp.lengths, tf.constant([T1], tf.float32),
+                                        tf.constant([ind1], tf.int32), diag=tf.constant([D], tf.float32))
+        else:
+            K = multi_kernel_covariance(self.gp.K_Ds, self.gp.lengths, tf.constant([T1], tf.float32),
+                                        tf.constant([ind1], tf.int32), tf.constant([T2], tf.float32),
+                                        tf.constant([ind2], tf.int32))
+        return K[0].numpy().astype(np.float64)
+
+    def append(self, Y, T, ind_K_D):
+        """
+        :param Y, T, ind_K_D: values, times and feature indices of the new observations
+        """
+        Y, T, ind_K_D = np.atleast_1d(Y), np.atleast_1d(T), np.atleast_1d(ind_K_D).astype(int)
+        n, k = len(self.T), len(T)
+        K_new = self.covariance(T, ind_K_D)
+        if n > 0:
+            # [[L, 0], [L_21, L_22]], L_21 = K_new,old L^-T, L_22 L_22^T = K_new - L_21 L_21^T
+            L_21 = solve_triangular(self.L, self.covariance(T, ind_K_D, self.T, self.ind_K_D).T, lower=True).T
+            L_22 = cholesky(K_new - L_21 @ L_21.T, lower=True)
+            self.L = np.block([[self.L, np.zeros((n, k))], [L_21, L_22]])
+        else:
+            self.L = cholesky(K_new, lower=True)
+        self.Y = np.concatenate([self.Y, Y])
+        self.T = np.concatenate([self.T, T])
+        self.ind_K_D = np.concatenate([self.ind_K_D, ind_K_D])
+        if self.max_obs is not None and len(self.T) > self.max_obs:
+            self.drop_oldest(len(self.T) - self.max_obs)
+
+    def drop_oldest(self, k):
+        # Sigma without its first k rows / columns = L_22 L_22^T + L_21 L_21^T
+        self.L = chol_update(self.L[k:, k:], self.L[k:, :k])
+        self.Y, self.T, self.ind_K_D = self.Y[k:], self.T[k:], self.ind_K_D[k:]
+
+    def draw(self, moments=False):
+        """
+        posterior draws on the last time_window hours of the hourly grid of the observations in the session
+        :return: n_mc_samples x time_window x n_feat (moments: mean, variance = time_window x n_feat each)
+        """
+        n = len(self.T)
+        X = np.arange(int(np.min(self.T)), int(np.max(self.T)) + 1)
+        Xi, X_len = self.gp.restrict_grid(tf.constant([X], tf.float32), tf.constant([len(X)], tf.int32))
+        self.gp.chol_telemetry = []
+        self.gp.noise_calls = 0
+        self.gp.current_patients = tf.constant([0])
+        draws = self.gp.draw_GP(Yi=tf.constant([self.Y], tf.float32),
+                                Ti=tf.constant([self.T], tf.float32),
+                                ind_K_Di=tf.constant([self.ind_K_D], tf.int32),
+                                ind_Ti=tf.constant([np.arange(n)], tf.int32),
+                                Xi=Xi,
+                                num_obs=tf.constant([n], tf.int32),
+                                X_len=X_len,
+                                L=tf.constant([self.L], tf.float32),
+                                moments=moments)
+        draws = self.gp.align_right(draws, X_len)[0]
+        if moments:
+            return draws[0], draws[1]
+        return draws
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import tensorflow as tf
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir))
+sys.path.append(head)
+
+
+# matrix free solvers: the operators are only accessed through batched matvecs
+# matvec(V) = A V, with V = batch x n x k (k right hand sides / starting vectors per patient)
+
+def batch_cg(matvec, rhs, precond=None, max_iter=100, tol=1e-4):
+    """
+    preconditioned conjugate gradients for a batch of SPD systems A X = rhs
+    every column is solved independently and stops updating once its relative residual is below tol
+    :param matvec: function V -> A V
+    :param rhs: batch x n x k
+    :param precond: function R -> P^-1 R, with P an approximation of A (identity if None)
+    :return: X = batch x n x k
+    """
+    if precond is None:
+        precond = lambda R: R
+    threshold = tol * tf.norm(rhs, axis=-2, keepdims=True)
+
+    def not_converged(R):
+        return tf.norm(R, axis=-2, keepdims=True) > threshold
+
+    def cond(i, X, R, P, rz):
+        return tf.logical_and(i < max_iter, tf.reduce_any(not_converged(R)))
+
+    def body(i, X, R, P, rz):
+        AP = matvec(P)
+        active = tf.cast(not_converged(R), rhs.dtype)
+        alpha = active * tf.math.divide_no_nan(rz, tf.reduce_sum(P * AP, axis=-2, keepdims=True))
+        X = X + alpha * P
+        R = R - alpha * AP
+        Z = precond(R)
+        rz_new = tf.reduce_sum(R * Z, axis=-2, keepdims=True)
+        P = Z + tf.math.divide_no_nan(rz_new, rz) * P
+        return i + 1, X, R, P, rz_new
+
+    Z = precond(rhs)
+    # (tuples, the structure of the outputs of body, as checked in eager mode with maximum_iterations)
+    loop_vars = (tf.constant(0), tf.zeros_like(rhs), rhs, Z, tf.reduce_sum(rhs * Z, axis=-2, keepdims=True))
+    # matvec and precond may lose the static sizes of rhs (e.g. its batch size), only the number of columns is kept
+    shape_invariants = (tf.TensorShape([]),) + tuple(tf.TensorShape([None] * (v.shape.rank - 1))
+                                                     .concatenate(v.shape[-1:]) for v in loop_vars[1:])
+    _, X, _, _, _ = tf.while_loop(cond, body, loop_vars=loop_vars, shape_invariants=shape_invariants,
+                                  maximum_iterations=max_iter)
+    return X
+
+
+def sqrtm_newton_schulz(A, n_iter=25):
+    # square root of a batch of small PSD matrices with coupled Newton-Schulz iterations
+    # (only matmuls, hence stable gradients even for repeated / zero eigenvalues)
+    norm = tf.sqrt(tf.reduce_sum(tf.square(A), axis=[-2, -1], keepdims=True))
+    norm = tf.maximum(norm, 1e-12)
+    I = tf.eye(tf.shape(A)[-1], batch_shape=tf.shape(A)[:-2], dtype=A.dtype)
+    Y = A / norm
+    Z = I
+    for _ in range(n_iter):
+        T = 0.5 * (3. * I - tf.matmul(Z, Y))
+        Y = tf.matmul(Y, T)
+        Z = tf.matmul(T, Z)
+    return Y * tf.sqrt(norm)
+
+
+def lanczos_sample(matvec, epsilon, n_iter=20):
+    """
+    approximates A^1/2 epsilon for every column of epsilon with n_iter Lanczos steps
+    A^1/2 epsilon ~ |epsilon| Q T^1/2 e_1, with Q, T the Lanczos basis and tridiagonal matrix of A started at epsilon
+    :param matvec: function V -> A V, A = batch of SPD matrices
+    :param epsilon: batch x n x k standard normal draws
+    :return: batch x n x k
+    """
+    eps_norm = tf.norm(epsilon, axis=-2, keepdims=True)
+    q = tf.math.divide_no_nan(epsilon, eps_norm)
+    q_prev = tf.zeros_like(q)
+    beta = tf.zeros_like(eps_norm)
+    Q, alphas, betas = [], [], []
+    for _ in range(n_iter):
+        Q.append(q)
+        w = matvec(q) - beta * q_prev
+        alpha = tf.reduce_sum(q * w, axis=-2, keepdims=True)
+        w = w - alpha * q
+        # full reorthogonalisation, the basis is small
+        for q_j in Q:
+            w = w - tf.reduce_sum(q_j * w, axis=-2, keepdims=True) * q_j
+        beta = tf.norm(w, axis=-2, keepdims=True)
+        alphas.append(alpha)
+        betas.append(beta)
+        q_prev = q
+        # an exhausted Krylov space gives q = 0, which decouples the remaining part of T
+        q = tf.math.divide_no_nan(w, beta)
+
+    # T = batch x k x n_iter x n_iter
+    alphas = tf.concat(alphas, -2)
+    betas = tf.concat(betas[:-1], -2)
+    alphas = tf.transpose(alphas, perm=[0, 2, 1])
+    betas = tf.transpose(betas, perm=[0, 2, 1])
+    T = tf.linalg.diag(alphas) + tf.linalg.diag(betas, k=1) + tf.linalg.diag(betas, k=-1)
+    sqrt_T_e1 = sqrtm_newton_schulz(T)[..., 0]
+    # Q = batch x n x k x n_iter
+    Q = tf.stack(Q, -1)
+    return tf.einsum('bnki,bki->bnk', Q, sqrt_T_e1) * eps_norm
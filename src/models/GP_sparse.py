@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tensorflow as tf
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
+sys.path.append(head)
+from src.models.GP import MultiKernelMGPLayer
+from src.models.GP_utils import multi_kernel_covariance
+
+
+class SparseMultiKernelMGPLayer(MultiKernelMGPLayer):
+    """
+    inducing point (FITC) version of MultiKernelMGPLayer, for full ICU stays (DataGenerator(max_no_dtpts=None))
+    n_inducing inducing points per feature are placed on the hourly grid of each patient, U = n_inducing x n_feat
+    the grid is the one the draws are made on, the last time_window hours of the stay (see restrict_grid): the
+    observations before it enter through their (decaying) covariance with the inducing values, and their FITC noise
+    the observations are conditionally independent given the inducing values (FITC prior):
+        Sigma_prior ~ Q_TT + diag(K_TT - Q_TT) + D, Q_TT = K_TU K_UU^-1 K_UT
+    hence the per patient cost is O(n_obs U^2) and the memory linear in n_obs
+    the draws on the grid use the conditional independence as well (diag(K_XX - Q_XX))
+    """
+    def __init__(self, time_window, n_mc_samples, n_features, n_inducing=10, **kwargs):
+        if kwargs.pop('method_name', 'fitc') != 'fitc':
+            raise NameError("SparseMultiKernelMGPLayer only draws with method_name 'fitc'")
+        super(SparseMultiKernelMGPLayer, self).__init__(time_window, n_mc_samples, n_features, **kwargs)
+        self.n_inducing = n_inducing
+        # no dense factorisation of Sigma_prior to share across horizons (see call_horizons)
+        self.method_name = 'fitc'
+
+    def draw_GP(self,
+                Yi,
+                Ti,
+                ind_K_Di,
+                ind_Ti,
+                Xi,
+                num_obs,
+                X_len,
+                L=None,
+                moments=False
+                ):
+        # same inputs and outputs as MultiKernelMGPLayer.draw_GP
+        batch = tf.shape(Ti)[0]
+        X_max = tf.shape(Xi)[1]
+        Yi, Ti, Xi = [tf.cast(M, self.D.dtype) for M in [Yi, Ti, Xi]]
+        obs_mask = tf.sequence_mask(num_obs, tf.shape(Ti)[1], dtype=Ti.dtype)
+        if self.pre_gathered:
+            Ti_big = Ti
+            Yi_reordered = Yi
+        else:
+            Ti_big = tf.gather(Ti, ind_Ti, batch_dims=1)
+            if self.moor_data:
+                Yi_reordered = Yi
+            else:
+                Yi_reordered = tf.gather(Yi, ind_Ti, batch_dims=1)
+        Yi_reordered = tf.expand_dims(Yi_reordered * obs_mask, -1)
+
+        # inducing times: min(n_inducing, X_len) grid times evenly spread over the grid of each patient
+        n_u = tf.minimum(X_len, self.n_inducing)
+        step = tf.cast(X_len - 1, tf.float32) / tf.cast(tf.maximum(n_u - 1, 1), tf.float32)
+        positions = tf.cast(tf.round(tf.expand_dims(step, -1) * tf.range(self.n_inducing, dtype=tf.float32)), tf.int32)
+        positions = tf.minimum(positions, X_max - 1)
+        u_mask = tf.sequence_mask(n_u, self.n_inducing, dtype=Ti.dtype)
+        ind_K_D_u = tf.repeat(tf.range(self.n_features), self.n_inducing)
+        ind_K_U = tf.tile(tf.range(self.n_inducing), [self.n_features])
+        U_big = tf.gather(tf.gather(Xi, positions, batch_dims=1), ind_K_U, axis=1)
+        u_mask_big = tf.gather(u_mask, ind_K_U, axis=1)
+
+        # grid
+        grid_mask = tf.sequence_mask(X_len, X_max, dtype=Ti.dtype)
+        ind_K_D_l = tf.repeat(tf.range(self.n_features), X_max)
+        ind_K_Xi = tf.tile(tf.range(X_max), [self.n_features])
+        grid_mask_big = tf.gather(grid_mask, ind_K_Xi, axis=1)
+        Xi_big = tf.gather(Xi, ind_K_Xi, axis=1)
+
+        # prior covariances, never over observation x observation
+        prior_var = tf.add_n([tf.linalg.diag_part(K_D) for K_D in self.K_Ds])
+        K_UU = multi_kernel_covariance(self.K_Ds, self.lengths, U_big, ind_K_D_u, mask1=u_mask_big,
+                                       diag=self.add_diag * tf.ones_like(U_big))
+        K_UT = multi_kernel_covariance(self.K_Ds, self.lengths, U_big, ind_K_D_u, Ti_big, ind_K_Di,
+                                       mask1=u_mask_big, mask2=obs_mask)
+        K_UX = multi_kernel_covariance(self.K_Ds, self.lengths, U_big, ind_K_D_u, Xi_big, ind_K_D_l,
+                                       mask1=u_mask_big, mask2=grid_mask_big)
+        L_UU, num_tries = self.try_cholesky(K_UU)
+        A = tf.linalg.triangular_solve(L_UU, K_UT)  # K_UU^-1/2 K_UT
+        C = tf.linalg.triangular_solve(L_UU, K_UX)  # K_UU^-1/2 K_UX
+
+        # FITC noise: diag(K_TT - Q_TT) + D, padded observations get 1 (and no coupling to U)
+        D_big = tf.gather(tf.linalg.diag_part(self.D), ind_K_Di)
+        Lambda = tf.nn.relu(tf.gather(prior_var, ind_K_Di) - tf.reduce_sum(tf.square(A), -2)) + D_big + self.add_diag
+        Lambda = Lambda * obs_mask + (1 - obs_mask)
+
+        # posterior of the whitened inducing values v = K_UU^-1/2 f_U: N(B^-1 A Lambda^-1 Y, B^-1),
+        # B = I + A Lambda^-1 A^T
+        A_scaled = A / tf.expand_dims(Lambda, -2)
+        B = tf.eye(tf.shape(A)[1], batch_shape=[batch], dtype=A.dtype) + tf.matmul(A_scaled, A, transpose_b=True)
+        L_B, num_tries = self.try_cholesky(B)
+        v_mean = tf.linalg.cholesky_solve(L_B, tf.matmul(A_scaled, Yi_reordered))
+        # conditional variance of the grid given the inducing values
+        var_X = tf.nn.relu(tf.gather(prior_var, ind_K_D_l) - tf.reduce_sum(tf.square(C), -2)) * grid_mask_big
+
+        if moments:
+            Mu = tf.matmul(C, v_mean, transpose_a=True)
+            W = tf.linalg.triangular_solve(L_B, C)
+            if moments == 'full':
+                Sigma = tf.linalg.diag(var_X) + tf.matmul(W, W, transpose_a=True) \
+                        * tf.expand_dims(grid_mask_big, -1) * tf.expand_dims(grid_mask_big, -2)
+                return tf.cast(Mu, tf.float32), tf.cast(Sigma, tf.float32)
+            var = var_X + tf.reduce_sum(tf.square(W), -2) * grid_mask_big
+            draws = tf.concat([Mu, tf.expand_dims(var, -1)], -1)
+            draws = tf.transpose(tf.reshape(draws, (batch, self.n_features, X_max, 2)), perm=[0, 3, 2, 1])
+            return tf.cast(draws, tf.float32)
+
+        epsilon_u = self.standard_normal((batch, tf.shape(A)[1], self.n_mc_samples))
+        epsilon_x = self.standard_normal((batch, X_max * self.n_features, self.n_mc_samples))
+        v = v_mean + tf.linalg.triangular_solve(L_B, epsilon_u, adjoint=True)
+        draws = tf.matmul(C, v, transpose_a=True) + tf.expand_dims(tf.sqrt(var_X + self.add_diag), -1) * epsilon_x
+        draws = draws * tf.expand_dims(grid_mask_big, -1)
+
+        # draws = batch x [x_i] * n_feat x n_mc_samples
+        shaped_draws = tf.transpose(tf.reshape(draws, (batch, self.n_features, X_max, self.n_mc_samples)),
+                                    perm=[0, 3, 2, 1])
+        # shaped_draws = batch x n_mc_samples x X x n_feat
+        return tf.cast(shaped_draws, tf.float32)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import tensorflow as tf
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir))
+sys.path.append(head)
+
+
+# state space form of the multi-kernel OU GP
+# f(t) = K_D_v_half z_v(t) + K_D_l_half z_l(t), with z_v, z_l n_feat independent unit variance OU processes
+# hence cov(f_d(t), f_d'(t')) = K_D_v[d, d'] OU_v(t, t') + K_D_l[d, d'] OU_l(t, t')
+# the state x = [z_v, z_l] (2 n_feat) is Markov: x(t + dt) = a x(t) + sqrt(1 - a^2) e, a = exp(-dt / length)
+
+def kalman_smoother_draws(H, lengths, times, dt_zero, is_obs, ind_obs, Y, noise, n_mc_samples,
+                          random_normal=tf.random.normal):
+    """
+    posterior draws of the state at every event with the simulation smoother of Durbin & Koopman (2002):
+    x = x_plus + E[x | Y] - E[x | Y_plus], (x_plus, Y_plus) a joint draw from the prior
+    the conditional means are computed with a Kalman filter (scalar updates) and a RTS smoother,
+    whose covariance recursions are shared by the data and all prior draws
+    :param H: n_feat x 2 n_feat, observation matrix [K_D_v_half, K_D_l_half]
+    :param lengths: list of the two time scales [length_v, length_l]
+    :param times: batch x n_events, event times sorted in increasing order
+    :param dt_zero: batch x n_events, True where the event happens at the same time as the previous one
+    :param is_obs: batch x n_events, 1 for observed values, 0 for grid times and padding
+    :param ind_obs: batch x n_events, feature index of each observation
+    :param Y: batch x n_events, observed values
+    :param noise: batch x n_events, observation noise variance
+    :param random_normal: function shape -> standard normal draws (MC samples on the last axis)
+    :return: batch x n_events x 2 n_feat x n_mc_samples
+    """
+    batch = tf.shape(times)[0]
+    n_state = tf.shape(H)[1]
+    n_feat = tf.shape(H)[0]
+
+    # transition coefficients, the first event starts from the stationary distribution (a = 0)
+    dt = tf.concat([tf.fill([batch, 1], 1e6), times[:, 1:] - times[:, :-1]], 1)
+    a = tf.concat([tf.tile(tf.expand_dims(tf.exp(-dt / lengths[0]), -1), [1, 1, n_feat]),
+                   tf.tile(tf.expand_dims(tf.exp(-dt / lengths[1]), -1), [1, 1, n_feat])], -1)
+    q = 1 - tf.square(a)
+    # simultaneous events (dt = 0) have q = 0, where the gradient of the square root is infinite
+    sqrt_q = tf.where(q > 0, tf.sqrt(tf.where(q > 0, q, tf.ones_like(q))), tf.zeros_like(q))
+    h = tf.gather(H, ind_obs) * tf.expand_dims(is_obs, -1)
+
+    # time major
+    a = tf.transpose(a, perm=[1, 0, 2])
+    q = tf.transpose(q, perm=[1, 0, 2])
+    sqrt_q = tf.transpose(sqrt_q, perm=[1, 0, 2])
+    h = tf.transpose(h, perm=[1, 0, 2])
+    is_obs_t = tf.transpose(is_obs)
+    Y_t = tf.transpose(Y)
+    noise_t = tf.transpose(noise)
+    n_events = tf.shape(a)[0]
+    e_x = random_normal((n_events, batch, n_state, n_mc_samples))
+    e_y = random_normal((n_events, batch, n_mc_samples))
+
+    def filter_step(carry, elems):
+        x_plus, m, P = carry
+        a_k, q_k, sqrt_q_k, h_k, obs_k, y_k, r_k, e_x_k, e_y_k = elems
+        # predict
+        x_plus = tf.expand_dims(a_k, -1) * x_plus + tf.expand_dims(sqrt_q_k, -1) * e_x_k
+        m = tf.expand_dims(a_k, -1) * m
+        P = tf.expand_dims(a_k, -1) * P * tf.expand_dims(a_k, -2) + tf.linalg.diag(q_k)
+        # update with the observed value and with the value observed on each prior draw
+        y_plus = tf.einsum('bk,bks->bs', h_k, x_plus) + tf.expand_dims(tf.sqrt(r_k), -1) * e_y_k
+        y_all = tf.concat([tf.expand_dims(y_k, -1), y_plus], -1)
+        Ph = tf.einsum('bkl,bl->bk', P, h_k)
+        s = tf.reduce_sum(h_k * Ph, -1) + r_k
+        gain = Ph / tf.expand_dims(s, -1) * tf.expand_dims(obs_k, -1)
+        innovation = y_all - tf.einsum('bk,bks->bs', h_k, m)
+        m = m + tf.expand_dims(gain, -1) * tf.expand_dims(innovation, -2)
+        P = P - tf.expand_dims(gain, -1) * tf.expand_dims(Ph, -2)
+        return x_plus, m, P
+
+    init = (tf.zeros((batch, n_state, n_mc_samples)),
+            tf.zeros((batch, n_state, n_mc_samples + 1)),
+            tf.eye(n_state, batch_shape=[batch]))
+    x_plus, m, P = tf.scan(filter_step, (a, q, sqrt_q, h, is_obs_t, Y_t, noise_t, e_x, e_y), initializer=init)
+
+    def smoother_step(m_s_next, elems):
+        m_k, P_k, a_next, q_next, dt_zero_next = elems
+        # m_s = m + P a P_pred^-1 (m_s_next - a m)
+        P_pred = tf.expand_dims(a_next, -1) * P_k * tf.expand_dims(a_next, -2) + tf.linalg.diag(q_next)
+        # broadcast identity: keeps the static batch size of the carry, loop invariant in graph mode
+        P_pred = tf.where(tf.reshape(dt_zero_next, (-1, 1, 1)), tf.eye(n_state, dtype=P_pred.dtype), P_pred)
+        correction = tf.linalg.cholesky_solve(tf.linalg.cholesky(P_pred),
+                                              m_s_next - tf.expand_dims(a_next, -1) * m_k)
+        m_s = m_k + tf.matmul(P_k, tf.expand_dims(a_next, -1) * correction)
+        # same time as the next event: same state
+        return tf.where(tf.reshape(dt_zero_next, (-1, 1, 1)), m_s_next, m_s)
+
+    dt_zero_t = tf.transpose(dt_zero)
+    m_s = tf.scan(smoother_step, (m[:-1], P[:-1], a[1:], q[1:], dt_zero_t[1:]), initializer=m[-1], reverse=True)
+    m_s = tf.concat([m_s, m[-1:]], 0)
+
+    draws = x_plus + m_s[..., :1] - m_s[..., 1:]
+    return tf.transpose(draws, perm=[1, 0, 2, 3])
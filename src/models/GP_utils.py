@@ -13,20 +13,202 @@ sys.path.append(head)
 # reformatted from M Moor and J Futoma
 
 def kroneker_matrix(M, idx1, idx2=None): #y
+    # out[..., i, j] = M[idx1[..., i], idx2[..., j]] with two 1-D gathers (no index grid)
+    # idx1, idx2 = n or batch x n
     if idx2 is None:
         idx2 = idx1
-    grid = tf.meshgrid(idx1, idx2)
-    idx = tf.stack((grid[0], grid[1]), -1)
-    return tf.gather_nd(M, idx)
+    rows = tf.gather(M, idx1)  # [batch x] n1 x n_features
+    if idx2.shape.rank == 1:
+        return tf.gather(rows, idx2, axis=-1)
+    if idx1.shape.rank == 1:
+        # rows shared by the whole batch
+        return tf.transpose(tf.gather(rows, idx2, axis=1), perm=[1, 0, 2])
+    return tf.gather(rows, idx2, axis=2, batch_dims=1)  # batch x n1 x n2
 
 
-def OU_kernel(length, x1, x2):
-    x1 = tf.reshape(x1, [-1, 1])  # colvec
-    x2 = tf.reshape(x2, [1, -1])  # rowvec
-    K = tf.exp(-tf.abs(x1 - x2) / length)
+def abs_distance(x1, x2):
+    # works on single vectors as well as on batches of vectors (batch x n)
+    x1 = tf.expand_dims(x1, -1)  # colvec
+    x2 = tf.expand_dims(x2, -2)  # rowvec
+    return tf.abs(x1 - x2)
+
+
+def OU_kernel(length, x1=None, x2=None, distance=None):
+    # the distance matrix can be passed directly when it is shared by several kernels
+    if distance is None:
+        distance = abs_distance(x1, x2)
+    K = tf.exp(-distance / length)
     return K
 
 
+def multi_kernel_covariance(K_Ds, lengths, x1, ind1, x2=None, ind2=None, mask1=None, mask2=None, diag=None):
+    """
+    fused assembly of sum_c K_D_c[ind1, ind2] * OU_kernel(length_c, x1, x2), for any number of additive components
+    the distances are computed once and shared by all components, masking and the diagonal are applied in the same pass
+    :param K_Ds: list of n_features x n_features feature covariances, one per component
+    :param lengths: list of the matching time scales
+    :param x1: batch x n1 times of the rows
+    :param ind1: n1 or batch x n1 feature indices of the rows
+    :param x2, ind2: same for the columns, square matrix over (x1, ind1) if None
+    :param mask1, mask2: batch x n1 / n2, 0 for padding, masked rows and columns are set to 0
+    :param diag: batch x n1 added to the diagonal of the valid entries (square matrices only),
+                 masked entries get a 1 on the diagonal to keep the matrix invertible
+    :return: batch x n1 x n2
+    """
+    square = x2 is None
+    if square:
+        x2, ind2, mask2 = x1, ind1, mask1
+    distance = abs_distance(x1, x2)
+    K = 0.
+    for K_D, length in zip(K_Ds, lengths):
+        K += kroneker_matrix(K_D, ind1, ind2) * tf.exp(-distance / length)
+    if mask1 is not None:
+        K *= tf.expand_dims(mask1, -1)
+    if mask2 is not None:
+        K *= tf.expand_dims(mask2, -2)
+    if square and (diag is not None or mask1 is not None):
+        diag = tf.zeros_like(x1) if diag is None else diag
+        if mask1 is not None:
+            diag = diag * mask1 + (1 - mask1)
+        K += tf.linalg.diag(diag)
+    return K
+
+
+def OU_sqrt(length, x, mask=None):
+    # square root S of the OU kernel matrix over x (batch x n), S S^T = OU_kernel(length, x, x), without factorising:
+    # in time order the cholesky factor is L[k, j] = exp(-(t_k - t_j) / length) * sqrt(1 - exp(-2 (t_j - t_j-1) / length))
+    # masked entries are moved after the last valid time (their rows are meaningless)
+    if mask is None:
+        mask = tf.ones_like(x)
+    order = tf.argsort(tf.where(mask > 0, x, np.inf * tf.ones_like(x)), stable=True)
+    x_sorted = tf.gather(x, order, batch_dims=1)
+    mask_sorted = tf.gather(mask, order, batch_dims=1)
+    last_x = tf.reduce_max(tf.where(mask_sorted > 0, x_sorted, -np.inf * tf.ones_like(x_sorted)), -1, keepdims=True)
+    last_x = tf.where(tf.math.is_finite(last_x), last_x, tf.zeros_like(last_x))
+    x_sorted = tf.where(mask_sorted > 0, x_sorted, last_x * tf.ones_like(x_sorted))
+    dx = x_sorted[:, 1:] - x_sorted[:, :-1]
+    q = 1 - tf.exp(-2 * dx / length)
+    # repeated times have q = 0, keep the gradient of the square root finite there
+    q_pos = q > 0
+    q = tf.where(q_pos, tf.sqrt(tf.where(q_pos, q, tf.ones_like(q))), tf.zeros_like(q))
+    scale = tf.concat([tf.ones_like(x_sorted[:, :1]), q], 1)
+    L = tf.linalg.band_part(OU_kernel(length, x_sorted, x_sorted), -1, 0) * tf.expand_dims(scale, -2)
+    # back to the original order (a row permutation of L is still a square root)
+    return tf.gather(L, tf.argsort(order), axis=1, batch_dims=1)
+
+
+def OU_grid_matmul(length, V, sqrt=False):
+    # K_X V with K_X the OU kernel matrix over a regular hourly grid (the grid on the last axis of V), O(G log G):
+    # K_X is Toeplitz, K_X[i, j] = a^|i - j| with a = exp(-1 / length), applied with the FFT of a circulant embedding
+    # sqrt: L_X V instead, with L_X L_X^T = K_X the causal (AR(1)) factor L_X[i, j] = a^(i - j) w_j for j <= i,
+    # w_0 = 1, w_j = sqrt(1 - a^2), i.e. a lower triangular Toeplitz matrix up to its first column
+    G = tf.shape(V)[-1]
+    a = tf.exp(-1. / length)
+    h = tf.pow(a, tf.range(G, dtype=V.dtype))
+    if sqrt:
+        V = V * tf.concat([tf.ones([1], V.dtype), tf.sqrt(1 - tf.square(a)) * tf.ones([G - 1], V.dtype)], 0)
+        c = tf.concat([h, tf.zeros([G], V.dtype)], 0)
+    else:
+        c = tf.concat([h, tf.zeros([1], V.dtype), tf.reverse(h[1:], [0])], 0)
+    V = tf.concat([V, tf.zeros_like(V)], -1)
+    KV = tf.signal.irfft(tf.signal.rfft(V) * tf.signal.rfft(c), fft_length=[2 * G])
+    return KV[..., :G]
+
+
+def OU_matmul(length, x, V):
+    # K_X V with K_X the OU kernel matrix over times x = batch x n in increasing order, V = batch x n x ...,
+    # O(n log n) time and O(n) memory, K_X is never formed: K_X V = F + B - V with F_i = sum_j<=i a_ij V_j and
+    # B_i = sum_j>=i a_ij V_j, a_ij = exp(-|t_i - t_j| / length), each a parallel (Hillis-Steele) scan
+    # the scans only multiply by factors a_ij <= 1, hence stable for any spread of the times
+    n = tf.shape(x)[1]
+    x = tf.reshape(x, tf.concat([tf.shape(x), tf.ones([len(V.shape) - 2], tf.int32)], 0))
+
+    def scan(x, V):
+        def body(offset, S):
+            # S_i = sum over the 2 offset last j <= i of exp(-(x_i - x_j) / length) V_j
+            shifted = tf.concat([tf.zeros_like(S[:, :offset]), S[:, :n - offset]], 1)
+            x_shifted = tf.concat([tf.repeat(x[:, :1], offset, axis=1), x[:, :n - offset]], 1)
+            return offset * 2, S + tf.exp(-(x - x_shifted) / length) * shifted
+
+        _, S = tf.while_loop(lambda offset, S: offset < n, body, [tf.constant(1), V])
+        return S
+
+    backward = tf.reverse(scan(-tf.reverse(x, [1]), tf.reverse(V, [1])), [1])
+    return scan(x, V) + backward - V
+
+
+# largest dimension of tf.math.sobol_sample
+SOBOL_MAX_DIM = 21200
+
+
+def standard_normal(shape, noise='mc', seed=None):
+    """
+    standard normal noise of the MC draws, the MC samples are on the last axis of shape
+    :param noise: 'mc': independent draws
+                  'antithetic': pairs (e, -e) along the sample axis
+                  'sobol': randomised QMC, one Sobol point per sample over all the other axes (in blocks of at most
+                           SOBOL_MAX_DIM dimensions), mapped through the normal inverse cdf; every block of every call
+                           gets its own random order of the samples and random shift of every dimension, hence the
+                           blocks and the calls are independent
+                  'crn': common random numbers, the same draws for the same seed (e.g. fixed noise for evaluation)
+    :param seed: pair of integers, only used by 'crn'
+    """
+    if noise == 'mc':
+        return tf.random.normal(shape)
+    if noise == 'antithetic':
+        shape = tf.unstack(tf.convert_to_tensor(shape, dtype=tf.int32))
+        n_samples = shape[-1]
+        half = tf.random.normal(shape[:-1] + [(n_samples + 1) // 2])
+        return tf.concat([half, -half], -1)[..., :n_samples]
+    if noise == 'sobol':
+        shape = tf.convert_to_tensor(shape, dtype=tf.int32)
+        n_samples = shape[-1]
+        dim = tf.reduce_prod(shape[:-1])
+        block = tf.minimum(dim, SOBOL_MAX_DIM)
+        n_blocks = (dim + block - 1) // block
+        # the first Sobol point is 0, skipped
+        points = tf.transpose(tf.math.sobol_sample(block, n_samples, skip=1))  # block x n_samples
+        order = tf.argsort(tf.random.uniform(tf.stack([n_blocks, n_samples])), -1)
+        points = tf.transpose(tf.gather(points, order, axis=1), perm=[1, 0, 2])  # n_blocks x block x n_samples
+        shift = tf.random.uniform(tf.stack([n_blocks, block, 1]))
+        u = tf.reshape(tf.math.floormod(points + shift, 1.), tf.stack([-1, n_samples]))[:dim]
+        u = tf.clip_by_value(u, 1e-6, 1 - 1e-6)
+        return tf.reshape(tf.math.ndtri(u), shape)
+    if noise == 'crn':
+        return tf.random.stateless_normal(shape, seed=seed)
+    raise NameError("noise not in ['mc', 'antithetic', 'sobol', 'crn']")
+
+
+def safe_cholesky(A):
+    # batch of cholesky factors, NaN for the matrices that are not PD
+    # (the CPU kernel of older TF versions raises instead, in which case the batch is factorised matrix by matrix)
+    try:
+        return tf.linalg.cholesky(A)
+    except tf.errors.InvalidArgumentError:
+        factors = []
+        for k in range(A.shape[0]):
+            try:
+                factors.append(tf.linalg.cholesky(A[k]))
+            except tf.errors.InvalidArgumentError:
+                factors.append(np.nan * tf.ones_like(A[k]))
+        return tf.stack(factors)
+
+
+def cholesky_failed(L):
+    # batch of cholesky factors -> batch of booleans, True where the factorisation failed (NaN or non positive diagonal)
+    diag = tf.linalg.diag_part(L)
+    return tf.logical_or(tf.reduce_any(tf.math.is_nan(L), axis=[-2, -1]), tf.reduce_any(diag <= 0, axis=-1))
+
+
+def cholesky_grad(L, dL):
+    # gradient of A -> cholesky(A) given the factor L (same as the registered gradient of tf.linalg.cholesky)
+    L_inverse = tf.linalg.triangular_solve(L, tf.eye(tf.shape(L)[-1], batch_shape=tf.shape(L)[:-2], dtype=L.dtype))
+    middle = tf.matmul(L, dL, adjoint_a=True)
+    middle = tf.linalg.band_part(tf.linalg.set_diag(middle, 0.5 * tf.linalg.diag_part(middle)), -1, 0)
+    grad_A = tf.matmul(tf.matmul(L_inverse, middle, adjoint_a=True), L_inverse)
+    return 0.5 * (grad_A + tf.linalg.adjoint(grad_A))
+
+
 def K_vitals_initialiser(shape, partition_info=None, dtype=None):
     # initialise lengths to be 0.01 for vitals and 5 for blood tests
     output = np.ones(shape[0])
@@ -39,3 +221,17 @@ def K_labs_initialiser(shape, partition_info=None, dtype=None):
     output = np.ones(shape[0])
     output[:7] = 0.01
     return tf.linalg.diag(tf.convert_to_tensor(output, dtype=tf.float32))
+
+
+def K_vitals_log_diag_initialiser(shape, partition_info=None, dtype=None):
+    # log of the diagonal of K_D for K_vitals_initialiser, for K_D = W W^T + diag
+    output = np.zeros(shape[0])
+    output[7:] = 2 * np.log(0.01)
+    return tf.convert_to_tensor(output, dtype=tf.float32)
+
+
+def K_labs_log_diag_initialiser(shape, partition_info=None, dtype=None):
+    # log of the diagonal of K_D for K_labs_initialiser, for K_D = W W^T + diag
+    output = np.zeros(shape[0])
+    output[:7] = 2 * np.log(0.01)
+    return tf.convert_to_tensor(output, dtype=tf.float32)
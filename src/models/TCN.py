@@ -10,7 +10,8 @@ sys.path.append(head)
 
 
 def make_model(time_window, no_channels, L2reg, DO, num_layers, kernel_size=2, stride=1, add_classification_layer=True,
-               filters_per_layer=None):
+               filters_per_layer=None, dtype=None):
+    # dtype: keras dtype policy of the layers, e.g. 'mixed_bfloat16' (bfloat16 compute, float32 weights)
     no_initial_channels = no_channels
     if filters_per_layer is None:
         no_channels = no_initial_channels
@@ -21,37 +22,45 @@ def make_model(time_window, no_channels, L2reg, DO, num_layers, kernel_size=2, s
                                   dilation_rate=1, activation=tf.nn.relu,
                                   input_shape=(time_window, no_initial_channels),
                                   kernel_regularizer=keras.regularizers.l2(L2reg[0]),
-                                  name="conv00"),
+                                  name="conv00",
+                                  dtype=dtype),
               keras.layers.Dropout(DO[0],
-                                   name="DropOut00"),
+                                   name="DropOut00",
+                                   dtype=dtype),
               keras.layers.Conv1D(filters=no_channels, kernel_size=kernel_size, strides=1, padding='causal',
                                   dilation_rate=1, activation=tf.nn.relu,
                                   kernel_regularizer=keras.regularizers.l2(L2reg[0]),
-                                  name="conv01"),
+                                  name="conv01",
+                                  dtype=dtype),
               keras.layers.Dropout(DO[0],
-                                   name="DropOut01")]
+                                   name="DropOut01",
+                                   dtype=dtype)]
     for i in range(1, num_layers):
         layers += [keras.layers.Conv1D(filters=no_channels, kernel_size=kernel_size, strides=1, padding='causal',
                                        dilation_rate=2 ** i, activation=tf.nn.relu,
                                        kernel_regularizer=keras.regularizers.l2(L2reg[i]),
-                                       name="conv{}0".format(i)),
+                                       name="conv{}0".format(i),
+                                       dtype=dtype),
                    keras.layers.Dropout(DO[i],
-                                        name="DropOut{}0".format(i)),
+                                        name="DropOut{}0".format(i),
+                                        dtype=dtype),
                    keras.layers.Conv1D(filters=no_channels, kernel_size=kernel_size, strides=1, padding='causal',
                                        dilation_rate=2 ** i, activation=tf.nn.relu,
                                        kernel_regularizer=keras.regularizers.l2(L2reg[i]),
-                                       name="conv{}1".format(i)),
+                                       name="conv{}1".format(i),
+                                       dtype=dtype),
                    keras.layers.Dropout(DO[i],
-                                        name="DropOut{}1".format(i))]
+                                        name="DropOut{}1".format(i),
+                                        dtype=dtype)]
     if add_classification_layer:
-        layers.append(LastDimDenseLayer(no_channels, 2))
+        layers.append(LastDimDenseLayer(no_channels, 2, dtype=dtype))
     model = keras.Sequential(layers)
     return model
 
 
 class LastDimDenseLayer(tf.keras.layers.Layer):
-    def __init__(self, no_channels, num_outputs):
-        super(LastDimDenseLayer, self).__init__()
+    def __init__(self, no_channels, num_outputs, dtype=None):
+        super(LastDimDenseLayer, self).__init__(dtype=dtype)
         self.kernel = self.add_variable("LastTimestepDense",
                                         shape=[no_channels, num_outputs])
 
@@ -60,3 +69,77 @@ class LastDimDenseLayer(tf.keras.layers.Layer):
 
     def call(self, input):
         return tf.matmul(input[:, -1, :], self.kernel)
+
+
+def fused_heads(inputs, heads):
+    # dense layers (heads) applied to the same inputs as a single projection (concatenated kernels and biases)
+    # returns the outputs of the heads stacked on a new last axis
+    kernel = tf.concat([head.kernel for head in heads], -1)
+    bias = tf.concat([head.bias for head in heads], -1)
+    outputs = tf.einsum('...c,cd->...d', inputs, tf.cast(kernel, inputs.dtype)) + tf.cast(bias, inputs.dtype)
+    return tf.stack(tf.split(outputs, len(heads), -1), -1)
+
+
+def call_with_static(model, inputs, static):
+    """
+    model (make_model) applied to the concatenation of inputs and of the static features repeated over time,
+    without materialising the repeated static features: being constant in time, their contribution to the first
+    (causal) convolution is computed once per patient, then shared by the MC samples of the patient
+    :param inputs: patient * MC sample x time x n_channels - n_static
+    :param static: patient x n_static
+    """
+    conv = model.layers[0]
+    dtype = conv.compute_dtype
+    kernel = tf.cast(conv.kernel, dtype)
+    kernel_size, n_dyn = kernel.shape[0], inputs.shape[-1]
+    dilation = conv.dilation_rate[0]
+    dyn = tf.nn.conv1d(tf.pad(tf.cast(inputs, dtype), [[0, 0], [(kernel_size - 1) * dilation, 0], [0, 0]]),
+                       kernel[:, :n_dyn], stride=1, padding='VALID', dilations=dilation)
+    # tap j of the causal convolution only sees (non padded) static features from time (kernel_size - 1 - j) d on
+    taps = tf.einsum('bs,ksc->bkc', tf.cast(static, dtype), kernel[:, n_dyn:])
+    valid = tf.cast(tf.expand_dims(tf.range(tf.shape(inputs)[1]), 1)
+                    >= tf.expand_dims((kernel_size - 1 - tf.range(kernel_size)) * dilation, 0), dtype)
+    stat = tf.repeat(tf.einsum('tk,bkc->btc', valid, taps), tf.shape(inputs)[0] // tf.shape(static)[0], axis=0)
+    outputs = conv.activation(dyn + stat + tf.cast(conv.bias, dtype))
+    for layer in model.layers[1:]:
+        outputs = layer(outputs)
+    return outputs
+
+
+class TCNStream:
+    """
+    streaming inference of a causal TCN (make_model), one time step at a time
+    the input of every convolution is kept in a ring buffer of its last (kernel_size - 1) * dilation + 1 time steps:
+    a new time step costs kernel_size matvecs per convolution, the past outputs are never computed again
+    same outputs as model on the whole stream (dropout is off), the buffers start at zero like the causal padding
+    """
+    def __init__(self, model):
+        self.model = model
+        self.convs = [layer for layer in model.layers if isinstance(layer, keras.layers.Conv1D)]
+        self.classifier = [layer for layer in model.layers if isinstance(layer, LastDimDenseLayer)]
+        self.buffers = []
+        self.t = 0
+
+    def reset(self, batch):
+        self.t = 0
+        self.buffers = [tf.Variable(tf.zeros([(conv.kernel.shape[0] - 1) * conv.dilation_rate[0] + 1, batch,
+                                              conv.kernel.shape[1]], conv.compute_dtype), trainable=False)
+                        for conv in self.convs]
+
+    def step(self, inputs):
+        """
+        :param inputs: batch x n_channels, the new time step
+        :return: output of the model at the new time step, batch x n_channels (batch x 2 with the classification layer)
+        """
+        outputs = inputs
+        for conv, buffer in zip(self.convs, self.buffers):
+            size, kernel_size, dilation = buffer.shape[0], conv.kernel.shape[0], conv.dilation_rate[0]
+            buffer[self.t % size].assign(tf.cast(outputs, buffer.dtype))
+            # tap j sees the input (kernel_size - 1 - j) * dilation time steps back
+            taps = tf.gather(buffer, (self.t - (kernel_size - 1 - tf.range(kernel_size)) * dilation) % size)
+            outputs = conv.activation(tf.einsum('kbc,kcd->bd', taps, tf.cast(conv.kernel, buffer.dtype))
+                                      + tf.cast(conv.bias, buffer.dtype))
+        self.t += 1
+        for layer in self.classifier:
+            outputs = tf.matmul(outputs, tf.cast(layer.kernel, outputs.dtype))
+        return outputs
@@ -2,17 +2,16 @@ import os
 import sys
 import tensorflow as tf
 from tensorflow import keras
-import numpy as np
 
 # appending head path
 cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
 sys.path.append(head)
 
-from src.models.TCN import make_model
+from src.models.TCN import make_model, call_with_static
 
 
-class AttTCN_alpha:
+class AttTCN_alpha(keras.Model):
     def __init__(self,
                  time_window,
                  n_channels,
@@ -20,7 +19,10 @@ class AttTCN_alpha:
                  DO,
                  L2reg,
                  kernel_size=2,
-                 stride=1):
+                 stride=1,
+                 dtype=None):
+        # dtype: keras dtype policy of the TCN and dense layer (see AttTCN)
+        super(AttTCN_alpha, self).__init__()
         self.alphaTCN = make_model(time_window=time_window,
                                    no_channels=n_channels,
                                    L2reg=L2reg,
@@ -28,36 +30,20 @@ class AttTCN_alpha:
                                    num_layers=num_layers,
                                    kernel_size=kernel_size,
                                    stride=stride,
-                                   add_classification_layer=False)
+                                   add_classification_layer=False,
+                                   dtype=dtype)
 
-        self.alpha_layer = keras.layers.Dense(2, input_shape=[n_channels], name="alpha_weights")
-
-        self.trainable_variables = self.alphaTCN.trainable_variables + \
-                                   self.alpha_layer.trainable_variables
+        self.alpha_layer = keras.layers.Dense(2, input_shape=[n_channels], name="alpha_weights", dtype=dtype)
         self.num_layers = num_layers
 
-    def __call__(self, inputs):
+    def call(self, inputs, static=None):
+        # static: static features of the patients, kept out of inputs (see AttTCN)
+        alpha_out = self.alphaTCN(inputs) if static is None else call_with_static(self.alphaTCN, inputs, static)
         # Note that the activation on alpha and the output are only valid if for a model trained on the last timestep
-        self.alpha = keras.activations.softmax(self.alpha_layer(self.alphaTCN(inputs)), -2)
-        _ = self.get_weights()
-        # end shape = batch x time x features x outcome_classes
-        end_shape = inputs.shape + [2]
-        expanded_alpha = tf.broadcast_to(tf.expand_dims(self.alpha, -2), end_shape)
-        expanded_inputs = tf.broadcast_to(tf.expand_dims(inputs, -1), end_shape)
-
-        return tf.reduce_sum(expanded_alpha * expanded_inputs, [1, 2])
-
-    def get_weights(self):
-        self.trainable_variables = self.alphaTCN.trainable_variables + \
-                                   self.alpha_layer.trainable_variables
-        return self.trainable_variables
-
-    def set_weights(self, weights):
-        if not isinstance(weights[0], np.ndarray):
-            weights = [weights[i].numpy() for i in range(len(weights))]
-        start = 0
-        end = self.num_layers * 4
-        self.alphaTCN.set_weights(weights[start: end])
-        start = end
-        end += 2
-        self.alpha_layer.set_weights(weights[start: end])
+        self.alpha = keras.activations.softmax(tf.cast(self.alpha_layer(alpha_out), tf.float32), -2)
+        # sum over time t and features c of alpha[t, k] inputs[t, c], for each outcome class k
+        if static is None:
+            return tf.einsum('btk,btc->bk', self.alpha, inputs)
+        stat = tf.repeat(static, tf.shape(inputs)[0] // tf.shape(static)[0], axis=0)
+        return tf.einsum('btk,btc->bk', self.alpha, inputs) + \
+               tf.einsum('btk,bc->bk', self.alpha, stat)
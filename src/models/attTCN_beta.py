@@ -2,17 +2,16 @@ import os
 import sys
 import tensorflow as tf
 from tensorflow import keras
-import numpy as np
 
 # appending head path
 cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
 sys.path.append(head)
 
-from src.models.TCN import make_model
+from src.models.TCN import make_model, fused_heads, call_with_static
 
 
-class AttTCN_beta:
+class AttTCN_beta(keras.Model):
     def __init__(self,
                  time_window,
                  n_channels,
@@ -21,7 +20,10 @@ class AttTCN_beta:
                  L2reg,
                  kernel_size=2,
                  stride=1,
-                 sigmoid_beta=False):
+                 sigmoid_beta=False,
+                 dtype=None):
+        # dtype: keras dtype policy of the TCN and dense layers (see AttTCN)
+        super(AttTCN_beta, self).__init__()
         self.betaTCN = make_model(time_window=time_window,
                                   no_channels=n_channels,
                                   L2reg=L2reg,
@@ -29,46 +31,31 @@ class AttTCN_beta:
                                   num_layers=num_layers,
                                   kernel_size=kernel_size,
                                   stride=stride,
-                                  add_classification_layer=False)
-
-        self.beta_layer_pos = keras.layers.Dense(n_channels, input_shape=[n_channels], name="beta_pos_weights")
-        self.beta_layer_neg = keras.layers.Dense(n_channels, input_shape=[n_channels], name="beta_neg_weights")
-
-        self.trainable_variables =self.betaTCN.trainable_variables + \
-                                   self.beta_layer_pos.trainable_variables + \
-                                   self.beta_layer_neg.trainable_variables
+                                  add_classification_layer=False,
+                                  dtype=dtype)
+
+        self.beta_layer_pos = keras.layers.Dense(n_channels, input_shape=[n_channels], name="beta_pos_weights",
+                                                 dtype=dtype)
+        self.beta_layer_neg = keras.layers.Dense(n_channels, input_shape=[n_channels], name="beta_neg_weights",
+                                                 dtype=dtype)
+        # the heads are used through their kernels (see fused_heads), hence built here
+        self.beta_layer_pos.build([None, n_channels])
+        self.beta_layer_neg.build([None, n_channels])
         self.num_layers = num_layers
         self.sigmoid_beta = sigmoid_beta
 
-    def __call__(self, inputs):
+    def call(self, inputs, static=None):
+        # static: static features of the patients, kept out of inputs (see AttTCN)
+        beta_out = self.betaTCN(inputs) if static is None else call_with_static(self.betaTCN, inputs, static)
         # Note that the activation on alpha and the output are only valid if for a model trained on the last timestep
+        # a single pass of the beta TCN (same dropout for both heads), both heads in one projection
+        self.beta = tf.cast(fused_heads(beta_out, [self.beta_layer_pos, self.beta_layer_neg]), tf.float32)
         if self.sigmoid_beta:
-            beta_pos = tf.expand_dims(keras.activations.sigmoid(self.beta_layer_pos(self.betaTCN(inputs))), -1)
-            beta_neg = tf.expand_dims(keras.activations.sigmoid(self.beta_layer_neg(self.betaTCN(inputs))), -1)
-        else:
-            beta_pos = tf.expand_dims(self.beta_layer_pos(self.betaTCN(inputs)), -1)
-            beta_neg = tf.expand_dims(self.beta_layer_neg(self.betaTCN(inputs)), -1)
-        _ = self.get_weights()
-        self.beta = tf.concat([beta_pos, beta_neg], -1)
-        expanded_inputs = tf.broadcast_to(tf.expand_dims(inputs, -1), list(self.beta.shape))
-
-        return tf.reduce_sum(self.beta * expanded_inputs, [1, 2])
-
-    def get_weights(self):
-        self.trainable_variables = self.betaTCN.trainable_variables + \
-                                   self.beta_layer_pos.trainable_variables + \
-                                   self.beta_layer_neg.trainable_variables
-        return self.trainable_variables
-
-    def set_weights(self, weights):
-        if not isinstance(weights[0], np.ndarray):
-            weights = [weights[i].numpy() for i in range(len(weights))]
-        start = 0
-        end = self.num_layers * 4
-        self.betaTCN.set_weights(weights[start: end])
-        start = end
-        end += 2
-        self.beta_layer_pos.set_weights(weights[start: end])
-        start = end
-        end += 2
-        self.beta_layer_neg.set_weights(weights[start: end])
+            self.beta = keras.activations.sigmoid(self.beta)
+        # sum over time t and channels c of beta[t, c, k] inputs[t, c], for each outcome class k
+        if static is None:
+            return tf.einsum('btck,btc->bk', self.beta, inputs)
+        n_dyn = inputs.shape[-1]
+        stat = tf.repeat(static, tf.shape(inputs)[0] // tf.shape(static)[0], axis=0)
+        return tf.einsum('btck,btc->bk', self.beta[:, :, :n_dyn], inputs) + \
+               tf.einsum('btck,bc->bk', self.beta[:, :, n_dyn:], stat)
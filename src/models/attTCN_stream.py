@@ -0,0 +1,88 @@
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+
+# appending head path
+cwd = os.path.dirname(os.path.abspath(__file__))
+head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir, os.pardir))
+sys.path.append(head)
+
+from src.models.TCN import TCNStream, fused_heads
+
+
+class AttTCNStream:
+    """
+    streaming inference of a trained AttTCN for live scoring, one new hour of every patient at a time
+    exact (default): the last time_window time steps are kept in a ring buffer and scored with the AttTCN, the same
+    scores as AttTCN on the right aligned window, at the cost of one window per step
+    exact=False (opt-in approximation): each time step goes through the alpha and beta TCNs once (see TCN.TCNStream),
+    the attention combination keeps, for the last time_window steps, the alpha logits and
+    sum_c beta[t, c, k] inputs[t, c] only (batch x 2 each); the TCNs then see the whole stream rather than the zero
+    padding at the start of each window: once the stream is longer than the window, the time steps of the window
+    within the receptive field of its start differ from those of AttTCN on the window
+    the past time steps are kept as they were received (draws or moments of the GP at that hour)
+    """
+    def __init__(self, attTCN, time_window, exact=True):
+        self.attTCN = attTCN
+        self.time_window = time_window
+        self.exact = exact
+        self.alpha_stream = TCNStream(attTCN.alphaTCN)
+        self.beta_stream = TCNStream(attTCN.betaTCN)
+        self.static = None
+        self.t = 0
+
+    def reset(self, batch, static=None, n_samples=1, prefill=True):
+        """
+        :param batch: number of streams (patient * MC sample)
+        :param static: patient x n_stat, appended to every time step (as in GPattTCN), None if in the time steps
+        :param prefill: starts with time_window - 1 zero time steps, as the left padding of short stays in the
+                        GP draws (MultiKernelMGPLayer.align_right), always on if exact
+        """
+        self.static = None if static is None else tf.repeat(tf.cast(static, tf.float32), n_samples, axis=0)
+        n_channels = self.alpha_stream.convs[0].kernel.shape[1]
+        n_stat = 0 if self.static is None else self.static.shape[-1]
+        self.t = 0
+        if self.exact:
+            # the window starts as the zero time steps (with the static features) of a short stay
+            padding = tf.zeros([batch, n_channels - n_stat])
+            if self.static is not None:
+                padding = tf.concat([padding, self.static], -1)
+            self.window = tf.Variable(tf.tile(tf.expand_dims(padding, 0), [self.time_window, 1, 1]),
+                                      trainable=False)
+            return
+        self.alpha_stream.reset(batch)
+        self.beta_stream.reset(batch)
+        # empty slots of the window get no attention
+        self.logits = tf.Variable(tf.fill([self.time_window, batch, 2], np.float32(-np.inf)), trainable=False)
+        self.values = tf.Variable(tf.zeros([self.time_window, batch, 2]), trainable=False)
+        if prefill:
+            for _ in range(self.time_window - 1):
+                self.step(tf.zeros([batch, n_channels - n_stat]))
+
+    def step(self, inputs):
+        """
+        :param inputs: batch x n_channels (- n_stat), the new time step of every stream
+        :return: logits of the last time_window steps, batch x 2
+        """
+        inputs = tf.cast(inputs, tf.float32)
+        if self.static is not None:
+            inputs = tf.concat([inputs, self.static], -1)
+        # the ring buffer slot of the time step leaving the window
+        slot = self.t % self.time_window
+        self.t += 1
+        if self.exact:
+            self.window[slot].assign(inputs)
+            # window in time order, from the oldest slot
+            order = (self.t + tf.range(self.time_window)) % self.time_window
+            return self.attTCN(tf.transpose(tf.gather(self.window, order), perm=[1, 0, 2]))
+
+        alpha_logits = tf.cast(self.attTCN.alpha_layer(self.alpha_stream.step(inputs)), tf.float32)
+        beta = tf.cast(fused_heads(self.beta_stream.step(inputs),
+                                   [self.attTCN.beta_layer_pos, self.attTCN.beta_layer_neg]), tf.float32)
+        if self.attTCN.sigmoid_beta:
+            beta = tf.sigmoid(beta)
+        self.logits[slot].assign(alpha_logits)
+        self.values[slot].assign(tf.einsum('bck,bc->bk', beta, inputs))
+        # softmax over the time steps of the window (the order of the slots does not matter)
+        return tf.reduce_sum(tf.nn.softmax(self.logits, axis=0) * self.values, 0)
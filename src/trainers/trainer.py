@@ -9,7 +9,8 @@ cwd = os.path.dirname(os.path.abspath(__file__))
 head = os.path.abspath(os.path.join(cwd, os.pardir, os.pardir))
 sys.path.append(head)
 from src.loss_n_eval.aucs import evals as uni_evals
-from src.loss_n_eval.losses import grad, GP_loss
+from src.loss_n_eval.losses import grad, GP_loss, logits_loss
+from src.models.GP_cache import PosteriorCache
 from src.utils.debug import t_print
 
 class Trainer:
@@ -29,6 +30,12 @@ class Trainer:
                  horizon0=False,
                  lab_vitals_only=False,
                  weighted_loss=None,
+                 freeze_GP_epoch=None,
+                 batch_size_cache=64,
+                 rank_cache=32,
+                 tf_function=False,
+                 jit_compile=False,
+                 eval_horizons=False,
                  ):
 
         self.model = model
@@ -46,6 +53,21 @@ class Trainer:
         self.horizon0 = horizon0
         self.lab_vitals_only = lab_vitals_only
         self.weighted_loss = weighted_loss
+        # two stage training: from epoch freeze_GP_epoch on the GP is frozen and only the attTCN is trained,
+        # on draws from an on disk cache of the GP posteriors (needs DataGenerator(debug=True) for the ids)
+        self.freeze_GP_epoch = freeze_GP_epoch
+        assert freeze_GP_epoch is None or data.debug, "freeze_GP_epoch needs the ids of DataGenerator(debug=True)"
+        self.batch_size_cache = batch_size_cache
+        self.rank_cache = rank_cache
+        # forward, backward pass and update of a training step compiled into a graph (tf.function),
+        # with XLA if jit_compile (GP with static_shapes), the frozen GP stage (numpy cache) stays eager
+        self.compiled_train_step = None
+        if tf_function or jit_compile:
+            self.compiled_train_step = tf.function(self.train_step, jit_compile=jit_compile, reduce_retracing=True)
+
+        # end of epoch dev evaluation of all horizons of a stay at once (model.call_horizons),
+        # needs DataGenerator(horizon_batches=True)
+        self.eval_horizons = eval_horizons
 
         # Initialise progress trackers - epoch
         self.train_loss_results = []
@@ -63,11 +85,15 @@ class Trainer:
         else:
             self.no_batches = int(len(self.data.train_case_idx) / self.batch_size) + 1
         self.no_dev_batches = int(len(self.data.val_data[-1]) / self.batch_size) + 1
+        if self.eval_horizons:
+            self.no_dev_horizon_batches = int(len(self.data.val_horizons[0]) / self.batch_size) + 1
 
 
     def run(self):
         for epoch in range(self.num_epochs):
             t_print("Start of epoch {}".format(epoch))
+            if epoch == self.freeze_GP_epoch:
+                self.freeze_GP()
             # shuffle data
             np.random.shuffle(self.data.train_case_idx)
             np.random.shuffle(self.data.train_control_idx)
@@ -78,20 +104,17 @@ class Trainer:
                 # batch_data = Y, T, ind_features, num_distinct_Y, X, num_distinct_X, static, labels, classes
                 batch_data = next(self.data.next_batch(self.batch_size, batch, late=self.late_patients_only,
                                                        horizon0=self.horizon0))
-                # batch_data[8] is static
-                if self.lab_vitals_only:
-                    inputs = batch_data[:7]
-                else:
-                    inputs = batch_data[:8]
+                inputs = self.model_inputs(batch_data)
                 y = batch_data[8]
                 classes = batch_data[9]
                 if len(y) > 0:
 
-                    # Evaluate loss and gradient
-                    loss_value, grads = grad(self.model, inputs, y, GP=True, weighted_loss=self.weighted_loss)
-                    # Apply gradient
-                    self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables), self.global_step)
-                    self.global_step.assign_add(1)
+                    # Evaluate loss and gradient, apply gradient
+                    if self.compiled_train_step is not None and getattr(self.model, 'cache', None) is None:
+                        loss_value, chol_metrics = self.compiled_train_step([tf.convert_to_tensor(x) for x in inputs],
+                                                                            tf.convert_to_tensor(y))
+                    else:
+                        loss_value, chol_metrics = self.train_step(inputs, y)
 
                     # Track progress - loss
                     self.train_loss_results_batch.append(loss_value.numpy())
@@ -106,6 +129,9 @@ class Trainer:
                     step = (epoch * self.no_batches + batch) * self.no_dev_batches
                     with self.summary_writers['train'].as_default():
                         tf.summary.scalar('loss', loss_value.numpy(), step=step)
+                        for name, value in chol_metrics.items():
+                            if len(value.shape) == 0: tf.summary.scalar(name, value, step=step)
+                            else: tf.summary.histogram(name, value, step=step)
                         for i in range(8):
                             if roc_auc[i] != 0: tf.summary.scalar("roc_{}".format(i), roc_auc[i], step=step)
                             if pr_auc[i] != 0: tf.summary.scalar("pr_{}".format(i), pr_auc[i], step=step)
@@ -130,9 +156,14 @@ class Trainer:
                 all_dev_y = []
                 all_dev_y_hat = []
                 classes = []
-                for dev_batch in range(self.no_dev_batches):
+                # the frozen GP (cache) only has the rows of the truncated copies
+                horizons = self.eval_horizons and getattr(self.model, 'cache', None) is None
+                for dev_batch in range(self.no_dev_horizon_batches if horizons else self.no_dev_batches):
                     step = (self.num_epochs * self.no_batches) * self.no_dev_batches
-                    y_true, y_hat, _class = self.dev_eval(dev_batch, step)
+                    if horizons:
+                        y_true, y_hat, _class = self.dev_eval_horizons(dev_batch, step)
+                    else:
+                        y_true, y_hat, _class = self.dev_eval(dev_batch, step)
                     all_dev_y.append(y_true)
                     all_dev_y_hat.append(y_hat)
                     classes.append(_class)
@@ -145,6 +176,17 @@ class Trainer:
                     with open(os.path.join(self.log_path, 'epoch_{}_out.pkl'.format(epoch)), "wb") as f:
                         pickle.dump(_to_save, f)
 
+    def train_step(self, inputs, y):
+        loss_value, grads = grad(self.model, inputs, y, GP=True, weighted_loss=self.weighted_loss)
+        # cholesky retries of the GP layer during this step
+        if hasattr(self.model, 'GP') and getattr(self.model, 'cache', None) is None:
+            chol_metrics = self.model.GP.chol_metrics()
+        else:
+            chol_metrics = {}
+        self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+        self.global_step.assign_add(1)
+        return loss_value, chol_metrics
+
     def dev_eval_per_horizon(self, horizon, step):
         batch_data = next(self.data.next_batch_dev_small(horizon))
         _, loss_dev, roc_auc, pr_auc = self.step(batch_data)
@@ -170,12 +212,50 @@ class Trainer:
         # return y_true, y_hat, class
         return np.array(batch_data[9]), dev_y_hat, np.array(batch_data[9])
 
-    def step(self, batch_data):
+    def dev_eval_horizons(self, dev_batch, step):
+        # stays of the batch with all their horizons, batch_data[10:] = num_obs_h, num_grid_h, rows_h
+        batch_data = next(self.data.next_batch_dev_horizons(self.batch_size, dev_batch))
+        num_obs_h, num_grid_h, rows_h = batch_data[10:]
+        if len(rows_h) == 0:
+            return None, None, None
+        kept = rows_h >= 0
+        y = tf.boolean_mask(batch_data[8], kept)
+        classes = batch_data[9][kept]
+        out = tf.boolean_mask(self.model.call_horizons(self.model_inputs(batch_data), num_obs_h, num_grid_h), kept)
+        loss_dev = logits_loss(out, y)
+        dev_y_hat = tf.nn.softmax(out)
+        roc_auc, pr_auc, _, _ = uni_evals(y.numpy(), dev_y_hat.numpy(), classes, overall=True)
+        with self.summary_writers['val'].as_default():
+            tf.summary.scalar("loss_dev", loss_dev.numpy(), step=step + dev_batch)
+            for i in range(7):
+                if roc_auc[i] != 0: tf.summary.scalar("roc_{}_dev".format(i), roc_auc[i], step=step + dev_batch)
+                if pr_auc[i] != 0: tf.summary.scalar("pr_{}_dev".format(i), pr_auc[i], step=step + dev_batch)
+        t_print("DEV Loss: {:.3f}\tROC o/a:{:.3f}\tPR  o/a:{:.3f}".format(loss_dev, roc_auc[7], pr_auc[7]))
+        return np.array(y), dev_y_hat, classes
+
+    def freeze_GP(self):
+        # posteriors of every row (icustay id, horizon) of all splits, computed once with the current GP
+        t_print("Freezing the GP")
+        cache = PosteriorCache(os.path.join(self.log_path, 'GP_cache'), noise=self.model.GP.noise,
+                               noise_seed=self.model.GP.noise_seed)
+        cache.build(self.model.GP,
+                    [self.data.train_data, self.data.val_data, self.data.test_data],
+                    batch_size=self.batch_size_cache,
+                    rank=self.rank_cache)
+        self.model.freeze_GP(cache)
+
+    def model_inputs(self, batch_data):
+        if getattr(self.model, 'cache', None) is not None:
+            # frozen GP: ids, horizons (classes are repeated for the MC samples) & static
+            return [batch_data[10], batch_data[9][::self.data.no_mc_samples], batch_data[7]]
         # batch_data[8] is static
         if self.lab_vitals_only:
-            inputs = batch_data[:7]
+            return batch_data[:7]
         else:
-            inputs = batch_data[:8]
+            return batch_data[:8]
+
+    def step(self, batch_data):
+        inputs = self.model_inputs(batch_data)
         y = batch_data[8]
         classes = batch_data[9]
         if len(y) > 0:
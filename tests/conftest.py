@@ -0,0 +1,108 @@
+import os
+import sys
+import numpy as np
+import pytest
+import tensorflow as tf
+
+# appending head path
+cwd = os.path.dirname(os.path.abspath(__file__))
+head = os.path.abspath(os.path.join(cwd, os.pardir))
+sys.path.append(head)
+
+from src.models.GP import MultiKernelMGPLayer
+
+TIME_WINDOW = 8
+N_FEATURES = 5
+N_STAT = 3
+# attTCN without dropout nor regularisation
+NUM_LAYERS = 3
+DO = [0.] * NUM_LAYERS
+L2REG = [0.] * NUM_LAYERS
+# MC samples of the moment tests
+N_SAMPLES = 500
+
+
+def synthetic_stays(batch=6, n_features=N_FEATURES, max_obs=30, on_grid=False, duration=15, seed=1):
+    """
+    random stays, a list of (times, values, features) in time order
+    on_grid: observation times on whole hours
+    duration: observation times in [0, duration] hours
+    """
+    rng = np.random.RandomState(seed)
+    stays = []
+    for n in rng.randint(5, max_obs, batch):
+        t = np.sort(rng.uniform(0, duration, n))
+        if on_grid:
+            t = np.round(t)
+        feature = rng.randint(0, n_features, n)
+        stays.append((t, rng.randn(n), feature))
+    return stays
+
+
+def pack_stays(stays):
+    """
+    stays in the input format of MultiKernelMGPLayer, [Y, T, ind_K_D, ind_T, num_obs, X, X_len]:
+    Y, T in time order, ind_K_D sorted by feature, ind_T position in time order of the sorted observations,
+    hourly grid X from 0 to the last observation
+    """
+    batch = len(stays)
+    num_obs = np.asarray([len(t) for t, _, _ in stays], np.int32)
+    n_max = num_obs.max()
+    Y = np.zeros((batch, n_max), np.float32)
+    T = np.zeros((batch, n_max), np.float32)
+    ind_K_D = np.zeros((batch, n_max), np.int32)
+    ind_T = np.zeros((batch, n_max), np.int32)
+    X = np.zeros((batch, 20), np.float32)
+    X_len = np.zeros(batch, np.int32)
+    for b, (t, y, feature) in enumerate(stays):
+        order = np.argsort(feature, kind='stable')
+        T[b, :num_obs[b]] = t
+        Y[b, :num_obs[b]] = y
+        ind_K_D[b, :num_obs[b]] = feature[order]
+        ind_T[b, :num_obs[b]] = order
+        X_len[b] = int(t.max()) + 1
+        X[b, :X_len[b]] = np.arange(X_len[b])
+    return [tf.constant(v) for v in [Y, T, ind_K_D, ind_T, num_obs, X, X_len]]
+
+
+def synthetic_batch(batch=6, n_features=N_FEATURES, max_obs=30, on_grid=False, duration=15, seed=1):
+    # random stays in the input format of MultiKernelMGPLayer, see synthetic_stays & pack_stays
+    return pack_stays(synthetic_stays(batch, n_features, max_obs, on_grid, duration, seed))
+
+
+def make_GP(reference_GP, n_mc_samples=N_SAMPLES, layer=MultiKernelMGPLayer, **kwargs):
+    # GP layer (MultiKernelMGPLayer or a subclass) with the parameters of reference_GP
+    GP = layer(TIME_WINDOW, n_mc_samples, N_FEATURES, **kwargs)
+    GP.set_weights(reference_GP.get_weights())
+    return GP
+
+
+def draw_statistics(GP, inputs):
+    # MC mean and variance of the draws of GP, batch x time_window x n_feat each
+    draws = tf.reshape(GP(list(inputs)), (-1, GP.n_mc_samples, GP.time_window, GP.n_features))
+    return tf.reduce_mean(draws, 1).numpy(), tf.math.reduce_variance(draws, 1).numpy()
+
+
+def assert_moments(mean, var, ref_mean, ref_var, n_samples, atol=1e-3):
+    # MC estimates within 5 standard errors of the exact moments
+    np.testing.assert_array_less(np.abs(mean - ref_mean), 5 * np.sqrt(ref_var / n_samples) + atol)
+    np.testing.assert_array_less(np.abs(var - ref_var), 5 * ref_var * np.sqrt(2. / n_samples) + atol)
+
+
+@pytest.fixture
+def inputs():
+    return synthetic_batch()
+
+
+@pytest.fixture
+def grid_inputs():
+    return synthetic_batch(on_grid=True)
+
+
+@pytest.fixture
+def reference_GP():
+    # exact posterior ('chol'), the other layers of a test copy its parameters
+    tf.random.set_seed(0)
+    GP = MultiKernelMGPLayer(TIME_WINDOW, 1, N_FEATURES, method_name='chol')
+    GP.variable_update()
+    return GP
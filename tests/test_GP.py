@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from conftest import TIME_WINDOW, N_FEATURES, N_SAMPLES, synthetic_batch, synthetic_stays, pack_stays, make_GP, \
+    draw_statistics, assert_moments
+from src.models.GP import MultiKernelMGPLayer
+
+
+@pytest.mark.parametrize('method_name, kwargs', [('chol', {}),
+                                                 ('cg', {}),
+                                                 ('cg', {'cg_matrix_free': True}),
+                                                 ('kalman', {}),
+                                                 ('pathwise', {}),
+                                                 ('kalman', {'noise': 'sobol'}),
+                                                 ('pathwise', {'noise': 'sobol'})])
+def test_draws_match_exact_moments(reference_GP, inputs, method_name, kwargs):
+    tf.random.set_seed(1)
+    ref_mean, ref_var = [x.numpy() for x in reference_GP(list(inputs), moments=True)]
+    mean, var = draw_statistics(make_GP(reference_GP, method_name=method_name, **kwargs), inputs)
+    assert_moments(mean, var, ref_mean, ref_var, N_SAMPLES)
+
+
+@pytest.mark.parametrize('noise', ['mc', 'antithetic', 'sobol'])
+def test_grid_draws_match_exact_moments(reference_GP, grid_inputs, noise):
+    tf.random.set_seed(1)
+    ref_mean, ref_var = [x.numpy() for x in reference_GP(list(grid_inputs), moments=True)]
+    mean, var = draw_statistics(make_GP(reference_GP, method_name='grid', noise=noise), grid_inputs)
+    assert_moments(mean, var, ref_mean, ref_var, N_SAMPLES)
+    if noise == 'antithetic':
+        # pairs (e, -e) along the sample axis: exact mean, the draws are linear in the noise
+        # (up to the CG tolerance of the grid solver)
+        np.testing.assert_allclose(mean, ref_mean, atol=5e-4)
+    if noise == 'sobol':
+        # at least as accurate as 4 times as many MC samples
+        assert_moments(mean, var, ref_mean, ref_var, 4 * N_SAMPLES)
+
+
+def test_prior_matmul(reference_GP, inputs):
+    Y, T, ind_K_D, ind_T, num_obs, X, X_len = inputs
+    Ti_big = tf.gather(T, ind_T, batch_dims=1)
+    obs_mask = tf.sequence_mask(num_obs, T.shape[1], dtype=tf.float32)
+    Sigma_prior, D_big = reference_GP.prior_covariance(Ti_big, ind_K_D, obs_mask)
+    V = tf.random.normal((T.shape[0], T.shape[1], 3))
+    np.testing.assert_allclose(reference_GP.prior_matmul(Ti_big, ind_K_D, D_big, obs_mask, V).numpy(),
+                               tf.matmul(Sigma_prior, V).numpy(), atol=1e-5)
+
+
+def test_lean_gradient_matches_autodiff(reference_GP, inputs):
+    # same draws (common random numbers), gradients of a fixed linear function of the draws
+    weights = tf.random.stateless_normal((inputs[0].shape[0] * 4, TIME_WINDOW, N_FEATURES), seed=[0, 1])
+    gradients = []
+    for lean_gradient in [True, False]:
+        GP = make_GP(reference_GP, n_mc_samples=4, noise='crn', lean_gradient=lean_gradient)
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(GP(list(inputs)) * weights)
+        gradients.append([g.numpy() for g in tape.gradient(loss, GP.trainable_variables)])
+    for lean, autodiff in zip(*gradients):
+        np.testing.assert_allclose(lean, autodiff, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('method_name, on_grid', [('kalman', False), ('grid', True)])
+def test_graph_mode_matches_eager(reference_GP, method_name, on_grid):
+    # common random numbers: the traced layer draws the same noise as the eager one
+    inputs = synthetic_batch(on_grid=on_grid)
+    GP = make_GP(reference_GP, n_mc_samples=4, method_name=method_name, noise='crn')
+    eager = GP(list(inputs))
+    graph = tf.function(lambda *x: GP(list(x)))(*inputs)
+    np.testing.assert_allclose(graph.numpy(), eager.numpy(), atol=1e-5)
+
+
+def test_kalman_gradient_with_simultaneous_events(reference_GP, grid_inputs):
+    # observations on whole hours: events sharing a time, without transition noise between them
+    GP = make_GP(reference_GP, n_mc_samples=4, method_name='kalman', noise='crn')
+    with tf.GradientTape() as tape:
+        loss = tf.reduce_sum(GP(list(grid_inputs)))
+    for gradient in tape.gradient(loss, GP.trainable_variables):
+        assert np.all(np.isfinite(gradient.numpy()))
+
+
+def test_graph_mode_grid_fallback(reference_GP, inputs):
+    # off the grid: the 'chol' branch of the tf.cond, with its cholesky telemetry
+    tf.random.set_seed(1)
+    ref_mean, ref_var = [x.numpy() for x in reference_GP(list(inputs), moments=True)]
+    GP = make_GP(reference_GP, method_name='grid')
+    draws, metrics = tf.function(lambda *x: (GP(list(x)), GP.chol_metrics()))(*inputs)
+    draws = tf.reshape(draws, (-1, N_SAMPLES, TIME_WINDOW, N_FEATURES))
+    assert_moments(tf.reduce_mean(draws, 1).numpy(), tf.math.reduce_variance(draws, 1).numpy(), ref_mean, ref_var,
+                   N_SAMPLES)
+    np.testing.assert_array_equal(metrics['chol_tries'].numpy(), 1)
+
+
+def fixed_noise(shape):
+    # the same noise for each patient, whatever the batch and the number of grid times
+    position = tf.range(shape[1], dtype=tf.float32)[:, None] + 0.37 * tf.range(shape[2], dtype=tf.float32)
+    return tf.broadcast_to(tf.sin(position), shape)
+
+
+def test_call_horizons_matches_truncated_stays(reference_GP):
+    # horizon h keeps the observations up to 2 h hours before the end of the stay
+    stays = synthetic_stays()
+    copies = [[(t[t <= t.max() - 2 * h], y[t <= t.max() - 2 * h], f[t <= t.max() - 2 * h]) for h in range(3)]
+              for t, y, f in stays]
+    num_obs_h = tf.constant([[len(t) for t, _, _ in stay] for stay in copies])
+    num_grid_h = tf.constant([[int(t.max()) + 1 for t, _, _ in stay] for stay in copies])
+    GP = make_GP(reference_GP, n_mc_samples=2)
+    GP.standard_normal = fixed_noise
+    horizons = GP.call_horizons(pack_stays(stays), num_obs_h, num_grid_h)
+    truncated = GP(pack_stays([copy for stay in copies for copy in stay]))
+    np.testing.assert_allclose(horizons.numpy(), truncated.numpy(), atol=1e-6)
+
+
+@pytest.mark.parametrize('static_shapes', [False, True])
+def test_try_cholesky_retries(static_shapes):
+    # PD, indefinite (lowest eigenvalue -0.5, fixed by the jitter 10^3 add_diag of the 3rd retry) and indefinite
+    # beyond the jitter schedule (-5, the 4th and last retry falls back on the diagonal dominance jitter 5 + 10)
+    Sigma = tf.constant([np.diag([1., 2.]), np.diag([1., -0.5]), np.diag([1., -5.])])
+    GP = MultiKernelMGPLayer(TIME_WINDOW, 1, N_FEATURES, add_diag=1e-3, max_chol_tries=4,
+                             static_shapes=static_shapes)
+    GP.current_patients = tf.range(3)
+    L, num_tries = GP.try_cholesky(Sigma)
+    jitter = np.array([0., 1., 15.])
+    np.testing.assert_allclose(tf.matmul(L, L, transpose_b=True).numpy(),
+                               Sigma.numpy() + jitter[:, None, None] * np.eye(2), atol=1e-12)
+    np.testing.assert_array_equal(num_tries.numpy(), [1, 4, 5])
+    metrics = GP.chol_metrics()
+    np.testing.assert_array_equal(metrics['chol_tries'].numpy(), [1, 4, 5])
+    np.testing.assert_allclose(metrics['chol_jitter'].numpy(), jitter)
+    assert metrics['chol_retries'].numpy() == 7
+    assert metrics['chol_patients_retried'].numpy() == 2
+    assert metrics['chol_patients_failed'].numpy() == 1
+    assert metrics['chol_max_jitter'].numpy() == 15.
+
+
+def test_feature_groups_match_block_masked_K_D(reference_GP, inputs):
+    # one posterior per group against the joint posterior with the cross group entries of K_D set to 0
+    groups = [[0, 3], [1, 2, 4]]
+    GP = make_GP(reference_GP, feature_groups=groups)
+    # features coupled across the groups
+    rng = np.random.RandomState(0)
+    GP.K_D_half_v_prior.assign(np.eye(N_FEATURES) + 0.3 * rng.randn(N_FEATURES, N_FEATURES))
+    GP.K_D_half_l_prior.assign(0.3 * rng.randn(N_FEATURES, N_FEATURES))
+    GP.variable_update()
+    masked_GP = make_GP(GP)
+    masked_GP.K_D_half_v_prior.assign(GP.K_D_v_half)
+    masked_GP.K_D_half_l_prior.assign(GP.K_D_l_half)
+    for moment, masked_moment in zip(GP(list(inputs), moments=True), masked_GP(list(inputs), moments=True)):
+        np.testing.assert_allclose(moment.numpy(), masked_moment.numpy(), atol=1e-6)
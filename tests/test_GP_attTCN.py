@@ -0,0 +1,54 @@
+import numpy as np
+import tensorflow as tf
+
+from conftest import TIME_WINDOW, N_FEATURES, N_STAT, NUM_LAYERS, DO, L2REG, synthetic_stays, pack_stays
+from src.data_loader.utils import kernel_geometry
+from src.models.GP_attTCN import GPattTCN
+
+
+def make_model(**kwargs):
+    tf.random.set_seed(0)
+    return GPattTCN(TIME_WINDOW, 4, N_FEATURES, N_STAT, num_layers=NUM_LAYERS, DO=DO, L2reg=L2REG, noise='crn',
+                    **kwargs)
+
+
+def model_inputs(inputs):
+    static = tf.random.stateless_normal((inputs[0].shape[0], N_STAT), seed=[0, 0])
+    return list(inputs) + [static]
+
+
+def test_predict_adaptive_is_P_sepsis(inputs):
+    # a single chunk: the average over the same draws of the first column of the softmax (the sepsis column of
+    # y_star in GP_loss and of the scores in aucs)
+    model = make_model()
+    inputs = model_inputs(inputs)
+    p, n_samples = model.predict_adaptive(inputs, chunk_size=4, max_samples=4)
+    p_call = tf.nn.softmax(model(inputs))[:, 0].numpy().reshape(-1, 4).mean(1)
+    np.testing.assert_allclose(p, p_call, atol=1e-6)
+    np.testing.assert_array_equal(n_samples, 4)
+
+
+def test_pre_gathered_matches_gather(inputs):
+    # inputs of DataGenerator(precompute_geometry=True): observations gathered once, in time order
+    # (compact storage, cast back as in DataGenerator.extract_data)
+    static = model_inputs(inputs)[-1]
+    pre_gathered_inputs = [tf.cast(x, y.dtype) for x, y in zip(kernel_geometry([x.numpy() for x in inputs]), inputs)]
+    model = make_model()
+    logits = model(list(inputs) + [static])
+    pre_gathered_model = make_model(pre_gathered=True)
+    pre_gathered_model(pre_gathered_inputs + [static])
+    pre_gathered_model.set_weights(model.get_weights())
+    pre_gathered_logits = pre_gathered_model(pre_gathered_inputs + [static])
+    np.testing.assert_allclose(pre_gathered_logits.numpy(), logits.numpy(), atol=1e-5)
+
+
+def test_predict_moments_uncertainty_over_the_stay():
+    # stays shorter and longer than the time window: the left padding of the short ones is not averaged
+    inputs = model_inputs(pack_stays(synthetic_stays(3, duration=TIME_WINDOW / 2) + synthetic_stays(3, seed=2)))
+    X_len = inputs[6].numpy()
+    model = make_model()
+    _, uncertainty = model.predict_moments(inputs)
+    _, GP_var = model.GP(inputs[:-1], moments=True)
+    n_hours = np.minimum(X_len, TIME_WINDOW)
+    expected = [GP_var[b, -n_hours[b]:].numpy().mean() for b in range(len(X_len))]
+    np.testing.assert_allclose(uncertainty.numpy(), expected, rtol=1e-5)
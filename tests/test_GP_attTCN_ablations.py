@@ -0,0 +1,19 @@
+import pytest
+import tensorflow as tf
+
+from conftest import TIME_WINDOW, N_FEATURES, N_STAT, NUM_LAYERS, DO, L2REG
+from src.models.GP_attTCN_ablations import GPattTCN_alpha, GPattTCN_beta
+
+
+@pytest.mark.parametrize('model_class', [GPattTCN_alpha, GPattTCN_beta])
+def test_precision_and_static_pathway(inputs, model_class):
+    model = model_class(TIME_WINDOW, 2, N_FEATURES, N_STAT, num_layers=NUM_LAYERS, DO=DO, L2reg=L2REG,
+                        gp_dtype='float64', tcn_dtype='mixed_bfloat16', static_pathway=False)
+    assert model.GP.gp_dtype == tf.float64
+    assert not model.static_pathway
+    conv = [layer for layer in model.attTCN.layers[0].layers if isinstance(layer, tf.keras.layers.Conv1D)]
+    assert all(layer.compute_dtype == 'bfloat16' for layer in conv)
+    static = tf.zeros((inputs[0].shape[0], N_STAT))
+    logits = model(list(inputs) + [static])
+    assert logits.dtype == tf.float32
+    assert logits.shape == (inputs[0].shape[0] * 2, 2)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from conftest import assert_moments
+from src.models.GP_cache import PosteriorCache
+
+N_SAMPLES = 2000
+
+
+def cache_data(inputs):
+    # data format of DataGenerator(debug=True): [Y, T, ind_K_D, ind_T, len_T, X, len_X, labels, static, classes, ids]
+    batch = inputs[0].shape[0]
+    ids, horizons = np.arange(100, 100 + batch), np.arange(batch) % 3
+    return [x.numpy() for x in inputs] + [np.zeros(batch), np.zeros((batch, 1)), horizons, ids]
+
+
+def test_posterior_matches_moments(reference_GP, inputs):
+    mean, Sigma = reference_GP.posterior(list(inputs))
+    ref_mean, ref_var = reference_GP(list(inputs), moments=True)
+    var = np.diagonal(Sigma.numpy(), axis1=1, axis2=2).reshape(ref_var.shape)
+    np.testing.assert_allclose(mean.numpy(), ref_mean.numpy(), atol=1e-4)
+    np.testing.assert_allclose(var, ref_var.numpy(), atol=1e-4)
+
+
+@pytest.mark.parametrize('rank', [None, 8])
+def test_cache(reference_GP, inputs, tmp_path, rank):
+    data = cache_data(inputs)
+    cache = PosteriorCache(str(tmp_path)).build(reference_GP, [data], batch_size=4, rank=rank)
+    mean, Sigma = [x.numpy() for x in reference_GP.posterior(list(inputs))]
+    # rows in the order of the data (two batches)
+    rows = cache.rows(data[10], data[9])
+    np.testing.assert_array_equal(rows, np.arange(len(rows)))
+    factor, diag = cache.factor[rows].astype(np.float64), cache.diag[rows].astype(np.float64)
+    np.testing.assert_allclose(cache.mean[rows], mean, atol=2e-3)
+    # exact marginals whatever the rank, exact covariance with the full rank (up to float16)
+    cached_Sigma = factor @ np.transpose(factor, [0, 2, 1])
+    np.testing.assert_allclose(np.diagonal(cached_Sigma, axis1=1, axis2=2) + diag,
+                               np.diagonal(Sigma, axis1=1, axis2=2), atol=2e-3)
+    if rank is None:
+        np.testing.assert_allclose(cached_Sigma, Sigma, atol=2e-3)
+
+    draws = cache.sample(data[10], data[9], N_SAMPLES).numpy().reshape((len(rows), N_SAMPLES) + mean.shape[1:])
+    var = np.diagonal(Sigma, axis1=1, axis2=2).reshape(mean.shape)
+    assert_moments(draws.mean(1), draws.var(1), mean, var, N_SAMPLES, atol=2e-3)
+
+
+@pytest.mark.parametrize('noise', ['antithetic', 'crn'])
+def test_cache_noise(reference_GP, inputs, tmp_path, noise):
+    data = cache_data(inputs)
+    cache = PosteriorCache(str(tmp_path), noise=noise).build(reference_GP, [data], rank=8)
+    draws = cache.sample(data[10], data[9], 4).numpy()
+    if noise == 'antithetic':
+        # pairs (e, -e): exact mean
+        np.testing.assert_allclose(draws.reshape((-1, 4) + draws.shape[1:]).mean(1), cache.mean, atol=1e-6)
+    else:
+        np.testing.assert_array_equal(cache.sample(data[10], data[9], 4).numpy(), draws)
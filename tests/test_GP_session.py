@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from scipy.linalg import cholesky
+
+from conftest import TIME_WINDOW
+from src.models.GP_session import GPSession
+
+
+def one_stay(Y, T, ind_K_D):
+    # single patient in the input format of MultiKernelMGPLayer, observations in time order
+    n = len(T)
+    order = np.argsort(ind_K_D, kind='stable')
+    X = np.arange(int(T.min()), int(T.max()) + 1)
+    return [tf.constant([Y], tf.float32), tf.constant([T], tf.float32), tf.constant([ind_K_D[order]], tf.int32),
+            tf.constant([order], tf.int32), tf.constant([n], tf.int32), tf.constant([X], tf.float32),
+            tf.constant([len(X)], tf.int32)]
+
+
+@pytest.mark.parametrize('max_obs', [None, 8])
+def test_session_matches_full_refactorisation(reference_GP, inputs, max_obs):
+    # longest stay of the batch
+    patient = np.argmax(inputs[4].numpy())
+    Y, T, ind_K_D, ind_T, num_obs = [x[patient].numpy() for x in inputs[:5]]
+    Y, T = Y[:num_obs], T[:num_obs]
+    features = np.zeros(num_obs, dtype=int)
+    features[ind_T[:num_obs]] = ind_K_D[:num_obs]
+
+    session = GPSession(reference_GP, max_obs=max_obs)
+    # one observation, then chunks of 3
+    for start, stop in zip([0] + list(range(1, num_obs, 3)), list(range(1, num_obs, 3)) + [num_obs]):
+        session.append(Y[start:stop], T[start:stop], features[start:stop])
+    kept = slice(0, num_obs) if max_obs is None else slice(num_obs - max_obs, num_obs)
+    np.testing.assert_array_equal(session.T, T[kept])
+
+    # factor of the appended / dropped observations against a cholesky from scratch
+    np.testing.assert_allclose(session.L, cholesky(session.covariance(session.T, session.ind_K_D), lower=True),
+                               atol=1e-5)
+    mean, var = session.draw(moments=True)
+    ref_mean, ref_var = reference_GP(one_stay(Y[kept], T[kept], features[kept]), moments=True)
+    assert mean.shape == (TIME_WINDOW, reference_GP.n_features)
+    np.testing.assert_allclose(mean.numpy(), ref_mean[0].numpy(), atol=1e-4)
+    np.testing.assert_allclose(var.numpy(), ref_var[0].numpy(), atol=1e-4)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from conftest import TIME_WINDOW, N_FEATURES, N_STAT, NUM_LAYERS, DO, L2REG, N_SAMPLES, synthetic_batch, make_GP, \
+    draw_statistics, assert_moments
+from src.models.GP import MultiKernelMGPLayer
+from src.models.GP_attTCN import GPattTCN
+from src.models.GP_sparse import SparseMultiKernelMGPLayer
+
+
+def test_draws_match_moments(reference_GP, inputs):
+    GP = make_GP(reference_GP, layer=SparseMultiKernelMGPLayer, n_inducing=4)
+    tf.random.set_seed(1)
+    ref_mean, ref_var = [x.numpy() for x in GP(list(inputs), moments=True)]
+    mean, var = draw_statistics(GP, inputs)
+    assert_moments(mean, var, ref_mean, ref_var, N_SAMPLES)
+
+
+def test_exact_with_inducing_points_on_all_observations():
+    # all the observations on the grid hours of the time window, every grid hour an inducing point: Q_TT = K_TT,
+    # up to the jitter (add_diag) that the two layers add at different places
+    inputs = synthetic_batch(on_grid=True, duration=TIME_WINDOW - 1)
+    tf.random.set_seed(0)
+    reference_GP = MultiKernelMGPLayer(TIME_WINDOW, 1, N_FEATURES, add_diag=1e-8, gp_dtype='float64')
+    ref_mean, ref_var = reference_GP(list(inputs), moments=True)
+    GP = make_GP(reference_GP, layer=SparseMultiKernelMGPLayer, n_inducing=TIME_WINDOW, add_diag=1e-8, gp_dtype='float64')
+    mean, var = GP(list(inputs), moments=True)
+    np.testing.assert_allclose(mean.numpy(), ref_mean.numpy(), atol=1e-5)
+    np.testing.assert_allclose(var.numpy(), ref_var.numpy(), atol=1e-5)
+
+
+def test_fitc_method_name():
+    # the only method of the layer, and the GP of GPattTCN(method_name='fitc')
+    with pytest.raises(NameError):
+        SparseMultiKernelMGPLayer(TIME_WINDOW, 1, N_FEATURES, method_name='chol')
+    model = GPattTCN(TIME_WINDOW, 1, N_FEATURES, N_STAT, num_layers=NUM_LAYERS, DO=DO, L2reg=L2REG,
+                     method_name='fitc', n_inducing=4)
+    assert isinstance(model.GP, SparseMultiKernelMGPLayer) and model.GP.n_inducing == 4
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from src.models.GP_utils import OU_kernel, OU_matmul, standard_normal, SOBOL_MAX_DIM
+
+
+def test_OU_matmul():
+    rng = np.random.RandomState(0)
+    # gaps much longer than the length scale
+    times = np.sort(np.concatenate([rng.uniform(0, 10, (3, 20)), rng.uniform(300, 310, (3, 20))], 1), 1)
+    V = rng.randn(3, 40, 2, 4)
+    K = OU_kernel(0.7, times, times).numpy()
+    np.testing.assert_allclose(OU_matmul(0.7, tf.constant(times), tf.constant(V)).numpy(),
+                               np.einsum('bij,bjfk->bifk', K, V), atol=1e-10)
+
+
+def assert_standard_normal(e):
+    # e = dim x n_samples: zero mean and unit variance within 5 standard errors, uncorrelated dimensions: MC level
+    # root mean square of the correlations (1 / sqrt(n_samples)), no pair of noise coordinates tied together
+    # (single Sobol pairs may be correlated at small n_samples, hence the loose bound on the largest correlation)
+    n_samples = e.shape[1]
+    np.testing.assert_array_less(np.abs(e.mean(1)), 5 / np.sqrt(n_samples))
+    np.testing.assert_array_less(np.abs(e.var(1) - 1), 5 * np.sqrt(2. / n_samples))
+    correlation = np.corrcoef(e)[~np.eye(e.shape[0], dtype=bool)]
+    assert np.sqrt(np.mean(np.square(correlation))) < 1.3 / np.sqrt(n_samples)
+    assert np.max(np.abs(correlation)) < 0.6
+
+
+@pytest.mark.parametrize('noise', ['mc', 'sobol'])
+def test_standard_normal(noise):
+    tf.random.set_seed(0)
+    # the first axis as the time steps of the Kalman noise
+    e = standard_normal((6, 3, 4, 512), noise).numpy()
+    assert_standard_normal(e.reshape(-1, 512))
+
+
+def test_sobol_calls_and_blocks_independent():
+    tf.random.set_seed(0)
+    # two calls with the same shape (e.g. the two components of the pathwise draws)
+    e = np.concatenate([standard_normal((2, 30, 512), 'sobol').numpy().reshape(-1, 512) for _ in range(2)])
+    assert_standard_normal(e)
+    # dimensions of different Sobol blocks
+    e = standard_normal((SOBOL_MAX_DIM + 20, 512), 'sobol').numpy()
+    assert_standard_normal(np.concatenate([e[:20], e[SOBOL_MAX_DIM:]]))
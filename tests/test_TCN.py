@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from conftest import NUM_LAYERS, DO, L2REG
+from src.models.TCN import make_model, TCNStream
+
+
+@pytest.mark.parametrize('add_classification_layer', [False, True])
+def test_stream_matches_model(add_classification_layer):
+    # one time step at a time against the causal TCN on the whole stream, longer than its receptive field
+    tf.random.set_seed(0)
+    n_steps, n_channels = 40, 6
+    model = make_model(time_window=n_steps, no_channels=n_channels, L2reg=L2REG, DO=DO, num_layers=NUM_LAYERS,
+                       kernel_size=3, stride=1, add_classification_layer=add_classification_layer)
+    inputs = tf.random.normal((2, n_steps, n_channels))
+    stream = TCNStream(model)
+    stream.reset(2)
+    outputs = tf.stack([stream.step(inputs[:, t]) for t in range(n_steps)], 1)
+    if add_classification_layer:
+        # the classification layer reads the last time step
+        outputs = outputs[:, -1]
+    np.testing.assert_allclose(outputs.numpy(), model(inputs).numpy(), rtol=1e-4, atol=1e-5)
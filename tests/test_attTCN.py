@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from conftest import TIME_WINDOW, N_FEATURES, N_STAT, NUM_LAYERS, DO, L2REG
+from src.models.attTCN import AttTCN
+from src.models.attTCN_alpha import AttTCN_alpha
+from src.models.attTCN_beta import AttTCN_beta
+
+N_PATIENTS = 3
+N_SAMPLES = 4
+
+
+@pytest.mark.parametrize('model_class', [AttTCN, AttTCN_alpha, AttTCN_beta])
+@pytest.mark.parametrize('kernel_size', [2, 3])
+def test_static_pathway_matches_broadcast_static(model_class, kernel_size):
+    tf.random.set_seed(0)
+    model = model_class(TIME_WINDOW, N_FEATURES + N_STAT, NUM_LAYERS, DO, L2REG, kernel_size=kernel_size)
+    dyn = tf.random.normal((N_PATIENTS * N_SAMPLES, TIME_WINDOW, N_FEATURES))
+    static = tf.random.normal((N_PATIENTS, N_STAT))
+    # static features repeated over the MC samples of each patient and over time
+    stat = tf.broadcast_to(tf.expand_dims(tf.repeat(static, N_SAMPLES, axis=0), 1),
+                           (N_PATIENTS * N_SAMPLES, TIME_WINDOW, N_STAT))
+    np.testing.assert_allclose(model(dyn, static=static).numpy(), model(tf.concat([dyn, stat], -1)).numpy(),
+                               rtol=1e-5, atol=1e-5)
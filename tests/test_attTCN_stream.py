@@ -0,0 +1,54 @@
+import numpy as np
+import tensorflow as tf
+
+from conftest import TIME_WINDOW, N_FEATURES, N_STAT, NUM_LAYERS, DO, L2REG
+from src.models.attTCN import AttTCN
+from src.models.attTCN_stream import AttTCNStream
+
+N_STREAMS = 2
+# stays longer than the time window and than the receptive field of the TCNs
+N_STEPS = 4 * TIME_WINDOW
+
+
+def stream_setup():
+    tf.random.set_seed(0)
+    model = AttTCN(TIME_WINDOW, N_FEATURES + N_STAT, NUM_LAYERS, DO, L2REG, kernel_size=3)
+    inputs = tf.random.normal((N_STREAMS, N_STEPS, N_FEATURES))
+    static = tf.random.normal((N_STREAMS, N_STAT))
+    # the stays left padded with time_window - 1 zero time steps, the static features on every time step
+    padded = tf.concat([tf.zeros((N_STREAMS, TIME_WINDOW - 1, N_FEATURES)), inputs], 1)
+    padded = tf.concat([padded, tf.broadcast_to(tf.expand_dims(static, 1), padded.shape[:2] + [N_STAT])], -1)
+    return model, inputs, static, padded
+
+
+def test_exact_stream_matches_windowed_model():
+    model, inputs, static, padded = stream_setup()
+    stream = AttTCNStream(model, TIME_WINDOW)
+    stream.reset(N_STREAMS, static=static)
+    for t in range(N_STEPS):
+        window = padded[:, t: t + TIME_WINDOW]
+        np.testing.assert_allclose(stream.step(inputs[:, t]).numpy(), model(window).numpy(), rtol=1e-4, atol=1e-5)
+
+
+def test_approximate_stream_attends_over_full_history_outputs():
+    # exact=False: attention over the last time_window outputs of the TCNs run on the whole (padded) stream
+    model, inputs, static, padded = stream_setup()
+    stream = AttTCNStream(model, TIME_WINDOW, exact=False)
+    stream.reset(N_STREAMS, static=static)
+    outputs = tf.stack([stream.step(inputs[:, t]) for t in range(N_STEPS)], 1)
+
+    def whole_stream(TCN):
+        # the layers one by one, the model itself expects time_window time steps
+        outputs = padded
+        for layer in TCN.layers:
+            outputs = layer(outputs)
+        return outputs
+
+    alpha_logits = model.alpha_layer(whole_stream(model.alphaTCN))
+    beta_out = whole_stream(model.betaTCN)
+    beta = tf.stack([model.beta_layer_pos(beta_out), model.beta_layer_neg(beta_out)], -1)
+    values = tf.einsum('btck,btc->btk', beta, padded)
+    for t in [0, TIME_WINDOW, N_STEPS - 1]:
+        window = slice(t, t + TIME_WINDOW)
+        expected = tf.reduce_sum(tf.nn.softmax(alpha_logits[:, window], 1) * values[:, window], 1)
+        np.testing.assert_allclose(outputs[:, t].numpy(), expected.numpy(), rtol=1e-4, atol=1e-5)
@@ -0,0 +1,62 @@
+import types
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from conftest import TIME_WINDOW, N_FEATURES, N_STAT, NUM_LAYERS, DO, L2REG
+from src.models.GP_attTCN import GPattTCN
+
+# the trainer imports tqdm & sklearn (through aucs)
+trainer = pytest.importorskip('src.trainers.trainer', exc_type=ImportError)
+
+METHOD_NAMES = ['chol', 'cg', 'kalman', 'pathwise', 'grid', 'fitc']
+
+
+def make_trainer(method_name, inputs, log_path, **kwargs):
+    tf.random.set_seed(0)
+    model = GPattTCN(TIME_WINDOW, 2, N_FEATURES, N_STAT, num_layers=NUM_LAYERS, DO=DO, L2reg=L2REG, noise='crn',
+                     method_name=method_name, static_shapes=True)
+    model(inputs)
+    # a few Lanczos steps: every step of the cg draws is a CG loop in the graph
+    model.GP.n_lanczos = 4
+    data = types.SimpleNamespace(train_case_idx=np.arange(len(inputs[0])), val_data=[[]], debug=False)
+    # SGD: the update is linear in the gradients
+    return trainer.Trainer(model, data, 1, len(inputs[0]), tf.keras.optimizers.SGD(1e-2), tf.Variable(0), {},
+                           str(log_path), **kwargs)
+
+
+def train_inputs(grid_inputs):
+    static = tf.random.stateless_normal((grid_inputs[0].shape[0], N_STAT), seed=[0, 0])
+    # labels of the 2 draws of every stay
+    y = tf.constant(np.repeat(np.arange(len(static)) % 2, 2), tf.int32)
+    return list(grid_inputs) + [static], y
+
+
+@pytest.mark.parametrize('method_name', METHOD_NAMES)
+def test_compiled_train_step_matches_eager(method_name, grid_inputs, tmp_path):
+    inputs, y = train_inputs(grid_inputs)
+    eager = make_trainer(method_name, inputs, tmp_path)
+    compiled = make_trainer(method_name, inputs, tmp_path, tf_function=True)
+    compiled.model.set_weights(eager.model.get_weights())
+    loss, _ = eager.train_step(inputs, y)
+    compiled_loss, _ = compiled.compiled_train_step(inputs, y)
+    np.testing.assert_allclose(compiled_loss.numpy(), loss.numpy(), rtol=1e-4)
+    for v, compiled_v in zip(eager.model.trainable_variables, compiled.model.trainable_variables):
+        np.testing.assert_allclose(compiled_v.numpy(), v.numpy(), atol=1e-4, err_msg=v.name)
+
+
+@pytest.mark.parametrize('method_name', METHOD_NAMES)
+def test_jit_compiled_train_step(method_name, grid_inputs, tmp_path):
+    # XLA pads the dynamic shapes of the patient buckets, so its 'crn' draws are not the eager ones:
+    # a finite update of the weights
+    inputs, y = train_inputs(grid_inputs)
+    compiled = make_trainer(method_name, inputs, tmp_path, jit_compile=True)
+    weights = compiled.model.get_weights()
+    loss, chol_metrics = compiled.compiled_train_step(inputs, y)
+    assert np.isfinite(loss.numpy())
+    assert all(np.isfinite(x.numpy()).all() for x in tf.nest.flatten(chol_metrics))
+    new_weights = compiled.model.get_weights()
+    assert all(np.isfinite(w).all() for w in new_weights)
+    assert any(not np.array_equal(new_w, w) for new_w, w in zip(new_weights, weights))
+    assert int(compiled.global_step.numpy()) == 1